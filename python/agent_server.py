@@ -2,52 +2,436 @@
 
 import asyncio
 import base64
+import bisect
 import codecs
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import inspect
 import json
 import logging
+import logging.handlers
+import math
+import mmap
+import multiprocessing
+import os
+import queue
 import re
+import secrets
 import signal
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
+import types
 import typing
+import weakref
+from collections import OrderedDict, deque
 from collections.abc import Callable
-from contextlib import asynccontextmanager
-from dataclasses import dataclass
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field, is_dataclass
 from types import FrameType
-from uuid import uuid4
+from uuid import UUID, uuid4
 
 from ag_ui.core import CustomEvent
-from ag_ui.core.types import RunAgentInput, TextInputContent, BinaryInputContent
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
-from pydantic_ai import Agent, DeferredToolRequests, DeferredToolResults
+from ag_ui.core.types import RunAgentInput, TextInputContent, BinaryInputContent, UserMessage
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from pydantic_ai import Agent, DeferredToolRequests, DeferredToolResults, RunContext
 from pydantic_ai.ag_ui import run_ag_ui, StateDeps
-from pydantic_ai.messages import ModelMessage, ModelRequest, ToolCallPart, UserPromptPart
+from pydantic_ai.messages import (
+    BinaryContent,
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    PartDeltaEvent,
+    PartStartEvent,
+    TextPart,
+    TextPartDelta,
+    ToolCallPart,
+    ToolCallPartDelta,
+    UserPromptPart,
+)
+from pydantic_ai.models import Model, ModelRequestParameters, StreamedResponse, infer_model
 from pydantic_ai.models.function import DeltaToolCall, FunctionModel, AgentInfo
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.settings import ModelSettings
 from pydantic_ai.toolsets import FunctionToolset
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
-from simpleeval import simple_eval
-from starlette.responses import StreamingResponse, FileResponse
+from starlette.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
 
 from opentelemetry import trace
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
-from opentelemetry.sdk.trace.export import (
-    BatchSpanProcessor,
-    ConsoleSpanExporter,
-    SpanExportResult,
-)
+from opentelemetry.trace import Status, StatusCode
 from pydantic_ai import InstrumentationSettings
 
+# Pillow, the OpenTelemetry SDK and the expression worker's dependencies are imported
+# on first use (see render_meme, instrument and ExpressionWorker) to keep startup fast
+if typing.TYPE_CHECKING:
+    from PIL import ImageDraw, ImageFont
+
+    import tracing
+
+# --- Logging ---
+
+# Records are queued by the logging call and written to stderr by a background thread,
+# so a slow terminal or pipe never blocks the event loop.
+# AGUI_LOG_FORMAT is "text" or "json" (one object per line, with the session and run ids);
+# AGUI_LOG_LEVELS sets per-logger levels, e.g. "agent_server=INFO,pydantic_ai=DEBUG".
+LOG_FORMAT = os.environ.get("AGUI_LOG_FORMAT", "text")
+LOG_LEVELS = os.environ.get("AGUI_LOG_LEVELS", "")
+LOG_QUEUE_SIZE = 10_000  # records waiting for the writer thread before new ones are dropped
+
+
+class ContextFilter(logging.Filter):
+    """Tags records with the session token prefix and run id of the task that logged them."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        token = current_session_token.get()
+        # The full token is a bearer credential; the prefix is what /debug/sessions shows
+        record.session = token[:8] if token else None
+        record.run_id = current_run_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, typing.Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("session", "run_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them rather than blocking when it falls behind."""
+
+    def __init__(self, log_queue: queue.Queue[typing.Any]):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Format the message now, while its arguments are current, but leave the
+        # traceback for the writer thread's formatter
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_log_levels(spec: str) -> dict[str, int]:
+    """Parse "name=LEVEL,..." into logger names and levels ("root" for the root logger)."""
+    levels = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        try:
+            levels[name.strip()] = logging.getLevelNamesMapping()[level.strip().upper()]
+        except KeyError:
+            raise ValueError(f"AGUI_LOG_LEVELS: unknown level {level.strip()!r} for {name.strip()!r}") from None
+    return levels
+
+
+def configure_logging(
+    log_format: str = LOG_FORMAT, levels: str = LOG_LEVELS
+) -> tuple[LogQueueHandler, logging.handlers.QueueListener]:
+    """Send all records through a queue to a stderr writer thread.
+
+    Called by lifespan rather than at import, so importing agent_server (in tests, or
+    from another app) leaves the root logger alone. Levels already set by the embedding
+    code are kept unless levels overrides them.
+    """
+    parsed_levels = parse_log_levels(levels)
+    stream_handler = logging.StreamHandler()
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+    listener.start()
+
+    logging.getLogger().addHandler(handler)
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.DEBUG)
+    for name, level in parsed_levels.items():
+        logging.getLogger(None if name == "root" else name).setLevel(level)
+    return handler, listener
+
+
+# Installed by lifespan
+log_handler: LogQueueHandler | None = None
 logger = logging.getLogger("agent_server")
-logger.setLevel(logging.DEBUG)
-_handler = logging.StreamHandler()
-_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(_handler)
 
 
 DEBUG = False
 
+# /debug endpoints show every session's data and switch on process-wide instrumentation,
+# so they only answer when DEBUG is on or the request has "Authorization: Bearer <AGUI_ADMIN_TOKEN>"
+ADMIN_TOKEN = os.environ.get("AGUI_ADMIN_TOKEN", "")
+
+
+async def require_debug_access(request: Request) -> None:
+    """Dependency that turns away callers who may not use the /debug endpoints."""
+    if DEBUG:
+        return
+    authorization = request.headers.get("authorization", "")
+    if ADMIN_TOKEN and secrets.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}"):
+        return
+    raise HTTPException(status_code=403, detail="Debug endpoints need DEBUG or AGUI_ADMIN_TOKEN")
+
+
+# --- Metrics ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{json.dumps(value)[1:-1]}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """Base for the small Prometheus-style metrics below; values are keyed by label values."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> typing.Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> typing.Iterable[str]:
+        for key, value in list(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value read at scrape time, so keeping it current costs nothing on the hot path."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        super().__init__(name, help)
+        self.read = read
+
+    def samples(self) -> typing.Iterable[str]:
+        yield f"{self.name} {_format_value(self.read())}"
+
+
+class CounterReader(Metric):
+    """A counter kept by another object (e.g. a stats dataclass) and read at scrape time.
+
+    read returns the current value for each combination of label values.
+    """
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], dict[tuple[str, ...], float]],
+        labelnames: tuple[str, ...] = (),
+    ):
+        super().__init__(name, help, labelnames)
+        self.read = read
+
+    def samples(self) -> typing.Iterable[str]:
+        for key, value in self.read().items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # label values -> [count per bucket (plus +Inf)], sum
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self.values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> typing.Iterable[str]:
+        for key, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register[M: Metric](self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+
+active_sessions_gauge = metrics.register(Gauge(
+    "agui_active_sessions", "Sessions with an open /events stream", lambda: len(sessions),
+))
+session_queue_depth_gauge = metrics.register(Gauge(
+    "agui_session_queue_depth", "Events waiting in all /events queues",
+    lambda: sum(session.queue.qsize() for session in list(sessions.values())),
+))
+session_queue_depth_max_gauge = metrics.register(Gauge(
+    "agui_session_queue_depth_max", "Events waiting in the fullest /events queue",
+    lambda: max((session.queue.qsize() for session in list(sessions.values())), default=0),
+))
+events_connects = metrics.register(Counter("agui_events_connects_total", "/events streams opened"))
+events_disconnects = metrics.register(Counter("agui_events_disconnects_total", "/events streams closed"))
+run_duration = metrics.register(Histogram(
+    "agui_run_duration_seconds", "Duration of /agent runs by outcome", ("outcome",),
+))
+run_ttft = metrics.register(Histogram(
+    "agui_run_time_to_first_token_seconds", "Time from run start to the first text or tool call event",
+))
+run_ttfb = metrics.register(Histogram(
+    "agui_run_time_to_first_byte_seconds", "Time from receiving POST /agent to sending its first chunk",
+))
+run_events = metrics.register(Histogram(
+    "agui_run_events", "SSE events sent per /agent run", buckets=COUNT_BUCKETS,
+))
+tool_calls = metrics.register(Counter("agui_tool_calls_total", "Tool calls by tool and outcome", ("tool", "outcome")))
+tool_latency = metrics.register(Histogram("agui_tool_call_duration_seconds", "Tool call latency", ("tool",)))
+attachment_bytes = metrics.register(Counter(
+    "agui_attachment_bytes_decoded_total", "Decoded size of processed attachments", ("kind",),
+))
+meme_render_time = metrics.register(Histogram("agui_meme_render_seconds", "Time to render a meme image"))
+session_memory_evictions = metrics.register(Counter(
+    "agui_session_memory_evictions_total", "Times a session over its memory limit shed data, by what", ("action",),
+))
+active_runs_gauge = metrics.register(Gauge(
+    "agui_active_runs", "/agent runs currently streaming", lambda: len(drainer.runs),
+))
+draining_gauge = metrics.register(Gauge(
+    "agui_draining", "1 while the server is draining for shutdown", lambda: drainer.draining,
+))
+events_published = metrics.register(Counter(
+    "agui_events_published_total", "Events queued for /events streams, by how they were addressed", ("target",),
+))
+events_dropped = metrics.register(Counter(
+    "agui_events_dropped_total", "Events not delivered because an /events queue was full",
+))
+log_records_dropped_gauge = metrics.register(Gauge(
+    "agui_log_records_dropped", "Log records dropped because the log writer fell behind",
+    lambda: log_handler.dropped if log_handler else 0,
+))
+tool_cache_lookups = metrics.register(CounterReader(
+    "agui_tool_cache_lookups_total", "Tool result cache lookups by tool and how they were served",
+    lambda: {
+        (name, result): stats[result]
+        for name, stats in toolset.cache_stats().items()
+        for result in ("hits", "misses", "shared", "bypassed")
+    },
+    ("tool", "result"),
+))
+tool_cache_entries_gauge = metrics.register(Gauge(
+    "agui_tool_cache_entries", "Results held in all tool result caches",
+    lambda: sum(len(cache.entries) for cache in toolset.caches.values()),
+))
+tool_calls_rejected = metrics.register(CounterReader(
+    "agui_tool_calls_rejected_total", "Tool calls turned away by a full backlog or open circuit breaker",
+    lambda: {(name,): runner.rejected for name, runner in toolset.runners.items()}, ("tool",),
+))
+expression_evaluations = metrics.register(CounterReader(
+    "agui_expression_evaluations_total", "Expression worker calls by outcome",
+    lambda: expression_pool.stats.by_outcome(), ("outcome",),
+))
+expression_evaluation_time = metrics.register(CounterReader(
+    "agui_expression_evaluation_seconds_total", "Time spent waiting for expression workers",
+    lambda: {(): expression_pool.stats.latency_total},
+))
+expression_evaluation_time_max = metrics.register(Gauge(
+    "agui_expression_evaluation_seconds_max", "Slowest expression worker call",
+    lambda: expression_pool.stats.latency_max,
+))
+
 
 def tool_schema_to_a2ui(tool_name: str, tool: typing.Any) -> list[dict[str, typing.Any]]:
     """Convert a tool's JSON schema into A2UI messages for a form UI."""
@@ -154,15 +538,865 @@ class Dependencies(BaseModel):
     pass
 
 
+PAUSED_RUN_TTL = 900.0  # seconds a run paused for approval can be resumed from its snapshot
+
+
+@dataclass
+class PausedRun:
+    """Snapshot of a run that ended with DeferredToolRequests, so approvals can resume it."""
+    thread_id: str
+    messages: list[ModelMessage]
+    # ids of the deferred tool calls that need a decision
+    pending: set[str]
+    created: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class RunStats:
+    """Usage and latency of one run, or running totals over a session's runs."""
+    runs: int = 0
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    tool_calls: int = 0
+    # Seconds the run spent outside tools (model calls and framework overhead)
+    model_time: float = 0.0
+    tool_time: float = 0.0
+    # Only meaningful for a single run
+    time_to_first_token: float | None = None
+    bytes_streamed: int = 0
+
+    def add(self, other: RunStats) -> None:
+        self.runs += other.runs
+        self.requests += other.requests
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.tool_calls += other.tool_calls
+        self.model_time += other.model_time
+        self.tool_time += other.tool_time
+        self.bytes_streamed += other.bytes_streamed
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return {
+            "runs": self.runs,
+            "requests": self.requests,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "tool_calls": self.tool_calls,
+            "model_time_ms": round(self.model_time * 1000, 1),
+            "tool_time_ms": round(self.tool_time * 1000, 1),
+            "time_to_first_token_ms": (
+                round(self.time_to_first_token * 1000, 1) if self.time_to_first_token is not None else None
+            ),
+            "bytes_streamed": self.bytes_streamed,
+        }
+
+
+# Stats of the /agent run being streamed, so tool calls can add their time
+current_run_stats: contextvars.ContextVar[RunStats | None] = contextvars.ContextVar("current_run_stats", default=None)
+
+
 @dataclass
 class Session:
     """Holds state for each connected client session."""
     agent: Agent[typing.Any]
     queue: asyncio.Queue[typing.Any]
     current_task: asyncio.Task[typing.Any] | None = None
+    router: ModelRouter | None = None
+    # id of the last summarized message -> summary of the history up to it
+    history_summaries: dict[str, str] = field(default_factory=dict)
+    paused_run: PausedRun | None = None
+    usage: RunStats = field(default_factory=RunStats)
+
+
+def take_paused_run(session: Session, run_input: RunAgentInput) -> list[ModelMessage]:
+    """Consume the session's paused run for a resume request and return its history.
+
+    The approvals must decide exactly the snapshot's pending calls. Raises 409 if there
+    is no matching snapshot, so the client can fall back to resending the history, and
+    400 if the request also carries conversation messages, which would be appended to
+    the snapshot a second time.
+    """
+    if any(message.role != "tool" for message in run_input.messages):
+        raise HTTPException(
+            status_code=400, detail="A resume request carries only approvals and tool results, not the conversation"
+        )
+    paused = session.paused_run
+    approvals = (run_input.state or {}).get("deferred_tool_approvals", {})
+    if (
+        paused is None
+        or paused.thread_id != run_input.thread_id
+        or time.monotonic() - paused.created > PAUSED_RUN_TTL
+        or set(approvals) != paused.pending
+    ):
+        raise HTTPException(status_code=409, detail="No paused run to resume; resend the conversation")
+    session.paused_run = None
+    return paused.messages
+
+
+class ToolResultCache:
+    """LRU/TTL cache of one tool's results with single-flight de-duplication.
+
+    Concurrent calls with the same arguments (from any session) share one execution.
+    Calls whose arguments fail should_cache_args (e.g. they ask for something random)
+    bypass the cache, and results that fail should_cache_result are not stored.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: float = 3600.0,
+        should_cache_args: Callable[[dict[str, typing.Any]], bool] | None = None,
+        should_cache_result: Callable[[typing.Any], bool] | None = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.should_cache_args = should_cache_args
+        self.should_cache_result = should_cache_result
+        self.entries: OrderedDict[str, tuple[float, typing.Any]] = OrderedDict()
+        self.inflight: dict[str, asyncio.Future[typing.Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def key(args: dict[str, typing.Any]) -> str:
+        return json.dumps(args, sort_keys=True, separators=(",", ":"), default=str)
+
+    async def call(
+        self,
+        args: dict[str, typing.Any],
+        compute: Callable[[], typing.Awaitable[typing.Any]],
+    ) -> typing.Any:
+        if self.should_cache_args is not None and not self.should_cache_args(args):
+            self.bypassed += 1
+            return await compute()
+        key = self.key(args)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if time.monotonic() - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+
+        inflight = self.inflight.get(key)
+        if inflight is not None:
+            self.shared += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        # Run in its own task so a cancelled caller doesn't cancel the other waiters
+        task = asyncio.ensure_future(compute())
+        self.inflight[key] = task
+        task.add_done_callback(lambda t: self._finished(key, t))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Future[typing.Any]) -> None:
+        self.inflight.pop(key, None)
+        # Exceptions (e.g. ToolOverloaded) are never cached
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.should_cache_result is not None and not self.should_cache_result(task.result()):
+            return
+        self.entries[key] = (time.monotonic(), task.result())
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, args: dict[str, typing.Any]) -> None:
+        self.entries.pop(self.key(args), None)
+
+    def stats(self) -> dict[str, typing.Any]:
+        lookups = self.hits + self.misses + self.shared
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "bypassed": self.bypassed,
+            "hit_rate": (self.hits + self.shared) / lookups if lookups else 0.0,
+            "size": len(self.entries),
+        }
+
+
+# --- Tool progress ---
+
+TOOL_PROGRESS_MIN_INTERVAL = 0.25  # seconds between tool_progress events for one tool call
+RUN_OUTPUT_QUEUE_SIZE = 256  # chunks a run may get ahead of its response stream
+
+# Progress sink of the /agent run being streamed, and the tool call currently executing
+current_tool_progress: contextvars.ContextVar[ToolProgressStream | None] = contextvars.ContextVar(
+    "current_tool_progress", default=None
+)
+current_tool_call: contextvars.ContextVar[tuple[str, str | None] | None] = contextvars.ContextVar(
+    "current_tool_call", default=None
+)
+
+
+@dataclass
+class ToolProgress:
+    """Yielded by async-generator tools to report progress; any other yielded value is the result."""
+    fraction: float | None = None
+    message: str | None = None
+
+
+class ToolProgressChunk(str):
+    """An SSE chunk carrying a tool_progress event, so it can be told apart from run_ag_ui output."""
+
+
+class ToolProgressStream:
+    """Turns progress reported by tools during one run into tool_progress CustomEvent chunks.
+
+    Updates for a tool call arriving less than min_interval apart are coalesced: only
+    the latest one is sent, once the interval has passed.
+    """
+
+    def __init__(self, emit: Callable[[ToolProgressChunk], None], min_interval: float = TOOL_PROGRESS_MIN_INTERVAL):
+        self.emit = emit
+        self.min_interval = min_interval
+        self.loop = asyncio.get_running_loop()
+        self.last_sent: dict[str, float] = {}
+        self.pending: dict[str, CustomEvent] = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def report(self, tool_name: str, tool_call_id: str | None, fraction: float | None, message: str | None) -> None:
+        """Queue a progress update; safe to call from tool threads."""
+        event = CustomEvent(
+            name="tool_progress",
+            value={"tool_name": tool_name, "tool_call_id": tool_call_id, "fraction": fraction, "message": message},
+            timestamp=int(time.time() * 1000),
+        )
+        key = tool_call_id or tool_name
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._submit(key, event)
+        else:
+            self.loop.call_soon_threadsafe(self._submit, key, event)
+
+    def _submit(self, key: str, event: CustomEvent) -> None:
+        if key in self.pending:
+            # A send is already scheduled; it will carry this newer update
+            self.coalesced += 1
+            self.pending[key] = event
+            return
+        wait = self.last_sent.get(key, -math.inf) + self.min_interval - time.monotonic()
+        if wait <= 0:
+            self._send(key, event)
+        else:
+            self.pending[key] = event
+            self.loop.call_later(wait, self._flush_one, key)
+
+    def _flush_one(self, key: str) -> None:
+        event = self.pending.pop(key, None)
+        if event is not None:
+            self._send(key, event)
+
+    def _send(self, key: str, event: CustomEvent) -> None:
+        self.last_sent[key] = time.monotonic()
+        self.sent += 1
+        self.emit(ToolProgressChunk(f"data: {json.dumps(event.model_dump())}\n\n"))
+
+    def flush(self) -> None:
+        """Send every coalesced update now (the run is ending)."""
+        for key in list(self.pending):
+            self._flush_one(key)
+
+
+def report_progress(fraction: float | None = None, message: str | None = None) -> None:
+    """Report progress of the running tool call to the client's /agent stream.
+
+    Call from inside a tool; it's a no-op when the tool isn't running in an /agent run.
+    """
+    stream = current_tool_progress.get()
+    call = current_tool_call.get()
+    if stream is not None and call is not None:
+        stream.report(call[0], call[1], fraction, message)
+
+
+_PRODUCER_DONE = object()
+
+
+async def with_tool_progress(chunks: typing.AsyncIterator[str]) -> typing.AsyncIterator[str]:
+    """Yield chunks, interleaved with tool_progress chunks reported while they are produced.
+
+    One producer task consumes chunks (the run keeps a single task and context) while
+    this generator waits on both the run's output and tool progress.
+    """
+    # Bounded, so a slow client holds the run back instead of letting its output pile up
+    output: asyncio.Queue[typing.Any] = asyncio.Queue(RUN_OUTPUT_QUEUE_SIZE)
+
+    def emit_progress(chunk: ToolProgressChunk) -> None:
+        # Progress is already coalesced and only advisory; drop it rather than wait for room
+        try:
+            output.put_nowait(chunk)
+        except asyncio.QueueFull:
+            progress.dropped += 1
+
+    progress = ToolProgressStream(emit_progress)
+
+    async def produce() -> None:
+        # Nothing is queued once cancelled: the consumer has stopped reading
+        try:
+            async for chunk in chunks:
+                await output.put(chunk)
+            progress.flush()
+        except Exception as e:  # noqa: BLE001 - handed to the consumer, which re-raises it
+            await output.put(e)
+        else:
+            await output.put(_PRODUCER_DONE)
+
+    # The task copies the context, so tools run by it see this run's progress stream
+    reset = current_tool_progress.set(progress)
+    producer = asyncio.create_task(produce())
+    current_tool_progress.reset(reset)
+    try:
+        while (item := await output.get()) is not _PRODUCER_DONE:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+
+class ToolExecutor:
+    """Where sync tool functions run: inline on the event loop, a thread pool or a process pool.
+
+    One executor can be shared by several tools (e.g. shared_tool_executor) or
+    dedicated to a single tool.
+    """
+
+    def __init__(
+        self,
+        kind: typing.Literal["inline", "threads", "processes"] = "threads",
+        max_workers: int = 4,
+        name: str = "tools",
+    ):
+        self.kind = kind
+        self.max_workers = max_workers
+        self.name = name
+        self._pool: concurrent.futures.Executor | None = None
+        tool_executors.add(self)
+
+    @property
+    def pool(self) -> concurrent.futures.Executor:
+        if self._pool is None:
+            if self.kind == "processes":
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix=self.name
+                )
+        return self._pool
+
+    async def run(self, func: Callable[..., typing.Any], *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        if self.kind == "inline":
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        if self.kind == "threads":
+            # Carry the context over so tools can report_progress() from the worker thread
+            return await loop.run_in_executor(self.pool, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+        return await loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+# Every live executor, so lifespan can shut them down; dropped ones fall out on their own
+tool_executors: weakref.WeakSet[ToolExecutor] = weakref.WeakSet()
+
+shared_tool_executor = ToolExecutor("threads", max_workers=8, name="shared-tools")
+inline_tool_executor = ToolExecutor("inline", name="inline-tools")
+
+
+@dataclass
+class ToolExecution:
+    """How one sync tool is executed: its executor plus per-tool limits."""
+    executor: ToolExecutor = field(default_factory=lambda: shared_tool_executor)
+    # Calls of this tool allowed to run at once (None: limited only by the executor)
+    max_concurrency: int | None = None
+    # Calls allowed to be running or waiting before the circuit breaker opens
+    max_backlog: int | None = None
+    # Seconds the breaker stays open, failing calls fast, once tripped
+    breaker_reset: float = 5.0
+
+
+class ToolOverloaded(Exception):
+    """A tool's backlog is full or its breaker is open.
+
+    ServerToolset turns this into a plain tool result, so it doesn't use up the
+    tool's retries the way ModelRetry would.
+    """
+
+
+class ToolRunner:
+    """Runs one sync tool according to its ToolExecution, with a backlog circuit breaker."""
+
+    def __init__(self, name: str, execution: ToolExecution):
+        self.name = name
+        self.execution = execution
+        self.semaphore = asyncio.Semaphore(execution.max_concurrency) if execution.max_concurrency else None
+        self.backlog = 0
+        self.open_until = 0.0
+        self.rejected = 0
+
+    def admit(self) -> None:
+        """Count a call against the backlog, or raise ToolOverloaded if the breaker is open."""
+        limit = self.execution.max_backlog
+        now = time.monotonic()
+        if now < self.open_until or (limit is not None and self.backlog >= limit):
+            if now >= self.open_until:
+                logger.warning(f"Tool {self.name} backlog reached {self.backlog}, failing fast for {self.execution.breaker_reset}s")
+                self.open_until = now + self.execution.breaker_reset
+            self.rejected += 1
+            raise ToolOverloaded(f"The {self.name} tool is overloaded right now. Try again later or continue without it.")
+        self.backlog += 1
+
+    async def run(self, func: Callable[..., typing.Any], *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        self.admit()
+        return await self.run_admitted(func, *args, **kwargs)
+
+    async def run_admitted(self, func: Callable[..., typing.Any], *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        """Run a call that admit() already counted."""
+        try:
+            if self.semaphore is None:
+                return await self.execution.executor.run(func, *args, **kwargs)
+            async with self.semaphore:
+                return await self.execution.executor.run(func, *args, **kwargs)
+        finally:
+            self.backlog -= 1
+
+
+class ServerToolset(FunctionToolset[typing.Any]):
+    """FunctionToolset whose tools can be given a result cache and an executor when added."""
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any):
+        super().__init__(*args, **kwargs)
+        self.caches: dict[str, ToolResultCache] = {}
+        self.runners: dict[str, ToolRunner] = {}
+        # Tools without side effects, whose calls a cached response may replay
+        self.pure: set[str] = set()
+
+    def add_function(  # type: ignore[override]
+        self,
+        func: typing.Any,
+        *args: typing.Any,
+        cache: ToolResultCache | None = None,
+        execution: ToolExecution | None = None,
+        pure: bool = False,
+        **kwargs: typing.Any,
+    ) -> typing.Any:
+        """Add a tool.
+
+        Pass cache= for tools whose results can be reused, pure=True for tools without
+        side effects whose calls can be replayed with a cached response, and execution=
+        to choose where a sync tool runs (by default the framework's thread pool).
+        Async-generator tools report progress by yielding ToolProgress; their last other
+        value is the result.
+        """
+        if inspect.isasyncgenfunction(func):
+            gen_func = func
+
+            @functools.wraps(gen_func)
+            async def collect_progress(*call_args: typing.Any, **call_kwargs: typing.Any) -> typing.Any:
+                result = None
+                async for item in gen_func(*call_args, **call_kwargs):
+                    if isinstance(item, ToolProgress):
+                        report_progress(item.fraction, item.message)
+                    else:
+                        result = item
+                return result
+
+            func = collect_progress
+        elif execution is not None and not inspect.iscoroutinefunction(func):
+            runner = ToolRunner(kwargs.get("name") or func.__name__, execution)
+            sync_func = func
+
+            # wraps() keeps the signature and docstring the tool schema is built from
+            @functools.wraps(sync_func)
+            async def run_in_executor(*call_args: typing.Any, **call_kwargs: typing.Any) -> typing.Any:
+                return await runner.run(sync_func, *call_args, **call_kwargs)
+
+            run_in_executor.runner = runner  # type: ignore[attr-defined]
+            self.runners[runner.name] = runner
+            func = run_in_executor
+        elif hasattr(func, "runner"):
+            # Re-registering an already wrapped tool, e.g. in the manual-run toolset
+            self.runners[kwargs.get("name") or func.__name__] = func.runner
+        tool = super().add_function(func, *args, **kwargs)
+        if cache is not None:
+            self.caches[tool.name] = cache
+        if pure:
+            self.pure.add(tool.name)
+        return tool
+
+    def is_replayable(self, name: str, tool_args: dict[str, typing.Any]) -> bool:
+        """True if replaying this call's recorded result is as good as making it again."""
+        if name not in self.pure:
+            return False
+        cache = self.caches.get(name)
+        return cache is None or cache.should_cache_args is None or cache.should_cache_args(tool_args)
+
+    async def call_tool(self, name: str, tool_args: dict[str, typing.Any], ctx: typing.Any, tool: typing.Any) -> typing.Any:
+        call = current_tool_call.set((name, getattr(ctx, "tool_call_id", None)))
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            cache = self.caches.get(name)
+            if cache is None:
+                result = await super().call_tool(name, tool_args, ctx, tool)
+            else:
+                result = await cache.call(tool_args, lambda: super(ServerToolset, self).call_tool(name, tool_args, ctx, tool))
+            outcome = "ok"
+            return result
+        except ToolOverloaded as e:
+            outcome = "overloaded"
+            return str(e)
+        finally:
+            current_tool_call.reset(call)
+            elapsed = time.perf_counter() - start
+            tool_calls.inc(tool=name, outcome=outcome)
+            tool_latency.observe(elapsed, tool=name)
+            stats = current_run_stats.get()
+            if stats is not None:
+                stats.tool_calls += 1
+                stats.tool_time += elapsed
+            profile = current_profile.get()
+            if profile is not None:
+                profile.add(f"{RUN_STAGE};tool:{name}", elapsed)
+
+    def cache_stats(self) -> dict[str, dict[str, typing.Any]]:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
 
+toolset = ServerToolset()
 
-toolset = FunctionToolset()
+
+# --- Background jobs ---
+
+JOB_RETENTION = 600.0  # seconds a finished job stays available for status lookups
+
+# Session token of the /agent run a tool is executing in, so jobs know where to report
+current_session_token: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_session_token", default=None
+)
+# Id of the /agent run being streamed, for log records
+current_run_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_run_id", default=None)
+
+ProgressCallback = Callable[[float, str | None], None]
+
+
+@dataclass
+class Job:
+    """A slow tool call finishing in the background after its tool has returned."""
+    id: str
+    tool_name: str
+    token: str | None
+    status: typing.Literal["pending", "running", "done", "failed"] = "pending"
+    progress: float = 0.0
+    message: str | None = None
+    result: typing.Any = None
+    error: str | None = None
+    finished_at: float | None = None
+    task: asyncio.Task[typing.Any] | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        return {
+            "job_id": self.id,
+            "tool_name": self.tool_name,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "error": self.error,
+        }
+
+    async def wait(self, timeout: float | None = None) -> None:
+        """Wait up to timeout seconds for the job to finish (never cancels it)."""
+        if self.task is not None and not self.done:
+            await asyncio.wait({self.task}, timeout=timeout)
+
+
+class JobManager:
+    """Runs jobs and pushes job_progress / job_finished CustomEvents to the owning session's /events stream."""
+
+    def __init__(self, retention: float = JOB_RETENTION):
+        self.retention = retention
+        self.jobs: dict[str, Job] = {}
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def submit(
+        self,
+        tool_name: str,
+        func: Callable[..., typing.Any],
+        *args: typing.Any,
+        runner: ToolRunner,
+        job_id: str | None = None,
+        **kwargs: typing.Any,
+    ) -> Job:
+        """Start func(*args, progress=..., **kwargs) on runner's executor and return its job at once.
+
+        progress(fraction, message) may be called from any thread. It can't be pickled,
+        so job functions need an inline or thread executor. Raises ToolOverloaded right away
+        if the runner's backlog is full.
+        """
+        self._prune()
+        runner.admit()
+        job = Job(id=job_id or uuid4().hex[:12], tool_name=tool_name, token=current_session_token.get())
+        self.jobs[job.id] = job
+        loop = asyncio.get_running_loop()
+
+        def progress(fraction: float, message: str | None = None) -> None:
+            loop.call_soon_threadsafe(self._progress, job, fraction, message)
+
+        job.task = asyncio.create_task(self._run(job, runner, func, args, {**kwargs, "progress": progress}))
+        self._publish(job, "job_progress")
+        return job
+
+    async def _run(
+        self,
+        job: Job,
+        runner: ToolRunner,
+        func: Callable[..., typing.Any],
+        args: tuple[typing.Any, ...],
+        kwargs: dict[str, typing.Any],
+    ) -> None:
+        job.status = "running"
+        try:
+            job.result = await runner.run_admitted(func, *args, **kwargs)
+            job.status = "done"
+            job.progress = 1.0
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "cancelled"
+            raise
+        except Exception as e:  # noqa: BLE001 - job functions are arbitrary tool code; the error goes to the client
+            logger.warning(f"Job {job.id} ({job.tool_name}) failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.monotonic()
+            self._publish(job, "job_finished")
+
+    def _progress(self, job: Job, fraction: float, message: str | None) -> None:
+        if job.done:
+            return
+        job.progress = fraction
+        job.message = message
+        self._publish(job, "job_progress")
+
+    def _publish(self, job: Job, name: str) -> None:
+        if job.token is None:
+            return
+        event = CustomEvent(name=name, value=job.snapshot(), timestamp=int(time.time() * 1000))
+        broker.send(job.token, event.model_dump())
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - self.retention
+        for job_id in [
+            job.id for job in self.jobs.values()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]:
+            del self.jobs[job_id]
+
+    def cancel_all(self) -> None:
+        for job in self.jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+
+
+jobs = JobManager()
+
+
+# --- Sandboxed expression evaluation ---
+
+EXPRESSION_POOL_SIZE = 2
+EXPRESSION_TIMEOUT = 2.0  # seconds of wall time before the worker is killed
+EXPRESSION_CPU_SECONDS = 2  # CPU seconds per call
+EXPRESSION_MEMORY_BYTES = 256 * 1024 * 1024
+EXPRESSION_WAIT_TIMEOUT = 10.0  # seconds a call waits for an idle worker before giving up
+
+
+@dataclass
+class ExpressionPoolStats:
+    """Updated under the pool's lock, since several tool threads call the pool at once."""
+    calls: int = 0
+    timeouts: int = 0
+    crashes: int = 0
+    latency_total: float = 0.0
+    latency_max: float = 0.0
+
+    def by_outcome(self) -> dict[tuple[str, ...], float]:
+        return {
+            ("ok",): self.calls - self.timeouts - self.crashes,
+            ("timeout",): self.timeouts,
+            ("crash",): self.crashes,
+        }
+
+
+class ExpressionWorker:
+    """One worker process and the parent end of its pipe."""
+
+    def __init__(self, ctx: typing.Any, cpu_seconds: int, memory_bytes: int | None):
+        self.conn, child_conn = ctx.Pipe()
+        import expression_worker  # noqa: PLC0415 - loads simpleeval and NumPy, only needed once a worker starts
+
+        self.process = ctx.Process(
+            target=expression_worker.serve,
+            args=(child_conn, cpu_seconds, memory_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+
+class ExpressionWorkerPool:
+    """Pre-started worker processes that evaluate expressions with CPU, memory and time limits.
+
+    A worker that times out or dies is killed and replaced, so one runaway expression
+    can't stall the server. Calls wait at most wait_timeout for an idle worker, then
+    start one if the pool is short (a respawn failed) or raise ToolOverloaded.
+    """
+
+    def __init__(
+        self,
+        size: int = EXPRESSION_POOL_SIZE,
+        timeout: float = EXPRESSION_TIMEOUT,
+        cpu_seconds: int = EXPRESSION_CPU_SECONDS,
+        memory_bytes: int | None = EXPRESSION_MEMORY_BYTES,
+        wait_timeout: float = EXPRESSION_WAIT_TIMEOUT,
+    ):
+        self.size = size
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.stats = ExpressionPoolStats()
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: queue.Queue[ExpressionWorker] = queue.Queue()
+        self._workers: set[ExpressionWorker] = set()
+        self._lock = threading.Lock()
+        self._spawning = 0
+        self._started = False
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.size):
+            worker = self._spawn()
+            if worker is not None:
+                self._idle.put(worker)
+
+    def _spawn(self) -> ExpressionWorker | None:
+        """Start a worker, or return None if the pool already has (or is starting) size workers."""
+        with self._lock:
+            if len(self._workers) + self._spawning >= self.size:
+                return None
+            self._spawning += 1
+        try:
+            worker = ExpressionWorker(self._ctx, self.cpu_seconds, self.memory_bytes)
+        except BaseException:
+            with self._lock:
+                self._spawning -= 1
+            raise
+        with self._lock:
+            self._spawning -= 1
+            self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker: ExpressionWorker) -> None:
+        worker.kill()
+        with self._lock:
+            self._workers.discard(worker)
+        replacement = self._spawn()
+        if replacement is not None:
+            self._idle.put(replacement)
+
+    def _acquire(self) -> ExpressionWorker:
+        try:
+            return self._idle.get(timeout=self.wait_timeout)
+        except queue.Empty:
+            pass
+        # Nothing came free: make up for a worker that failed to respawn, or give up
+        worker = self._spawn()
+        if worker is None:
+            raise ToolOverloaded("The expression evaluator is busy right now. Try again later.")
+        return worker
+
+    def _call(self, request: tuple[typing.Any, ...]) -> typing.Any:
+        """Send a request to an idle worker. Blocks the calling thread, not the event loop."""
+        self.start()
+        expression = request[1]
+        start = time.perf_counter()
+        worker = self._acquire()
+        try:
+            worker.conn.send(request)
+            if worker.conn.poll(self.timeout):
+                result = worker.conn.recv()
+                self._idle.put(worker)
+            else:
+                with self._lock:
+                    self.stats.timeouts += 1
+                logger.warning(f"Expression timed out after {self.timeout}s, replacing worker: {expression[:100]!r}")
+                self._replace(worker)
+                result = f"Error evaluating expression: timed out after {self.timeout} seconds"
+        except (EOFError, OSError):
+            # The worker died, most likely from hitting its CPU or memory limit
+            with self._lock:
+                self.stats.crashes += 1
+            logger.warning(f"Expression worker died, replacing it: {expression[:100]!r}")
+            self._replace(worker)
+            result = "Error evaluating expression: resource limit exceeded"
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats.calls += 1
+            self.stats.latency_total += elapsed
+            self.stats.latency_max = max(self.stats.latency_max, elapsed)
+        return result
+
+    def evaluate(self, expression: str) -> str:
+        return self._call(("eval", expression))
+
+    def evaluate_batch(self, expression: str, rows: list[dict[str, typing.Any]]) -> list[str] | str:
+        """Results per row, or an error string if the whole batch failed."""
+        return self._call(("batch", expression, rows))
+
+    def close(self) -> None:
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+            self._started = False
+        for worker in workers:
+            worker.kill()
+        self._idle = queue.Queue()
+
+
+expression_pool = ExpressionWorkerPool()
 
 
 def evaluate_expression(expression: str) -> str:
@@ -180,18 +1414,75 @@ def evaluate_expression(expression: str) -> str:
     - "int(3.7)" returns 3
     - "1 / 0" returns inf (infinity)
     """
-    try:
-        result = simple_eval(expression)
-        return str(result)
-    except ZeroDivisionError:
-        return str(float("inf"))
-    except Exception as e:
-        return f"Error evaluating expression: {str(e)}"
+    return expression_pool.evaluate(expression)
+
+
+_RANDOM_CALL = re.compile(r"\brand(?:int)?\s*\(")
+
+
+def is_deterministic_expression(args: dict[str, typing.Any]) -> bool:
+    """False for expressions that call rand() or randint(), whose results must not be reused."""
+    return not _RANDOM_CALL.search(str(args.get("expression", "")))
 
 
+def is_expression_result(result: typing.Any) -> bool:
+    """False for "Error evaluating expression: ..." results, which may be transient (timeouts, crashes)."""
+    return not (isinstance(result, str) and result.startswith("Error evaluating expression:"))
+
+
+# Evaluation blocks a thread while a worker process computes, so give the expression
+# tools their own threads, one per worker, instead of tying up the shared pool.
+expression_tool_executor = ToolExecutor("threads", max_workers=EXPRESSION_POOL_SIZE, name="expression-tools")
+
 toolset.add_function(
     evaluate_expression,
     requires_approval=False,
+    cache=ToolResultCache(
+        maxsize=1024, should_cache_args=is_deterministic_expression, should_cache_result=is_expression_result
+    ),
+    execution=ToolExecution(expression_tool_executor, max_backlog=32),
+    pure=True,
+)
+
+BATCH_MAX_ROWS = 10_000
+# Larger batches are evaluated in chunks of this many rows, reporting progress after each
+BATCH_PROGRESS_ROWS = 2_000
+
+
+def evaluate_expression_batch(expression: str, rows: list[dict[str, int | float | str]]) -> str:
+    """Evaluate one expression over many sets of variable values in a single call.
+
+    Use this instead of calling evaluate_expression repeatedly when the same formula is
+    needed for several inputs. Variables in the expression are looked up in each row.
+    Supports the same operators and functions as evaluate_expression.
+
+    Args:
+        expression: The expression to evaluate, e.g. "price * qty * (1 + tax)"
+        rows: One object of variable values per evaluation, e.g. [{"price": 2.5, "qty": 4, "tax": 0.2}]
+
+    Returns a JSON list with one result per row, in order.
+    """
+    if len(rows) > BATCH_MAX_ROWS:
+        return f"Error evaluating expression: at most {BATCH_MAX_ROWS} rows per call"
+    results: list[str] = []
+    for start in range(0, len(rows), BATCH_PROGRESS_ROWS):
+        chunk = expression_pool.evaluate_batch(expression, rows[start:start + BATCH_PROGRESS_ROWS])
+        if isinstance(chunk, str):
+            return chunk
+        results.extend(chunk)
+        if len(rows) > BATCH_PROGRESS_ROWS:
+            report_progress(len(results) / len(rows), f"Evaluated {len(results)} of {len(rows)} rows")
+    return json.dumps(results)
+
+
+toolset.add_function(
+    evaluate_expression_batch,
+    requires_approval=False,
+    cache=ToolResultCache(
+        maxsize=64, should_cache_args=is_deterministic_expression, should_cache_result=is_expression_result
+    ),
+    execution=ToolExecution(expression_tool_executor, max_concurrency=1, max_backlog=8),
+    pure=True,
 )
 
 
@@ -207,14 +1498,15 @@ def dangerous_tool(text: str) -> str:
 toolset.add_function(
     dangerous_tool,
     requires_approval=True,
+    cache=ToolResultCache(),
+    execution=ToolExecution(inline_tool_executor),
 )
 
 
 # --- Meme generator tool ---
 
 IMPACT_FONT = "/System/Library/Fonts/Supplemental/Impact.ttf"
-MEME_DIR = Path(__file__).parent / "generated_memes"
-MEME_DIR.mkdir(exist_ok=True)
+MEME_DIR = Path(__file__).parent / "generated_memes"  # created by lifespan
 
 # Store generated meme filenames for serving
 generated_memes: dict[str, Path] = {}
@@ -237,39 +1529,177 @@ def _draw_meme_text(draw: ImageDraw.ImageDraw, text: str, y: int, width: int, fo
 DOGE_TEMPLATE = Path(__file__).parent / "meme_templates" / "doge.jpg"
 
 
-def make_meme(top_text: str, bottom_text: str) -> str:
-    """Generate a doge meme image with Impact font.
+# How long serve_meme waits for a meme that is still rendering before answering 202
+MEME_WAIT_SECONDS = 2.0
 
-    Creates a classic doge meme with white-on-black outlined text in Impact font.
 
-    Args:
-        top_text: Text for the top of the meme (will be uppercased)
-        bottom_text: Text for the bottom of the meme (will be uppercased)
+def render_meme(meme_id: str, top_text: str, bottom_text: str, progress: ProgressCallback | None = None) -> Path:
+    """Render a doge meme to MEME_DIR and register it for serving."""
+    report = progress or (lambda _fraction, _message=None: None)
+    start = time.perf_counter()
+    from PIL import Image, ImageDraw, ImageFont  # noqa: PLC0415 - Pillow is only loaded once a meme is drawn
 
-    Returns a URL to the generated image.
-    """
     img = Image.open(DOGE_TEMPLATE).copy()
     width, height = img.size
     draw = ImageDraw.Draw(img)
 
     font = ImageFont.truetype(IMPACT_FONT, width // 12)
+    report(0.2, "Drawing top text")
 
     _draw_meme_text(draw, top_text, 20, width, font)
+    report(0.5, "Drawing bottom text")
     _draw_meme_text(draw, bottom_text, height - 80, width, font)
+    report(0.8, "Saving image")
 
-    meme_id = str(uuid4())[:8]
     filename = f"meme_{meme_id}.png"
     filepath = MEME_DIR / filename
+    MEME_DIR.mkdir(exist_ok=True)  # also rendered outside the app, by benchmarks and tests
     img.save(filepath)
     generated_memes[meme_id] = filepath
-
-    return json.dumps({"url": f"/memes/{meme_id}", "meme_id": meme_id})
+    meme_render_time.observe(time.perf_counter() - start)
+    return filepath
 
 
-toolset.add_function(
-    make_meme,
-    requires_approval=False,
+# Rendering is CPU heavy; a dedicated pool keeps it from starving other tools
+meme_runner = ToolRunner(
+    "make_meme",
+    ToolExecution(ToolExecutor("threads", max_workers=2, name="meme-tools"), max_backlog=16),
 )
+# A cached result hands out the same job id again, so it mustn't outlive the job
+meme_cache = ToolResultCache(ttl=JOB_RETENTION)
+
+
+async def make_meme(top_text: str, bottom_text: str) -> str:
+    """Generate a doge meme image with Impact font.
+
+    Creates a classic doge meme with white-on-black outlined text in Impact font.
+
+    Args:
+        top_text: Text for the top of the meme (will be uppercased)
+        bottom_text: Text for the bottom of the meme (will be uppercased)
+
+    Returns a URL to the generated image. The image is rendered in the background,
+    so the URL may take a moment to become available.
+    """
+    meme_id = str(uuid4())[:8]
+    job = jobs.submit(
+        "make_meme", render_meme, meme_id, top_text, bottom_text,
+        runner=meme_runner, job_id=f"meme-{meme_id}",
+    )
+
+    def forget_failed(_task: asyncio.Task[typing.Any]) -> None:
+        # Don't keep handing out the URL of a meme that was never rendered
+        if job.status == "failed":
+            meme_cache.invalidate({"top_text": top_text, "bottom_text": bottom_text})
+
+    assert job.task is not None
+    job.task.add_done_callback(forget_failed)
+    return json.dumps({"url": f"/memes/{meme_id}", "meme_id": meme_id, "job_id": job.id})
+
+
+toolset.add_function(make_meme, requires_approval=False, cache=meme_cache)
+
+
+# --- Tool selection ---
+
+# Send only the top-k most relevant tools each turn (plus tools already used in the
+# thread). None sends every enabled tool.
+TOOL_SELECTION_TOP_K: int | None = None
+
+_STOP_WORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "i", "in", "is", "it",
+    "me", "of", "on", "or", "please", "the", "this", "to", "what", "with", "you",
+})
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokens; snake_case names are split into words."""
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in _STOP_WORDS]
+
+
+class ToolSelector:
+    """BM25 index over tool names and descriptions, built once when the server starts."""
+
+    def __init__(self, tools: typing.Mapping[str, typing.Any], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs: dict[str, dict[str, int]] = {}
+        self.lengths: dict[str, int] = {}
+        doc_freq: dict[str, int] = {}
+        for name, tool in tools.items():
+            # Weight the name twice, it's the strongest signal
+            terms = tokenize(name) * 2 + tokenize(tool.description or "")
+            counts: dict[str, int] = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            self.docs[name] = counts
+            self.lengths[name] = len(terms)
+            for term in counts:
+                doc_freq[term] = doc_freq.get(term, 0) + 1
+        n = len(self.docs)
+        self.avg_length = sum(self.lengths.values()) / n if n else 0.0
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()
+        }
+
+    def score(self, query: str) -> dict[str, float]:
+        terms = set(tokenize(query))
+        scores: dict[str, float] = {}
+        for name, counts in self.docs.items():
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[name] / (self.avg_length or 1))
+            total = 0.0
+            for term in terms:
+                tf = counts.get(term)
+                if tf:
+                    total += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores[name] = total
+        return scores
+
+    def select(self, query: str, top_k: int, always: typing.Iterable[str] = ()) -> set[str] | None:
+        """Names of the top_k tools for query plus `always`, or None if nothing matched."""
+        ranked = sorted(
+            ((score, name) for name, score in self.score(query).items() if score > 0),
+            reverse=True,
+        )
+        if not ranked:
+            return None
+        return {name for _, name in ranked[:top_k]} | set(always)
+
+
+tool_selector = ToolSelector(toolset.tools)
+
+
+def tools_used_in_thread(messages: typing.Iterable[typing.Any]) -> set[str]:
+    """Names of tools the assistant has called so far in the thread."""
+    return {
+        call.function.name
+        for msg in messages
+        if msg.role == "assistant"
+        for call in getattr(msg, "tool_calls", None) or []
+    }
+
+
+def typed_text(msg: typing.Any) -> str:
+    """What the user typed in a message, without text attachments inlined by process_attachments."""
+    if isinstance(msg.content, str):
+        return msg.content
+    if isinstance(msg.content, list):
+        return "\n".join(
+            c.text for c in msg.content
+            if isinstance(c, TextInputContent) and not c.text.startswith("<file-attachment ")
+        )
+    return ""
+
+
+def select_tools(run_input: RunAgentInput, top_k: int) -> set[str] | None:
+    """Tools relevant to the latest user prompt, or None to send all of them.
+
+    Attached files are left out of the query: their words would outweigh the prompt's.
+    """
+    query = next(
+        (typed_text(m) for m in reversed(run_input.messages) if m.role == "user"), ""
+    )
+    return tool_selector.select(query, top_k, always=tools_used_in_thread(run_input.messages))
 
 
 #model = BedrockConverseModel(
@@ -293,10 +1723,488 @@ toolset.add_function(
 #    deps_type=StateDeps[Dependencies],
 #)
 
-def create_agent() -> Agent[StateDeps[Dependencies]]:
+# Backends the router may use, in order of preference. Hedged requests go to the
+# second backend when one is configured, otherwise to the first one again.
+MODEL_BACKENDS: list[Model | str] = ["google-gla:gemini-3.1-pro-preview"]
+# Optional faster model for cheap turns such as the manual-tool summary.
+FAST_MODEL: Model | str | None = None
+
+HEDGE_PERCENTILE = 0.95
+HEDGE_DEFAULT_DELAY = 3.0  # seconds, used until enough samples have been recorded
+HEDGE_MIN_DELAY = 0.25
+HEDGE_MIN_SAMPLES = 5
+
+
+async def stream_model_deltas(
+    model: Model,
+    messages: list[ModelMessage],
+    info: AgentInfo,
+) -> typing.AsyncIterator[str | dict[int, DeltaToolCall]]:
+    """Stream a model response translated into FunctionModel deltas (text and tool calls)."""
+    async with model.request_stream(
+        messages, info.model_settings, info.model_request_parameters
+    ) as response:
+        async for event in response:
+            if isinstance(event, PartStartEvent):
+                part = event.part
+                if isinstance(part, TextPart):
+                    if part.content:
+                        yield part.content
+                elif isinstance(part, ToolCallPart):
+                    yield {event.index: DeltaToolCall(
+                        name=part.tool_name,
+                        json_args=part.args_as_json_str() if part.args else None,
+                        tool_call_id=part.tool_call_id,
+                    )}
+            elif isinstance(event, PartDeltaEvent):
+                delta = event.delta
+                if isinstance(delta, TextPartDelta):
+                    if delta.content_delta:
+                        yield delta.content_delta
+                elif isinstance(delta, ToolCallPartDelta):
+                    args = delta.args_delta
+                    yield {event.index: DeltaToolCall(
+                        name=delta.tool_name_delta,
+                        json_args=args if args is None or isinstance(args, str) else json.dumps(args),
+                        tool_call_id=delta.tool_call_id,
+                    )}
+
+
+@dataclass
+class LatencyTracker:
+    """Rolling window of time-to-first-token samples (seconds) for one backend."""
+    samples: deque[float] = field(default_factory=lambda: deque(maxlen=200))
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """Nearest-rank percentile, e.g. the 19th of 20 samples for q=0.95."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[max(0, min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1))]
+
+
+# Global dictionary: backend model name -> time-to-first-token samples, shared by all sessions
+model_latency: dict[str, LatencyTracker] = {}
+
+
+class ModelRouter:
+    """Routes model requests across several backends.
+
+    If the first backend hasn't produced a token within the p95 time-to-first-token
+    deadline, a hedged request is sent to the next backend and whichever answers first
+    wins; the loser is cancelled. Cheap turns go to the fast model when one is configured.
+    """
+
+    def __init__(
+        self,
+        backends: typing.Sequence[Model | str],
+        fast_model: Model | str | None = None,
+        hedge_percentile: float = HEDGE_PERCENTILE,
+        default_hedge_delay: float = HEDGE_DEFAULT_DELAY,
+    ):
+        if not backends:
+            raise ValueError("ModelRouter needs at least one backend")
+        self.backends = [infer_model(b) for b in backends]
+        self.fast_model = infer_model(fast_model) if fast_model is not None else None
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+
+    @staticmethod
+    def _tracker(model: Model) -> LatencyTracker:
+        return model_latency.setdefault(model.model_name, LatencyTracker())
+
+    def hedge_delay(self, model: Model) -> float:
+        """Seconds to wait for the first token from model before hedging."""
+        tracker = self._tracker(model)
+        if len(tracker.samples) < HEDGE_MIN_SAMPLES:
+            return self.default_hedge_delay
+        p = tracker.percentile(self.hedge_percentile)
+        return max(HEDGE_MIN_DELAY, p if p is not None else self.default_hedge_delay)
+
+    def candidates(self, cheap: bool = False) -> list[Model]:
+        """Primary model followed by the model used for the hedged request."""
+        primary = self.fast_model if cheap and self.fast_model else self.backends[0]
+        hedge = self.backends[1] if len(self.backends) > 1 and primary is self.backends[0] else self.backends[0]
+        return [primary, hedge]
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+        run_context: RunContext[typing.Any] | None = None,
+        cheap: bool = False,
+    ) -> typing.AsyncIterator[StreamedResponse]:
+        """Open the stream of the first candidate to produce a token and yield it as is.
+
+        Backends only return from request_stream once their first chunk has arrived, so
+        that's the race. Each attempt runs in its own task, which keeps the backend's
+        stream open until the caller is done with the winner.
+        """
+        primary, hedge = self.candidates(cheap)
+        started: asyncio.Queue[tuple[int, StreamedResponse | Exception]] = asyncio.Queue()
+        done = asyncio.Event()
+        attempts: list[asyncio.Task[None]] = []
+
+        async def attempt(idx: int, model: Model) -> None:
+            start = time.perf_counter()
+            first_token = False
+            try:
+                async with model.request_stream(
+                    list(messages), model_settings, model_request_parameters, run_context
+                ) as response:
+                    first_token = True
+                    self._tracker(model).record(time.perf_counter() - start)
+                    started.put_nowait((idx, response))
+                    await done.wait()
+            except Exception as e:  # noqa: BLE001 - any backend error is a reason to fail over
+                if not first_token:
+                    started.put_nowait((idx, e))
+            finally:
+                if not first_token:
+                    # Failed and cancelled attempts took at least this long; leaving the slow
+                    # ones out would bias the percentile low
+                    self._tracker(model).record(time.perf_counter() - start)
+
+        def launch(model: Model) -> None:
+            attempts.append(asyncio.create_task(attempt(len(attempts), model)))
+
+        launch(primary)
+        winner: int | None = None
+        failed = 0
+        try:
+            while winner is None:
+                timeout = self.hedge_delay(primary) if len(attempts) == 1 else None
+                try:
+                    idx, item = await asyncio.wait_for(started.get(), timeout)
+                except TimeoutError:
+                    logger.info(f"No first token from {primary.model_name} after {timeout:.2f}s, hedging to {hedge.model_name}")
+                    launch(hedge)
+                    continue
+                if isinstance(item, Exception):
+                    failed += 1
+                    logger.warning(f"Model attempt {idx} failed before first token: {item}")
+                    if len(attempts) == 1:
+                        launch(hedge)
+                    elif failed == len(attempts):
+                        raise item
+                    continue
+                winner = idx
+                for i, task in enumerate(attempts):
+                    if i != winner:
+                        task.cancel()
+                yield item
+        finally:
+            done.set()
+            for i, task in enumerate(attempts):
+                if i != winner:
+                    task.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+        cheap: bool = False,
+    ) -> ModelResponse:
+        """Non-streamed variant of stream(): the first complete response wins."""
+        primary, hedge = self.candidates(cheap)
+        attempts: list[asyncio.Task[ModelResponse]] = []
+
+        async def attempt(model: Model) -> ModelResponse:
+            start = time.perf_counter()
+            try:
+                return await model.request(list(messages), model_settings, model_request_parameters)
+            finally:
+                # Failed and cancelled attempts count too, see stream()
+                self._tracker(model).record(time.perf_counter() - start)
+
+        attempts.append(asyncio.create_task(attempt(primary)))
+        pending: set[asyncio.Task[ModelResponse]] = set(attempts)
+        last_error: BaseException | None = None
+        try:
+            timeout: float | None = self.hedge_delay(primary)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                timeout = None
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+                    last_error = error
+                    logger.warning(f"Model request failed: {error}")
+                if len(attempts) == 1:
+                    if not done:
+                        logger.info(f"No response from {primary.model_name}, hedging to {hedge.model_name}")
+                    attempts.append(asyncio.create_task(attempt(hedge)))
+                    pending.add(attempts[-1])
+            assert last_error is not None
+            raise last_error
+        finally:
+            for task in attempts:
+                task.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+
+    def as_model(self, cheap: bool = False) -> RoutedModel:
+        """The router as a Model an Agent can use."""
+        return RoutedModel(self, cheap=cheap)
+
+
+class RoutedModel(WrapperModel):
+    """Model that sends every request through a ModelRouter.
+
+    Responses are the winning backend's own, not re-synthesized, so thinking parts,
+    provider details (e.g. Gemini thought signatures) and real token usage survive.
+    Everything else, such as the profile, comes from the primary backend.
+    """
+
+    def __init__(self, router: ModelRouter, cheap: bool = False):
+        super().__init__(router.candidates(cheap)[0])
+        self.router = router
+        self.cheap = cheap
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+    ) -> ModelResponse:
+        return await self.router.request(messages, model_settings, model_request_parameters, cheap=self.cheap)
+
+    @asynccontextmanager
+    async def request_stream(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+        run_context: RunContext[typing.Any] | None = None,
+    ) -> typing.AsyncIterator[StreamedResponse]:
+        async with self.router.stream(
+            messages, model_settings, model_request_parameters, run_context, cheap=self.cheap
+        ) as response:
+            yield response
+
+    @property
+    def model_name(self) -> str:
+        return f"router:{self.wrapped.model_name}"
+
+
+# --- Model record/replay ---
+
+# Set AGUI_RECORD_FILE to append every backend's streamed responses (deltas and their
+# timing) to a JSONL file; set AGUI_REPLAY_FILE to serve such a recording instead of
+# the real backends, e.g. for offline e2e tests and benchmarks.
+RECORD_FILE = os.environ.get("AGUI_RECORD_FILE")
+REPLAY_FILE = os.environ.get("AGUI_REPLAY_FILE")
+# Multiplier for the recorded gaps between chunks on replay: 1.0 replays with the
+# original timing, smaller values compress it, 0 replays instantly.
+REPLAY_TIME_SCALE = float(os.environ.get("AGUI_REPLAY_TIME_SCALE", "1.0"))
+
+type ModelDelta = str | dict[int, DeltaToolCall]
+
+
+def recording_key(messages: list[ModelMessage]) -> tuple[str, int]:
+    """The latest user prompt and how many model responses followed it in this run."""
+    steps = 0
+    for message in reversed(messages):
+        if isinstance(message, ModelResponse):
+            steps += 1
+            continue
+        for part in message.parts:
+            if isinstance(part, UserPromptPart):
+                if isinstance(part.content, str):
+                    return part.content, steps
+                return " ".join(c for c in part.content if isinstance(c, str)), steps
+    return "", steps
+
+
+@dataclass
+class ModelRecording:
+    """One recorded model response: (seconds since the request, delta) pairs."""
+    model: str
+    prompt: str
+    step: int
+    chunks: list[tuple[float, ModelDelta]]
+
+    def to_json(self) -> str:
+        def encode(delta: ModelDelta) -> typing.Any:
+            if isinstance(delta, str):
+                return delta
+            return {
+                str(index): {"name": call.name, "json_args": call.json_args, "tool_call_id": call.tool_call_id}
+                for index, call in delta.items()
+            }
+
+        return json.dumps({
+            "model": self.model,
+            "prompt": self.prompt,
+            "step": self.step,
+            "chunks": [[round(offset, 4), encode(delta)] for offset, delta in self.chunks],
+        })
+
+    @classmethod
+    def from_json(cls, line: str) -> ModelRecording:
+        data = json.loads(line)
+        return cls(
+            model=data["model"],
+            prompt=data["prompt"],
+            step=data["step"],
+            chunks=[(offset, delta) for offset, delta in data["chunks"]],
+        )
+
+    def deltas(self) -> typing.Iterator[tuple[float, ModelDelta]]:
+        """Fresh delta objects, since the model's parts manager keeps the ones it's given."""
+        for offset, delta in self.chunks:
+            if isinstance(delta, dict):
+                delta = {
+                    int(index): DeltaToolCall(**call)
+                    for index, call in delta.items()
+                }
+            yield offset, delta
+
+    def response(self) -> ModelResponse:
+        """The complete response the recorded deltas add up to."""
+        text: list[str] = []
+        calls: dict[int, dict[str, typing.Any]] = {}
+        for _, delta in self.deltas():
+            if isinstance(delta, str):
+                text.append(delta)
+                continue
+            for index, call in delta.items():
+                merged = calls.setdefault(index, {"name": "", "args": "", "id": None})
+                merged["name"] += call.name or ""
+                merged["args"] += call.json_args or ""
+                merged["id"] = merged["id"] or call.tool_call_id
+        parts: list[typing.Any] = [TextPart("".join(text))] if text else []
+        for call in calls.values():
+            tool_call_id = call["id"] or str(uuid4())
+            parts.append(ToolCallPart(call["name"], call["args"] or None, tool_call_id=tool_call_id))
+        return ModelResponse(parts=parts, model_name=self.model)
+
+
+def response_deltas(response: ModelResponse) -> list[ModelDelta]:
+    """A non-streamed response as the deltas that would have streamed it."""
+    deltas: list[ModelDelta] = []
+    for index, part in enumerate(response.parts):
+        if isinstance(part, TextPart) and part.content:
+            deltas.append(part.content)
+        elif isinstance(part, ToolCallPart):
+            deltas.append({index: DeltaToolCall(
+                name=part.tool_name,
+                json_args=part.args_as_json_str() if part.args else None,
+                tool_call_id=part.tool_call_id,
+            )})
+    return deltas
+
+
+class ModelRecorder:
+    """Wraps a real model and appends each of its responses to a JSONL recording."""
+
+    def __init__(self, model: Model | str, path: str | Path):
+        self.model = infer_model(model)
+        self.path = Path(path)
+
+    def save(self, messages: list[ModelMessage], chunks: list[tuple[float, ModelDelta]]) -> None:
+        prompt, step = recording_key(messages)
+        recording = ModelRecording(self.model.model_name, prompt, step, chunks)
+        with self.path.open("a") as f:
+            f.write(recording.to_json() + "\n")
+
+    def as_model(self) -> FunctionModel:
+        async def record_fn(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+            start = time.perf_counter()
+            response = await self.model.request(messages, info.model_settings, info.model_request_parameters)
+            offset = time.perf_counter() - start
+            self.save(messages, [(offset, delta) for delta in response_deltas(response)])
+            return response
+
+        async def record_stream_fn(
+            messages: list[ModelMessage], info: AgentInfo
+        ) -> typing.AsyncIterator[ModelDelta]:
+            start = time.perf_counter()
+            chunks: list[tuple[float, ModelDelta]] = []
+            async for delta in stream_model_deltas(self.model, messages, info):
+                chunks.append((time.perf_counter() - start, delta))
+                yield delta
+            # Interrupted streams aren't saved: replaying half a response would be misleading
+            self.save(messages, chunks)
+
+        return FunctionModel(record_fn, stream_function=record_stream_fn, model_name=self.model.model_name)
+
+
+class ModelReplayer:
+    """Serves recorded responses as a model.
+
+    A request gets the recording made for the same prompt and step of the run when
+    there is one, otherwise the recordings are handed out in order, round robin, so
+    load tests with arbitrary prompts still see realistic streams.
+    """
+
+    def __init__(self, recordings: list[ModelRecording], time_scale: float = REPLAY_TIME_SCALE):
+        if not recordings:
+            raise ValueError("ModelReplayer needs at least one recording")
+        self.recordings = recordings
+        self.time_scale = time_scale
+        self.by_key: dict[tuple[str, int], ModelRecording] = {}
+        for recording in recordings:
+            self.by_key.setdefault((recording.prompt, recording.step), recording)
+        self.next_index = 0
+
+    @classmethod
+    def load(cls, path: str | Path, time_scale: float = REPLAY_TIME_SCALE) -> ModelReplayer:
+        with Path(path).open() as f:
+            return cls([ModelRecording.from_json(line) for line in f if line.strip()], time_scale)
+
+    def pick(self, messages: list[ModelMessage]) -> ModelRecording:
+        recording = self.by_key.get(recording_key(messages))
+        if recording is None:
+            recording = self.recordings[self.next_index % len(self.recordings)]
+            self.next_index += 1
+        return recording
+
+    def as_model(self) -> FunctionModel:
+        async def replay_fn(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+            recording = self.pick(messages)
+            if recording.chunks and self.time_scale:
+                await asyncio.sleep(recording.chunks[-1][0] * self.time_scale)
+            return recording.response()
+
+        async def replay_stream_fn(
+            messages: list[ModelMessage], info: AgentInfo
+        ) -> typing.AsyncIterator[ModelDelta]:
+            previous = 0.0
+            for offset, delta in self.pick(messages).deltas():
+                delay = (offset - previous) * self.time_scale
+                previous = offset
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield delta
+
+        return FunctionModel(replay_fn, stream_function=replay_stream_fn, model_name="replay")
+
+
+if REPLAY_FILE:  # pragma: no cover
+    MODEL_BACKENDS[:] = [ModelReplayer.load(REPLAY_FILE).as_model()]
+    FAST_MODEL = None
+elif RECORD_FILE:  # pragma: no cover
+    MODEL_BACKENDS[:] = [ModelRecorder(backend, RECORD_FILE).as_model() for backend in MODEL_BACKENDS]
+    if FAST_MODEL is not None:
+        FAST_MODEL = ModelRecorder(FAST_MODEL, RECORD_FILE).as_model()
+
+
+def create_agent(router: ModelRouter | None = None) -> Agent[StateDeps[Dependencies]]:
     """Create a new agent instance for a session."""
-    model = "google-gla:gemini-3.1-pro-preview"
-    logger.info(f"Creating agent with model: {model}")
+    if router is None:
+        router = ModelRouter(MODEL_BACKENDS, fast_model=FAST_MODEL)
+    model = router.as_model()
+    logger.info(f"Creating agent with model: {model.model_name}")
     return Agent[StateDeps[Dependencies], typing.Any](
         model,
         system_prompt=AGENT_INSTRUCTIONS,
@@ -309,10 +2217,10 @@ def create_agent() -> Agent[StateDeps[Dependencies]]:
 def make_injector_stream_fn(
     tool_name: str,
     tool_args: str,
-    real_model: typing.Any,
+    real_model: Model,
 ) -> typing.Callable[..., typing.AsyncIterator[str | dict[int, DeltaToolCall]]]:
     """Create a stream function that injects a predetermined tool call on the first turn,
-    then delegates to the real model for the summary."""
+    then streams the summary from the real model."""
     call_count = 0
 
     async def injector_stream_fn(
@@ -334,12 +2242,15 @@ def make_injector_stream_fn(
                 tool_call_id=str(uuid4()),
             )}
         else:
-            response = await real_model.request(
-                messages, info.model_settings, info.model_request_parameters
-            )
-            for part in response.parts:
-                if hasattr(part, 'content'):
-                    yield part.content
+            # Stream the summary so text reaches the client as soon as the model produces it
+            start = time.perf_counter()
+            first_token_seen = False
+            async for delta in stream_model_deltas(real_model, messages, info):
+                if not first_token_seen:
+                    first_token_seen = True
+                    ttft_ms = (time.perf_counter() - start) * 1000
+                    logger.info(f"Manual {tool_name} summary time-to-first-token: {ttft_ms:.0f}ms")
+                yield delta
 
     return injector_stream_fn
 
@@ -350,21 +2261,305 @@ SignalHandler = Callable[[int, FrameType | None], object] | int | None
 sessions: dict[str, Session] = {}
 
 
+# --- Session pub/sub ---
+
+# Clients choose their own groups with /events?group=, so a group only routes
+# broadcasts: never send anything to a group that its members aren't all allowed to see.
+# EVENT_GROUPS limits the names clients may join (None allows any valid name).
+EVENT_GROUPS: frozenset[str] | None = None
+EVENT_GROUP_NAME = re.compile(r"[A-Za-z0-9_.:-]{1,64}")
+MAX_EVENT_GROUPS = 16  # groups one session may join
+
+
+def encode_sse(data: typing.Any) -> bytes:
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+class EventBroker:
+    """Pushes events to /events streams: to one session, a named group of sessions, or all.
+
+    Each event is encoded to its SSE frame once and the same bytes are queued for every
+    recipient, so a broadcast costs one json.dumps however many sessions are connected.
+    Must be called from the event loop (JobManager hops there for progress reports).
+    """
+
+    def __init__(self) -> None:
+        # group name -> session tokens, and the reverse so leaving costs O(own groups)
+        self.groups: dict[str, set[str]] = {}
+        self.memberships: dict[str, set[str]] = {}
+        # Frames encoded and their total size, to estimate what a session's queue holds
+        self.frames = 0
+        self.frame_bytes = 0
+
+    def join(self, token: str, group: str) -> None:
+        self.groups.setdefault(group, set()).add(token)
+        self.memberships.setdefault(token, set()).add(group)
+
+    def leave(self, token: str, group: str | None = None) -> None:
+        """Take token out of group, or out of every group it joined."""
+        if group is None:
+            names = self.memberships.pop(token, set())
+        else:
+            names = {group}
+            joined = self.memberships.get(token)
+            if joined is not None:
+                joined.discard(group)
+                if not joined:
+                    del self.memberships[token]
+        for name in names:
+            members = self.groups.get(name)
+            if members is not None:
+                members.discard(token)
+                if not members:
+                    del self.groups[name]
+
+    def queued_bytes(self, session: Session) -> int:
+        """Estimated bytes waiting in a session's queue, from the average frame size."""
+        return session.queue.qsize() * self.frame_bytes // self.frames if self.frames else 0
+
+    def send(self, token: str, event: typing.Any) -> int:
+        """Queue event for one session; returns how many sessions it was queued for."""
+        return self._deliver([token], event, "session")
+
+    def publish(self, group: str, event: typing.Any) -> int:
+        return self._deliver(list(self.groups.get(group, ())), event, "group")
+
+    def broadcast(self, event: typing.Any) -> int:
+        return self._deliver(list(sessions), event, "all")
+
+    def _deliver(self, tokens: list[str], event: typing.Any, target: str) -> int:
+        frame = None
+        delivered = 0
+        for token in tokens:
+            session = sessions.get(token)
+            if session is None:
+                continue
+            if frame is None:
+                frame = encode_sse(event)
+                self.frames += 1
+                self.frame_bytes += len(frame)
+            try:
+                session.queue.put_nowait(frame)
+                delivered += 1
+            except asyncio.QueueFull:
+                events_dropped.inc()
+        events_published.inc(delivered, target=target)
+        return delivered
+
+
+broker = EventBroker()
+
+
+def notify_sessions(
+    message: str,
+    level: typing.Literal["info", "warning"] = "info",
+    token: str | None = None,
+    group: str | None = None,
+) -> int:
+    """Show a server notice to one session, a group, or (by default) everyone."""
+    event = CustomEvent(
+        name="server_notice", value={"message": message, "level": level}, timestamp=int(time.time() * 1000),
+    ).model_dump()
+    if token is not None:
+        return broker.send(token, event)
+    if group is not None:
+        return broker.publish(group, event)
+    return broker.broadcast(event)
+
+
+@functools.cache
+def available_tools() -> list[dict[str, typing.Any]]:
+    """The toolset as sent to clients, built once per toolset change."""
+    return [
+        {
+            "name": name,
+            "description": tool.description or "",
+            "a2ui": tool_schema_to_a2ui(name, tool),
+        }
+        for name, tool in toolset.tools.items()
+    ]
+
+
+def toolset_changed() -> None:
+    """Call after adding or removing tools at runtime: rebuilds what's derived from the
+    toolset and sends every connected client the new tool list."""
+    global tool_selector
+    tool_selector = ToolSelector(toolset.tools)
+    available_tools.cache_clear()
+    broker.broadcast(CustomEvent(
+        name="tools_changed", value={"available_tools": available_tools()}, timestamp=int(time.time() * 1000),
+    ).model_dump())
+
+
 async def ping_all_sessions():
     """Send a ping to all connected clients every minute."""
     while True:
         await asyncio.sleep(60)
-        ping_event = {"ping": True}
-        for session in sessions.values():
+        broker.broadcast({"ping": True})
+
+
+# --- Graceful drain ---
+
+# On SIGTERM/SIGINT the server stops accepting /events and /agent requests, lets running
+# /agent streams finish for up to DRAIN_TIMEOUT seconds, and closes each /events stream
+# with a reconnect event. A second signal, or AGUI_DRAIN_TIMEOUT=0, shuts down at once.
+DRAIN_TIMEOUT = float(os.environ.get("AGUI_DRAIN_TIMEOUT", "30"))
+# Seconds clients should wait before reconnecting, sent with reconnect events and 503s
+DRAIN_RETRY_AFTER = int(os.environ.get("AGUI_DRAIN_RETRY_AFTER", "2"))
+# Directory shared with the replacement process: each drained session's history summaries
+# and paused run are saved there, and /events?resume=<old token> picks them up
+HANDOFF_DIR = os.environ.get("AGUI_HANDOFF_DIR")
+HANDOFF_TTL = 600.0  # seconds a handed-off session can be resumed
+
+
+def save_handoff(token: str, session: Session, directory: str) -> None:
+    paused = session.paused_run
+    entry = {
+        "saved": time.time(),
+        "history_summaries": session.history_summaries,
+        "paused_run": paused and {
+            "thread_id": paused.thread_id,
+            "messages": ModelMessagesTypeAdapter.dump_python(paused.messages, mode="json"),
+            "pending": sorted(paused.pending),
+            "age": time.monotonic() - paused.created,
+        },
+    }
+    path = Path(directory) / f"{token}.json"
+    # Written whole or not at all: the replacement process may be reading already
+    temp = path.with_suffix(".tmp")
+    temp.write_text(json.dumps(entry))
+    temp.replace(path)
+
+
+def take_handoff(token: str, directory: str) -> dict[str, typing.Any] | None:
+    """Load and remove a handed-off session; None if there is none, it's too old or it's unreadable."""
+    try:
+        path = Path(directory) / f"{UUID(token)}.json"
+    except ValueError:
+        return None
+    try:
+        entry = json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        # e.g. the old process died while writing it
+        logger.warning(f"[{token[:8]}] Ignoring corrupt session handoff {path.name}")
+        path.unlink(missing_ok=True)
+        return None
+    path.unlink()
+    return entry if time.time() - entry["saved"] <= HANDOFF_TTL else None
+
+
+def restore_handoff(session: Session, entry: dict[str, typing.Any]) -> None:
+    session.history_summaries = entry["history_summaries"]
+    paused = entry["paused_run"]
+    if paused is not None:
+        session.paused_run = PausedRun(
+            thread_id=paused["thread_id"],
+            messages=ModelMessagesTypeAdapter.validate_python(paused["messages"]),
+            pending=set(paused["pending"]),
+            # The TTL keeps counting across the handoff
+            created=time.monotonic() - paused["age"] - (time.time() - entry["saved"]),
+        )
+
+
+def prune_handoffs(directory: str) -> None:
+    """Remove handoffs nobody resumed in time."""
+    for path in Path(directory).glob("*.json"):
+        try:
+            if time.time() - path.stat().st_mtime > HANDOFF_TTL:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class Drainer:
+    """Shutdown state: whether the server is draining, and the /agent runs still streaming."""
+
+    def __init__(self, timeout: float = DRAIN_TIMEOUT, retry_after: int = DRAIN_RETRY_AFTER):
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.draining = False
+        # streaming /agent run -> its session token
+        self.runs: dict[asyncio.Task[typing.Any], str] = {}
+        self.released: set[str] = set()
+        # The drain started by a shutdown signal; referenced so it isn't garbage collected
+        self.task: asyncio.Task[None] | None = None
+
+    def check_accepting(self) -> None:
+        """Turn away new requests while draining, so clients retry against another process."""
+        if self.draining:
+            raise HTTPException(
+                status_code=503,
+                detail="Server is restarting",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    def run_started(self, token: str) -> None:
+        task = asyncio.current_task()
+        if task is not None:
+            self.runs[task] = token
+
+    def run_finished(self, token: str) -> None:
+        task = asyncio.current_task()
+        if task is not None:
+            self.runs.pop(task, None)
+        session = sessions.get(token)
+        if self.draining and session is not None and token not in self.runs.values():
+            self.release(token, session)
+
+    def release(self, token: str, session: Session) -> None:
+        """Hand the session off and tell its client to reconnect."""
+        if token in self.released:
+            return
+        self.released.add(token)
+        if HANDOFF_DIR:
             try:
-                session.queue.put_nowait(ping_event)
-            except asyncio.QueueFull:
-                pass
+                save_handoff(token, session, HANDOFF_DIR)
+            except OSError:
+                logger.exception(f"[{token[:8]}] Couldn't hand off session")
+        try:
+            session.queue.put_nowait({"reconnect": {"retry_after": self.retry_after, "resume": token}})
+        except asyncio.QueueFull:
+            pass
+
+    async def drain(self) -> None:
+        """Release idle sessions now and busy ones as their runs finish, up to the timeout."""
+        self.draining = True
+        logger.info(f"Draining: {len(self.runs)} runs streaming, {len(sessions)} sessions")
+        if HANDOFF_DIR:
+            Path(HANDOFF_DIR).mkdir(parents=True, exist_ok=True)
+            prune_handoffs(HANDOFF_DIR)
+        notify_sessions("The server is restarting, replies in progress will finish first", level="warning")
+        busy = set(self.runs.values())
+        for token, session in list(sessions.items()):
+            if token not in busy:
+                self.release(token, session)
+
+        deadline = time.monotonic() + self.timeout
+        while self.runs and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.runs:
+            logger.warning(f"Drain timed out after {self.timeout}s, cancelling {len(self.runs)} runs")
+            runs = list(self.runs)
+            for task in runs:
+                task.cancel()
+            # Cancelled runs release their sessions on the way out
+            await asyncio.wait(runs, timeout=1.0)
+        for token, session in list(sessions.items()):
+            self.release(token, session)
+        logger.info(f"Drained: released {len(self.released)} sessions")
+
+
+drainer = Drainer()
 
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
-    # Install signal handlers to gracefully close SSE before uvicorn shuts down
+    global log_handler
+    log_handler, log_listener = configure_logging()
+
+    # Install signal handlers to drain runs and close SSE before uvicorn shuts down
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGTERM, signal.SIGINT):
         prev: SignalHandler = signal.getsignal(sig)
@@ -372,20 +2567,49 @@ async def lifespan(_app: FastAPI):
         def make_handler(
             s: signal.Signals, previous: SignalHandler
         ) -> Callable[[], None]:
-            def handler() -> None:
+            def shut_down() -> None:
                 for session in sessions.values():
                     session.queue.put_nowait({"die": True})
                 if callable(previous):
                     previous(s, None)
 
+            async def drain_then_shut_down() -> None:
+                try:
+                    await drainer.drain()
+                except Exception:
+                    logger.exception("Draining failed, shutting down now")
+                shut_down()
+
+            def handler() -> None:
+                if drainer.draining or drainer.timeout <= 0:
+                    # Second signal, or draining disabled: stop now
+                    shut_down()
+                else:
+                    drainer.task = loop.create_task(drain_then_shut_down())
+
             return handler
 
         loop.add_signal_handler(sig, make_handler(sig, prev))
 
+    MEME_DIR.mkdir(exist_ok=True)
+    # Pre-start the expression workers so the first evaluation doesn't pay for process
+    # startup, without holding up readiness; early evaluations wait for a worker
+    pool_warmup = threading.Thread(target=expression_pool.start, name="expression-pool-warmup", daemon=True)
+    pool_warmup.start()
+
     # Start ping task
     ping_task = asyncio.create_task(ping_all_sessions())
     yield
     ping_task.cancel()
+    jobs.cancel_all()
+    pool_warmup.join()
+    expression_pool.close()
+    for executor in list(tool_executors):
+        executor.shutdown()
+    # Write out whatever is still queued
+    logging.getLogger().removeHandler(log_handler)
+    log_listener.stop()
+    log_handler = None
 
 
 app = FastAPI(lifespan=lifespan)
@@ -393,13 +2617,481 @@ app = FastAPI(lifespan=lifespan)
 
 @app.get("/memes/{meme_id}")
 async def serve_meme(meme_id: str):
+    job = jobs.get(f"meme-{meme_id}")
+    if job is not None and not job.done:
+        await job.wait(MEME_WAIT_SECONDS)
+        if not job.done:
+            return JSONResponse(job.snapshot(), status_code=202, headers={"Retry-After": "1"})
     filepath = generated_memes.get(meme_id)
     if not filepath or not filepath.exists():
         raise HTTPException(status_code=404, detail="Meme not found")
     return FileResponse(filepath, media_type="image/png")
 
 
-def process_text_attachment(base64_data: str, filename: str) -> TextInputContent:
+@app.get("/ready")
+async def ready():
+    """Readiness for load balancers: 503 once draining, so new clients go elsewhere."""
+    drainer.check_accepting()
+    return {"ready": True}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/sessions", dependencies=[Depends(require_debug_access)])
+async def debug_sessions(limit: int = 20):
+    """Sessions with the heaviest usage first."""
+    heaviest = sorted(
+        sessions.items(),
+        key=lambda item: item[1].usage.input_tokens + item[1].usage.output_tokens,
+        reverse=True,
+    )
+    return {
+        "sessions": [
+            {"token": token[:8], "usage": session.usage.to_dict()}
+            for token, session in heaviest[:limit]
+        ]
+    }
+
+
+# --- Session memory accounting ---
+
+# Approximate bytes a session may retain (queued events, history, paused run snapshot,
+# job results) before attachments are evicted and history compacted after a run
+SESSION_MEMORY_LIMIT = int(os.environ.get("AGUI_SESSION_MEMORY_BYTES", str(64 * 1024 * 1024)))
+TRACEMALLOC_FRAMES = 10
+
+_ATOMIC_TYPES = (str, bytes, bytearray, int, float, bool, type(None))
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType, asyncio.Task)
+
+
+def estimate_size(obj: typing.Any) -> int:
+    """Approximate bytes retained by obj and everything it references, each object counted once."""
+    seen: set[int] = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, _SKIPPED_TYPES):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, _ATOMIC_TYPES):
+            continue
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        elif is_dataclass(item) or isinstance(item, BaseModel):
+            # Data only: arbitrary objects could lead anywhere, e.g. to shared clients
+            if hasattr(item, "__dict__"):
+                stack.append(item.__dict__)
+            for slot in getattr(type(item), "__slots__", ()):
+                stack.append(getattr(item, slot, None))
+    return total
+
+
+def session_memory(token: str, session: Session) -> dict[str, int]:
+    """Approximate retained bytes of a session, by what holds them.
+
+    The agent and router are counted shallowly: they mostly reference the toolset and
+    model clients that all sessions share.
+    """
+    return {
+        "queue": broker.queued_bytes(session),
+        "history": estimate_size(session.history_summaries),
+        "paused_run": estimate_size(session.paused_run),
+        "jobs": estimate_size([job.result for job in jobs.jobs.values() if job.token == token]),
+        "agent": sys.getsizeof(session.agent) + sys.getsizeof(session.router),
+    }
+
+
+def _evict_attachments(messages: list[ModelMessage]) -> int:
+    """Replace attachments in a message history with short notes; returns how many were evicted."""
+    evicted = 0
+    for message in messages:
+        if not isinstance(message, ModelRequest):
+            continue
+        for part in message.parts:
+            if not isinstance(part, UserPromptPart) or isinstance(part.content, str):
+                continue
+            content = []
+            for item in part.content:
+                if isinstance(item, BinaryContent):
+                    item = f"[{item.media_type} attachment removed to save server memory]"
+                    evicted += 1
+                elif isinstance(item, str) and item.startswith("<file-attachment "):
+                    item = item.split(">", 1)[0] + ">[removed to save server memory]</file-attachment>"
+                    evicted += 1
+                content.append(item)
+            part.content = content
+    return evicted
+
+
+def enforce_session_memory(token: str, session: Session, limit: int = SESSION_MEMORY_LIMIT) -> int:
+    """Shed a session's retained memory until it is under limit; returns the bytes it retains.
+
+    Attachments in the paused run go first, then all but the latest history summary,
+    then the paused run itself (the client can still resume by resending the history).
+    """
+    retained = sum(session_memory(token, session).values())
+    steps: list[tuple[str, Callable[[], bool]]] = [
+        ("attachments", lambda: session.paused_run is not None and _evict_attachments(session.paused_run.messages) > 0),
+        ("history", lambda: _compact_summaries(session)),
+        ("paused_run", lambda: _drop_paused_run(session)),
+    ]
+    for action, step in steps:
+        if retained <= limit:
+            break
+        if step():
+            session_memory_evictions.inc(action=action)
+            before, retained = retained, sum(session_memory(token, session).values())
+            logger.warning(f"[{token[:8]}] Session over its {limit} byte memory limit: shed {action}, {before} -> {retained} bytes")
+    return retained
+
+
+def _compact_summaries(session: Session) -> bool:
+    if len(session.history_summaries) <= 1:
+        return False
+    latest = list(session.history_summaries.items())[-1]
+    session.history_summaries.clear()
+    session.history_summaries[latest[0]] = latest[1]
+    return True
+
+
+def _drop_paused_run(session: Session) -> bool:
+    if session.paused_run is None:
+        return False
+    session.paused_run = None
+    return True
+
+
+@app.get("/debug/memory", dependencies=[Depends(require_debug_access)])
+async def debug_memory(limit: int = 20):
+    """Sessions retaining the most memory first."""
+    usage = [(token, session_memory(token, session)) for token, session in list(sessions.items())]
+    usage.sort(key=lambda item: sum(item[1].values()), reverse=True)
+    return {
+        "limit_bytes": SESSION_MEMORY_LIMIT,
+        "total_bytes": sum(sum(breakdown.values()) for _, breakdown in usage),
+        "sessions": [
+            {"token": token[:8], "bytes": sum(breakdown.values()), "breakdown": breakdown}
+            for token, breakdown in usage[:limit]
+        ],
+    }
+
+
+# Compared against by the next snapshot
+_last_tracemalloc_snapshot: tracemalloc.Snapshot | None = None
+
+
+@app.post("/debug/memory/tracemalloc", dependencies=[Depends(require_debug_access)])
+async def tracemalloc_snapshot(limit: int = 25):
+    """Top allocation sites, and their growth since the previous snapshot.
+
+    The first call starts tracing (which slows allocations down) and returns nothing;
+    DELETE stops it.
+    """
+    global _last_tracemalloc_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        _last_tracemalloc_snapshot = None
+        return {"tracing": True, "started": True, "top": []}
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    previous, _last_tracemalloc_snapshot = _last_tracemalloc_snapshot, snapshot
+    if previous is None:
+        stats = snapshot.statistics("lineno")
+    else:
+        stats = snapshot.compare_to(previous, "lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "started": False,
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "top": [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "bytes": stat.size,
+                "count": stat.count,
+                "bytes_diff": getattr(stat, "size_diff", None),
+            }
+            for stat in stats[:limit]
+        ],
+    }
+
+
+@app.delete("/debug/memory/tracemalloc", dependencies=[Depends(require_debug_access)])
+async def stop_tracemalloc():
+    global _last_tracemalloc_snapshot
+    tracemalloc.stop()
+    _last_tracemalloc_snapshot = None
+    return {"tracing": False}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.snapshot()
+
+
+# --- Request body spooling ---
+
+# POST /agent bodies larger than SPOOL_THRESHOLD are parsed incrementally: JSON strings
+# above the threshold (attachment data URLs) go to temporary files instead of memory
+# and reach process_attachments as SpooledString handles.
+SPOOL_THRESHOLD = 1024 * 1024
+MAX_REQUEST_BYTES = int(os.environ.get("AGUI_MAX_REQUEST_BYTES", str(256 * 1024 * 1024)))
+MAX_ATTACHMENT_BYTES = int(os.environ.get("AGUI_MAX_ATTACHMENT_BYTES", str(128 * 1024 * 1024)))  # per JSON string
+
+
+
+def _spool_marker() -> str:
+    """A fresh prefix for spooled string placeholders, which client strings can't forge."""
+    return f"\x00spool:{uuid4().hex}:"
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+class SpooledString:
+    """A large JSON string from a request body, kept in an (unlinked) temporary file.
+
+    The raw bytes are the string as it was encoded in the JSON body, so they can be
+    copied into other JSON unchanged; value() decodes them.
+    """
+
+    def __init__(self, file: typing.IO[bytes], size: int, escaped: bool):
+        self.file = file
+        self.size = size
+        self.escaped = escaped  # contains JSON escape sequences
+        self._map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+
+    @property
+    def raw(self) -> memoryview:
+        return memoryview(self._map)
+
+    def value(self) -> str:
+        if self.escaped:
+            return json.loads(b'"' + self._map[:] + b'"')
+        return str(self._map[:], "utf-8")
+
+    def chunks(self, chunk_size: int = SPOOL_THRESHOLD) -> typing.Iterator[str]:
+        """The raw string in pieces, decoded without splitting characters."""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for start in range(0, self.size, chunk_size):
+            yield decoder.decode(self._map[start:start + chunk_size])
+        yield decoder.decode(b"", final=True)
+
+    def parse_data_url(self) -> tuple[str, str | memoryview] | None:
+        """Like parse_data_url, but the base64 data is a view of the spooled bytes."""
+        if self.escaped:
+            return parse_data_url(self.value())
+        match = re.match(rb"data:([^;]+);base64,", self._map[:256])
+        if not match or match.end() == self.size:
+            return None
+        return match.group(1).decode(), self.raw[match.end():]
+
+    def close(self) -> None:
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # a view is still in use; the mapping goes away with it
+        self.file.close()
+
+
+class SpoolingJSONParser:
+    """Incrementally splits a JSON body into a small skeleton and spooled large strings.
+
+    Strings longer than threshold are written to temporary files as they arrive and
+    replaced in the skeleton by placeholders, so the skeleton parses quickly with json.
+    """
+
+    def __init__(self, threshold: int = SPOOL_THRESHOLD, max_string_bytes: int = MAX_ATTACHMENT_BYTES):
+        self.threshold = threshold
+        self.max_string_bytes = max_string_bytes
+        self.skeleton = bytearray()
+        self.spooled: list[SpooledString] = []
+        self._marker = _spool_marker()
+        self._in_string = False
+        self._pending_escape = False
+        self._string = bytearray()
+        self._file: typing.IO[bytes] | None = None
+        self._size = 0
+        self._escaped = False
+
+    def feed(self, chunk: bytes) -> None:
+        i, n = 0, len(chunk)
+        while i < n:
+            if not self._in_string:
+                j = chunk.find(b'"', i)
+                if j < 0:
+                    self.skeleton += chunk[i:]
+                    return
+                self.skeleton += chunk[i:j]
+                self._in_string = True
+                i = j + 1
+                continue
+            if self._pending_escape:
+                self._pending_escape = False
+                self._append(chunk[i:i + 1])
+                i += 1
+                continue
+            quote = chunk.find(b'"', i)
+            backslash = chunk.find(b"\\", i, quote if quote >= 0 else n)
+            if backslash >= 0:
+                self._escaped = True
+                self._append(chunk[i:backslash + 1])
+                self._pending_escape = True
+                i = backslash + 1
+            elif quote >= 0:
+                self._append(chunk[i:quote])
+                self._end_string()
+                i = quote + 1
+            else:
+                self._append(chunk[i:])
+                return
+
+    def _append(self, data: bytes) -> None:
+        self._size += len(data)
+        if self._size > self.max_string_bytes:
+            raise PayloadTooLarge(f"A string in the request is larger than {self.max_string_bytes} bytes")
+        if self._file is None:
+            self._string += data
+            if len(self._string) > self.threshold:
+                self._file = tempfile.TemporaryFile()  # noqa: SIM115 - closed by close() or the SpooledString it becomes
+                self._file.write(self._string)
+                self._string = bytearray()
+        else:
+            self._file.write(data)
+
+    def _end_string(self) -> None:
+        if self._file is None:
+            self.skeleton += b'"' + self._string + b'"'
+        else:
+            self._file.flush()
+            self.spooled.append(SpooledString(self._file, self._size, self._escaped))
+            self.skeleton += json.dumps(f"{self._marker}{len(self.spooled) - 1}").encode()
+        self._in_string = False
+        self._string = bytearray()
+        self._file = None
+        self._size = 0
+        self._escaped = False
+
+    def finish(self) -> typing.Any:
+        """The parsed body; spooled state.attachments values are SpooledStrings, other strings are plain."""
+        if self._in_string:
+            raise ValueError("Unterminated string in request body")
+        body = json.loads(self.skeleton)
+        state = body.get("state") if isinstance(body, dict) else None
+        attachments = state.get("attachments") if isinstance(state, dict) else None
+        if isinstance(attachments, dict):
+            # process_attachments reads these from the spooled files; anything else would
+            # be serialized again later, so it gets its text back
+            state["attachments"] = {
+                self._restore(name): self._spooled(data_url) or self._restore(data_url)
+                for name, data_url in attachments.items()
+            }
+        return self._restore(body)
+
+    def _spooled(self, value: typing.Any) -> SpooledString | None:
+        if isinstance(value, str) and value.startswith(self._marker):
+            return self.spooled[int(value[len(self._marker):])]
+        return None
+
+    def _restore(self, value: typing.Any) -> typing.Any:
+        if isinstance(value, str):
+            spooled = self._spooled(value)
+            if spooled is None:
+                return value
+            text = spooled.value()
+            spooled.close()
+            return text
+        if isinstance(value, list):
+            return [self._restore(item) for item in value]
+        if isinstance(value, dict):
+            return {self._restore(key): self._restore(item) for key, item in value.items()}
+        return value
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        for spooled in self.spooled:
+            spooled.close()
+
+
+async def read_run_input(request: Request) -> RunAgentInput:
+    """Parse a POST /agent body, spooling large attachments instead of holding them in memory.
+
+    A draining server answers 503 before reading the body at all.
+    """
+    drainer.check_accepting()
+    declared = request.headers.get("content-length")
+    try:
+        length = int(declared) if declared is not None else None
+    except ValueError:
+        length = -1
+    if length is not None and length < 0:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length header")
+    if length is not None and length > MAX_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail=f"Request body is larger than {MAX_REQUEST_BYTES} bytes")
+    try:
+        if length is not None and length <= SPOOL_THRESHOLD:
+            return RunAgentInput.model_validate_json(await request.body())
+
+        parser = SpoolingJSONParser(SPOOL_THRESHOLD, MAX_ATTACHMENT_BYTES)
+        received = 0
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > MAX_REQUEST_BYTES:
+                    raise PayloadTooLarge(f"Request body is larger than {MAX_REQUEST_BYTES} bytes")
+                parser.feed(chunk)
+            return RunAgentInput.model_validate(parser.finish())
+        except BaseException:
+            parser.close()
+            raise
+    except PayloadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e)) from None
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        ) from None
+    except ValueError as e:
+        raise RequestValidationError([
+            {"type": "json_invalid", "loc": ("body",), "msg": "JSON decode error", "input": {}, "ctx": {"error": str(e)}}
+        ]) from None
+
+
+def attachments_event_chunks(attachments_info: dict[str, str | SpooledString]) -> typing.Iterator[str]:
+    """The attachments CustomEvent as SSE text, copying spooled data URLs in pieces."""
+    spooled = [value for value in attachments_info.values() if isinstance(value, SpooledString)]
+    marker = _spool_marker()
+    value = {
+        name: f"{marker}{spooled.index(data_url)}" if isinstance(data_url, SpooledString) else data_url
+        for name, data_url in attachments_info.items()
+    }
+    event = CustomEvent(name="attachments", value=value, timestamp=int(time.time() * 1000))
+    text = f"data: {json.dumps(event.model_dump())}\n\n"
+    placeholder = re.compile(re.escape(json.dumps(marker)[:-1]) + r'(\d+)"')
+    position = 0
+    for match in placeholder.finditer(text):
+        yield text[position:match.start()] + '"'
+        yield from spooled[int(match.group(1))].chunks()
+        yield '"'
+        position = match.end()
+    yield text[position:]
+
+
+def process_text_attachment(base64_data: str | memoryview, filename: str) -> TextInputContent:
     text_content = base64.b64decode(base64_data).decode("utf-8")
     return TextInputContent(
         text=f"""<file-attachment name="{filename}">
@@ -409,18 +3101,18 @@ def process_text_attachment(base64_data: str, filename: str) -> TextInputContent
 
 
 def process_binary_attachment(
-    media_type: str, base64_data: str, filename: str
+    media_type: str, base64_data: str | memoryview, filename: str
 ) -> BinaryInputContent:
     return BinaryInputContent(
         mime_type=media_type,
-        data=base64_data,
+        data=base64_data if isinstance(base64_data, str) else str(base64_data, "ascii"),
         filename=filename
     )
 
 
-def process_attachments(run_input: RunAgentInput) -> dict[str, str]:
+def process_attachments(run_input: RunAgentInput) -> dict[str, str | SpooledString]:
     attachments = run_input.state.get("attachments", {})
-    attachments_info: dict[str, str] = {}
+    attachments_info: dict[str, str | SpooledString] = {}
     if not (attachments and run_input.messages):
         return attachments_info
     # Find the last user message index
@@ -437,11 +3129,16 @@ def process_attachments(run_input: RunAgentInput) -> dict[str, str]:
     content_list: list[TextInputContent | BinaryInputContent] | None = None
 
     for filename, data_url in attachments.items():
-        parsed = parse_data_url(data_url)
+        parsed = data_url.parse_data_url() if isinstance(data_url, SpooledString) else parse_data_url(data_url)
         if not parsed:
             continue
         media_type, base64_data = parsed
         attachments_info[filename] = data_url
+        padding = base64_data[-2:].count("=") if isinstance(base64_data, str) else bytes(base64_data[-2:]).count(b"=")
+        attachment_bytes.inc(
+            len(base64_data) * 3 // 4 - padding,
+            kind="text" if media_type.startswith("text/") else "binary",
+        )
 
         if content_list is None:
             if isinstance(msg.content, str):
@@ -464,40 +3161,243 @@ def process_attachments(run_input: RunAgentInput) -> dict[str, str]:
     return attachments_info
 
 
+# --- Context window management ---
+
+# Approximate token budgets for the message history, keyed by backend model name
+CONTEXT_TOKEN_BUDGETS: dict[str, int] = {
+    "gemini-3.1-pro-preview": 200_000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 100_000
+# Number of most recent messages that are always sent verbatim
+KEEP_RECENT_MESSAGES = 8
+# Rough token cost of an image/document attachment
+ATTACHMENT_TOKEN_ESTIMATE = 1_000
+# Summarize dropped turns with the fast model instead of just omitting them
+SUMMARIZE_DROPPED_TURNS = True
+# Longest a background summary may take before it is abandoned
+SUMMARY_TIMEOUT_SECONDS = 15.0
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the earlier part of a conversation between a user and an assistant. "
+    "Keep facts, decisions, names, numbers and open questions. Be brief."
+)
+
+
+def context_token_budget(model_name: str) -> int:
+    """Token budget for the history sent to the given model."""
+    return CONTEXT_TOKEN_BUDGETS.get(model_name.removeprefix("router:"), DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def message_text(msg: typing.Any) -> str:
+    """Text of an AG-UI message, without binary attachment payloads."""
+    content = msg.content
+    if isinstance(content, str):
+        text = content
+    elif isinstance(content, list):
+        text = "\n".join(c.text for c in content if isinstance(c, TextInputContent))
+    else:
+        text = ""
+    for call in getattr(msg, "tool_calls", None) or []:
+        text += f"\n[tool call {call.function.name}({call.function.arguments})]"
+    return text
+
+
+def estimate_message_tokens(msg: typing.Any) -> int:
+    tokens = estimate_tokens(message_text(msg))
+    if isinstance(msg.content, list):
+        tokens += ATTACHMENT_TOKEN_ESTIMATE * sum(
+            1 for c in msg.content if not isinstance(c, TextInputContent)
+        )
+    return tokens
+
+
+def strip_stale_attachments(messages: list[typing.Any]) -> int:
+    """Replace binary attachments in the given user messages with a short placeholder."""
+    stripped = 0
+    for msg in messages:
+        if msg.role != "user" or not isinstance(msg.content, list):
+            continue
+        content: list[typing.Any] = []
+        for c in msg.content:
+            if isinstance(c, TextInputContent):
+                content.append(c)
+            else:
+                name = getattr(c, "filename", None) or getattr(c, "mime_type", None) or "file"
+                content.append(TextInputContent(text=f"[attachment {name} omitted from history]"))
+                stripped += 1
+        msg.content = content
+    return stripped
+
+
+async def summarize_messages(model: Model, previous_summary: str | None, messages: list[typing.Any]) -> str:
+    """Summarize messages (and an earlier summary) with the given model."""
+    transcript = "\n".join(f"{msg.role}: {message_text(msg)}" for msg in messages)
+    if previous_summary:
+        transcript = f"Summary so far:\n{previous_summary}\n\nLater messages:\n{transcript}"
+    summarizer = Agent(model, system_prompt=SUMMARY_INSTRUCTIONS)
+    result = await summarizer.run(transcript)
+    return result.output
+
+
+# Summaries being made in the background, by (summary cache, id of the last summarized message)
+pending_summaries: dict[tuple[int, str], asyncio.Task[None]] = {}
+
+
+async def refresh_summary(
+    model: Model, cache: dict[str, str], previous: str | None, messages: list[typing.Any]
+) -> None:
+    """Summarize messages on top of a previous summary and cache the result for later turns."""
+    try:
+        summary = await asyncio.wait_for(summarize_messages(model, previous, messages), SUMMARY_TIMEOUT_SECONDS)
+    except Exception as e:  # noqa: BLE001 - summaries are best effort, the turns are just omitted meanwhile
+        logger.warning(f"Summarizing {len(messages)} dropped messages failed: {e!r}")
+        return
+    # Each summary covers the ones before it, so only the latest is kept
+    cache.clear()
+    cache[messages[-1].id] = summary
+
+
+async def compact_history(
+    run_input: RunAgentInput,
+    budget: int,
+    keep_recent: int = KEEP_RECENT_MESSAGES,
+    summary_model: Model | None = None,
+    summary_cache: dict[str, str] | None = None,
+) -> int:
+    """Shrink run_input.messages in place to fit a token budget.
+
+    System messages and the last `keep_recent` messages are kept verbatim. Binary
+    attachments in older user messages are replaced with placeholders, then the oldest
+    turns are dropped until the history fits, and the dropped turns are replaced with a
+    note that they were omitted. With a summary_model and summary_cache, the note is a
+    summary instead once one covering exactly the dropped turns is cached; until then it
+    is made in the background, so the run doesn't wait for it. The latest summary is cached
+    by the id of the last summarized message so later turns only summarize what was
+    dropped since.
+
+    Returns the number of dropped messages.
+    """
+    messages = list(run_input.messages)
+    if len(messages) <= keep_recent:
+        return 0
+
+    # Start the recent window at a user turn, so it never opens with a tool result
+    # whose tool call would be dropped
+    recent_start = len(messages) - keep_recent
+    while recent_start and messages[recent_start].role != "user":
+        recent_start -= 1
+    if not recent_start:
+        return 0
+    stripped = strip_stale_attachments(messages[:recent_start])
+
+    system = [m for m in messages[:recent_start] if m.role in ("system", "developer")]
+    older = [m for m in messages[:recent_start] if m.role not in ("system", "developer")]
+    recent = messages[recent_start:]
+
+    total = sum(estimate_message_tokens(m) for m in system + older + recent)
+    drop = 0
+    while total > budget and drop < len(older):
+        total -= estimate_message_tokens(older[drop])
+        drop += 1
+    # Never start the kept history with a tool result or a dangling assistant turn
+    while drop and drop < len(older) and older[drop].role != "user":
+        drop += 1
+
+    if stripped:
+        logger.debug(f"Stripped {stripped} stale attachments from history")
+    if not drop:
+        return 0
+
+    dropped = older[:drop]
+    kept: list[typing.Any] = system
+    note = f"[{drop} earlier messages were omitted to fit the context window]"
+    if summary_model is not None and summary_cache is not None:
+        # Reuse the longest cached summary of a prefix of the dropped messages
+        previous: str | None = None
+        start = 0
+        for i in range(len(dropped) - 1, -1, -1):
+            if dropped[i].id in summary_cache:
+                previous, start = summary_cache[dropped[i].id], i + 1
+                break
+        key = (id(summary_cache), dropped[-1].id)
+        if start == len(dropped):
+            note = f"<conversation-summary>\n{previous}\n</conversation-summary>"
+        elif key not in pending_summaries:
+            task = asyncio.create_task(refresh_summary(summary_model, summary_cache, previous, dropped[start:]))
+            pending_summaries[key] = task
+            task.add_done_callback(lambda _: pending_summaries.pop(key, None))
+    kept.append(UserMessage(id=f"compacted-{dropped[-1].id}", role="user", content=note))
+    kept.extend(older[drop:])
+    kept.extend(recent)
+    run_input.messages = kept
+    logger.info(f"Compacted history: dropped {drop} of {len(messages)} messages (~{total} tokens kept)")
+    return drop
+
+
 @app.post("/events")
-async def events(request: Request):
-    """SSE endpoint that creates a session with its own agent and streams events."""
+async def events(
+    request: Request,
+    resume: str | None = None,
+    group: typing.Annotated[list[str] | None, Query()] = None,
+):
+    """SSE endpoint that creates a session with its own agent and streams events.
+
+    resume is the token of a session a draining process handed off (see HANDOFF_DIR);
+    each group joins the session to a broker group for EventBroker.publish (see EVENT_GROUPS).
+    """
+    drainer.check_accepting()
+    groups = group or []
+    if len(groups) > MAX_EVENT_GROUPS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_EVENT_GROUPS} groups per session")
+    for name in groups:
+        if not EVENT_GROUP_NAME.fullmatch(name) or (EVENT_GROUPS is not None and name not in EVENT_GROUPS):
+            raise HTTPException(status_code=400, detail=f"Unknown event group {name[:64]!r}")
     token = str(uuid4())
+    router = ModelRouter(MODEL_BACKENDS, fast_model=FAST_MODEL)
     session = Session(
-        agent=create_agent(),
+        agent=create_agent(router),
         queue=asyncio.Queue(),
+        router=router,
     )
+    if resume and HANDOFF_DIR:
+        handoff = take_handoff(resume, HANDOFF_DIR)
+        if handoff is not None:
+            restore_handoff(session, handoff)
+            logger.info(f"[{token[:8]}] Resumed handed-off session {resume[:8]}")
     sessions[token] = session
+    for name in groups:
+        broker.join(token, name)
 
     agent_url = f"/agent?token={token}"
-    available_tools = [
-        {
-            "name": name,
-            "description": tool.description or "",
-            "a2ui": tool_schema_to_a2ui(name, tool),
-        }
-        for name, tool in toolset.tools.items()
-    ]
 
     async def event_stream():
+        current_session_token.set(token)
         logger.info(f"[{token[:8]}] /events client connected")
+        events_connects.inc()
         try:
             # First event: JSON with agent URL and available tools
-            first_event = {"agent": agent_url, "available_tools": available_tools}
-            print(f"[DEBUG] Sending first_event: {first_event}")
+            first_event = {"agent": agent_url, "available_tools": available_tools()}
             yield f"data: {json.dumps(first_event)}\n\n"
 
             # Loop forever reading from queue
             while True:
                 event = await session.queue.get()
+                if isinstance(event, bytes):
+                    # Already encoded by the broker
+                    yield event
+                    continue
                 if isinstance(event, dict) and event.get("die"):
                     yield "event: die\ndata: shutdown\n\n"
                     return
+                if isinstance(event, dict) and "reconnect" in event:
+                    retry_ms = event["reconnect"]["retry_after"] * 1000
+                    yield f"event: reconnect\nretry: {retry_ms}\ndata: {json.dumps(event['reconnect'])}\n\n"
+                    return
                 yield f"data: {json.dumps(event)}\n\n"
         except asyncio.CancelledError:
             logger.info(f"[{token[:8]}] /events client disconnected")
@@ -506,10 +3406,300 @@ async def events(request: Request):
             if session.current_task and not session.current_task.done():
                 session.current_task.cancel()
             sessions.pop(token, None)
+            broker.leave(token)
+            events_disconnects.inc()
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
+# --- Response replay cache ---
+
+# Opt-in cache of whole AG-UI event streams for identical prompts (demo/regression traffic),
+# turned on with AGUI_RESPONSE_CACHE=1. Runs that call a tool which isn't pure aren't cached.
+RESPONSE_CACHE_ENABLED = os.environ.get("AGUI_RESPONSE_CACHE", "") not in ("", "0")
+RESPONSE_CACHE_TTL = 3600.0  # seconds
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Multiplier for the recorded gaps between events on replay: 1.0 replays with the
+# original timing, smaller values compress it, 0 replays instantly.
+RESPONSE_CACHE_TIME_SCALE = 1.0
+
+
+@dataclass
+class CachedResponse:
+    """A recorded AG-UI event stream: (seconds since start, SSE chunk) pairs."""
+    chunks: list[tuple[float, str]]
+    size: int
+    created: float
+
+
+class ResponseCache:
+    """LRU cache of recorded event streams with a TTL and a total size bound."""
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> CachedResponse | None:
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry.created > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, chunks: list[tuple[float, str]]) -> None:
+        size = sum(len(chunk) for _, chunk in chunks)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = CachedResponse(chunks=chunks, size=size, created=time.monotonic())
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str) -> None:
+        self.size -= self.entries.pop(key).size
+
+
+response_cache = ResponseCache()
+
+
+def response_cache_key(
+    model_name: str,
+    system_prompt: str,
+    tool_names: typing.Iterable[str],
+    run_input: RunAgentInput,
+) -> str:
+    """Hash of everything that determines the model's answer, ignoring message and run ids.
+
+    That includes the client's own tools and context, which are sent to the model too.
+    """
+    tools = [
+        [name, toolset.tools[name].description or "", toolset.tools[name].function_schema.json_schema]
+        for name in sorted(tool_names)
+    ]
+    client_tools = sorted(
+        ([tool.name, tool.description, tool.parameters] for tool in run_input.tools), key=lambda tool: tool[0]
+    )
+    context = [[item.description, item.value] for item in run_input.context]
+    history = [
+        [msg.role, message_text(msg), getattr(msg, "tool_call_id", None) is not None]
+        for msg in run_input.messages
+    ]
+    payload = json.dumps([model_name, system_prompt, tools, client_tools, context, history], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def is_cacheable_run(run_input: RunAgentInput) -> bool:
+    """Runs with approvals, attachments or manual tool calls always go to the model."""
+    state = run_input.state or {}
+    if state.get("deferred_tool_approvals") or state.get("attachments") or state.get("manual_tool_call"):
+        return False
+    return not any(
+        isinstance(msg.content, list) and any(not isinstance(c, TextInputContent) for c in msg.content)
+        for msg in run_input.messages
+    )
+
+
+async def replay_response(
+    entry: CachedResponse,
+    run_input: RunAgentInput,
+    time_scale: float = RESPONSE_CACHE_TIME_SCALE,
+) -> typing.AsyncIterator[str]:
+    """Replay a recorded event stream with the ids of the current run and fresh message ids.
+
+    The client keeps messages by id, so replaying the recorded ones would overwrite the
+    original turn's messages with the replayed ones.
+    """
+    previous = 0.0
+    fresh_ids: dict[str, str] = {}
+    for offset, chunk in entry.chunks:
+        delay = (offset - previous) * time_scale
+        previous = offset
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if chunk.startswith("data: ") and ('"RUN_' in chunk or 'Id"' in chunk):
+            event_data = json.loads(chunk[6:])
+            if event_data.get("type") in ("RUN_STARTED", "RUN_FINISHED", "RUN_ERROR"):
+                event_data["threadId"] = run_input.thread_id
+                event_data["runId"] = run_input.run_id
+            for field_name in ("messageId", "parentMessageId", "toolCallId"):
+                if isinstance(event_data.get(field_name), str):
+                    event_data[field_name] = fresh_ids.setdefault(event_data[field_name], str(uuid4()))
+            chunk = f"data: {json.dumps(event_data)}\n\n"
+        yield chunk
+
+
+# --- Per-run profiling ---
+
+# When the server runs with AGUI_PROFILING=1 (or DEBUG), send this header (or set
+# state["profile"]) to "1" to time the run's stages, or "sample" to also sample the
+# event loop's stacks while it runs. Profiles are downloaded with debug access.
+PROFILING = DEBUG or os.environ.get("AGUI_PROFILING", "") not in ("", "0")
+PROFILE_HEADER = "x-agui-profile"
+PROFILE_KEEP = 20  # profiles kept for download
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between event loop samples
+STREAM_STAGE = "agent_run;stream_agent_response"
+RUN_STAGE = f"{STREAM_STAGE};run_ag_ui"
+
+current_profile: contextvars.ContextVar[RunProfile | None] = contextvars.ContextVar("current_profile", default=None)
+
+
+class EventLoopSampler:
+    """Samples the event loop thread's Python stack from a background thread."""
+
+    # Held by the running sampler: they would all sample the same loop, so one is enough
+    _running = threading.Lock()
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.samples: dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="loop-sampler", daemon=True)
+
+    def start(self) -> bool:
+        """Start sampling, unless another sampler is already running."""
+        if not EventLoopSampler._running.acquire(blocking=False):
+            return False
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+            EventLoopSampler._running.release()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_qualname} ({Path(code.co_filename).name})")
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+
+class RunProfile:
+    """Wall time per stage of one /agent run, exported as collapsed stacks for flame graphs.
+
+    Stages are ';'-separated paths. Time is recorded per path including children, and
+    each path's self time is what's left after its direct children.
+    """
+
+    def __init__(self, profile_id: str, sample: bool = False):
+        self.id = profile_id
+        self.totals: dict[str, float] = {}
+        self.sampler = EventLoopSampler() if sample else None
+
+    def add(self, path: str, seconds: float) -> None:
+        self.totals[path] = self.totals.get(path, 0.0) + seconds
+
+    def self_times(self) -> dict[str, float]:
+        result = dict(self.totals)
+        for path, seconds in self.totals.items():
+            parent = path.rpartition(";")[0]
+            if parent in result:
+                result[parent] -= seconds
+        # Concurrent children (e.g. parallel tool calls) can add up to more than their parent
+        return {path: max(seconds, 0.0) for path, seconds in result.items()}
+
+    def collapsed(self) -> str:
+        """Collapsed-stack text (flamegraph.pl, speedscope) with microsecond weights."""
+        lines = [f"{path} {round(seconds * 1e6)}" for path, seconds in self.self_times().items()]
+        if self.sampler is not None:
+            weight = round(self.sampler.interval * 1e6)
+            lines += [f"event_loop;{stack} {count * weight}" for stack, count in list(self.sampler.samples.items())]
+        return "\n".join(lines) + "\n"
+
+
+profiles: OrderedDict[str, RunProfile] = OrderedDict()
+
+
+def requested_profile_mode(request: Request, run_input: RunAgentInput) -> str | None:
+    """"stages" or "sample" if this request asked to be profiled and profiling is on, else None."""
+    if not PROFILING:
+        return None
+    value = request.headers.get(PROFILE_HEADER)
+    if not isinstance(value, str) and run_input.state:
+        value = run_input.state.get("profile")
+    if isinstance(value, str):
+        value = value.strip().lower()
+    if value is True or value in ("1", "true", "stages"):
+        return "stages"
+    if value == "sample":
+        return "sample"
+    return None
+
+
+def start_profile(mode: str) -> RunProfile:
+    """Create and keep a profile; its sampler is started by the run's response body.
+
+    The id is generated here, not taken from the client, so one run can't read or
+    overwrite another run's profile by reusing its run id.
+    """
+    profile = RunProfile(uuid4().hex[:12], sample=mode == "sample")
+    profiles[profile.id] = profile
+    while len(profiles) > PROFILE_KEEP:
+        profiles.popitem(last=False)
+    return profile
+
+
+@contextmanager
+def profile_stage(path: str) -> typing.Iterator[None]:
+    """Time a block as a stage of the current run's profile (no-op when not profiling)."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(path, time.perf_counter() - start)
+
+
+async def profile_chunks(chunks: typing.AsyncIterator[str], path: str) -> typing.AsyncIterator[str]:
+    """Record the time spent waiting on each chunk as the given stage."""
+    profile = current_profile.get()
+    iterator = aiter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        finally:
+            if profile is not None:
+                profile.add(path, time.perf_counter() - start)
+        yield chunk
+
+
+@app.get("/debug/profiles/{profile_id}", dependencies=[Depends(require_debug_access)])
+async def download_profile(profile_id: str):
+    profile = profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        profile.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'},
+    )
+
+
 async def stream_agent_response(
     token: str,
     run_input: RunAgentInput,
@@ -518,10 +3708,15 @@ async def stream_agent_response(
     on_complete_callback,
     deferred_tool_requests: dict,
     state: dict,
+    message_history: list[ModelMessage] | None = None,
 ):
-    """Stream agent response, yielding SSE chunks."""
+    """Stream agent response, yielding SSE chunks.
+
+    message_history is the snapshot of a paused run being resumed; run_input then only
+    carries the approvals.
+    """
     deferred_tool_results = None
-    attachments_info: dict[str, str] = {}
+    attachments_info: dict[str, str | SpooledString] = {}
 
     if run_input.state:
         # Only create DeferredToolResults if there are actual approvals
@@ -529,13 +3724,62 @@ async def stream_agent_response(
         if approvals:
             deferred_tool_results = DeferredToolResults(approvals=approvals)
 
-        attachments_info = process_attachments(run_input)
+        with profile_stage(f"{STREAM_STAGE};process_attachments"):
+            attachments_info = process_attachments(run_input)
 
     # Filter tools based on disabled_tools in state
     disabled_tools = set(run_input.state.get("disabled_tools", [])) if run_input.state else set()
-    if disabled_tools:
+    # Narrow to the most relevant tools (manual and resumed runs need the tools they trigger)
+    selected_tools = None
+    if (
+        TOOL_SELECTION_TOP_K
+        and message_history is None
+        and not (run_input.state and run_input.state.get("manual_tool_call"))
+    ):
+        with profile_stage(f"{STREAM_STAGE};select_tools"):
+            selected_tools = select_tools(run_input, TOOL_SELECTION_TOP_K)
+        if selected_tools is not None:
+            logger.debug(f"[{token[:8]}] Selected tools: {sorted(selected_tools)}")
+
+    # Looked up before compacting the history, so a hit costs nothing but the replay
+    cache_key = None
+    recording: list[tuple[float, str]] | None = None
+    if RESPONSE_CACHE_ENABLED and is_cacheable_run(run_input):
+        enabled_tools = [
+            name for name in toolset.tools
+            if name not in disabled_tools and (selected_tools is None or name in selected_tools)
+        ]
+        cache_key = response_cache_key(
+            agent.model.model_name if isinstance(agent.model, Model) else str(agent.model),
+            AGENT_INSTRUCTIONS,
+            enabled_tools,
+            run_input,
+        )
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"[{token[:8]}] Replaying cached response {cache_key[:12]}")
+            state["ag_ui_events"] = replay_response(cached, run_input)
+        else:
+            recording = []
+
+    # Keep the history within the model's context budget (a resumed snapshot is used as-is)
+    session = sessions.get(token)
+    summary_model = None
+    if SUMMARIZE_DROPPED_TURNS and session and session.router:
+        summary_model = session.router.as_model(cheap=True)
+    if message_history is None and state.get("ag_ui_events") is None:
+        with profile_stage(f"{STREAM_STAGE};compact_history"):
+            await compact_history(
+                run_input,
+                context_token_budget(agent.model.model_name if isinstance(agent.model, Model) else str(agent.model)),
+                summary_model=summary_model,
+                summary_cache=session.history_summaries if session else None,
+            )
+
+    if disabled_tools or selected_tools is not None:
         filtered = toolset.filtered(
             lambda _ctx, tool_def: tool_def.name not in disabled_tools
+            and (selected_tools is None or tool_def.name in selected_tools)
         )
         agent = Agent[StateDeps[Dependencies], typing.Any](
             agent.model,
@@ -545,16 +3789,54 @@ async def stream_agent_response(
             deps_type=StateDeps[Dependencies],
         )
 
-    state["ag_ui_events"] = run_ag_ui(  # type: ignore[misc]
-        agent,
-        run_input,
-        deferred_tool_results=deferred_tool_results,
-        on_complete=on_complete_callback,
-        deps=deps
-    )
+    stats = RunStats(runs=1)
+    current_run_stats.set(stats)
+
+    def on_complete(result):
+        nonlocal recording
+        # Summed from the responses, which reads the same across pydantic-ai versions
+        for message in result.new_messages():
+            if isinstance(message, ModelResponse):
+                stats.requests += 1
+                stats.input_tokens += message.usage.input_tokens
+                stats.output_tokens += message.usage.output_tokens
+                # A replay wouldn't repeat the side effects or draw new random numbers
+                if recording is not None and not all(
+                    toolset.is_replayable(part.tool_name, part.args_as_dict())
+                    for part in message.parts if isinstance(part, ToolCallPart)
+                ):
+                    recording = None
+        if on_complete_callback is not None:
+            on_complete_callback(result)
+
+    if state.get("ag_ui_events") is None:
+        state["ag_ui_events"] = run_ag_ui(  # type: ignore[misc]
+            agent,
+            run_input,
+            message_history=message_history,
+            deferred_tool_results=deferred_tool_results,
+            on_complete=on_complete,
+            deps=deps
+        )
 
+    run_start = time.perf_counter()
+    run_finished = False
     first_event_seen = False
-    async for chunk in state["ag_ui_events"]:
+    first_token_seen = False
+    events_sent = 0
+    chunks = traced_run(state["ag_ui_events"], token, run_input)
+    if current_profile.get() is not None:
+        chunks = profile_chunks(chunks, RUN_STAGE)
+    async for chunk in with_tool_progress(chunks):
+        events_sent += 1
+        # Encoder output is almost always ASCII, whose length is its UTF-8 size (isascii() is O(1))
+        stats.bytes_streamed += len(chunk) if chunk.isascii() else len(chunk.encode())
+        if isinstance(chunk, ToolProgressChunk):
+            # Progress is live-only: it's neither recorded for replay nor inspected below
+            yield chunk
+            continue
+        if recording is not None:
+            recording.append((time.perf_counter() - run_start, chunk))
         # Yield the first event (RUN_STARTED)
         if not first_event_seen:
             logger.debug(f"[{token[:8]}] RUN_STARTED event received")
@@ -572,19 +3854,24 @@ async def stream_agent_response(
 
             # Emit attachments event if there are any
             if attachments_info:
-                attachments_event = CustomEvent(
-                    name="attachments",
-                    value=attachments_info,
-                    timestamp=int(time.time() * 1000)
-                )
-                yield f"data: {json.dumps(attachments_event.model_dump())}\n\n"
+                for piece in attachments_event_chunks(attachments_info):
+                    yield piece
+                # The attachments are in the messages now, so spooled copies can go
+                for data_url in attachments_info.values():
+                    if isinstance(data_url, SpooledString):
+                        data_url.close()
 
             continue
         if chunk.startswith("data: "):
             json_str = chunk[6:].strip()
             event_data = json.loads(json_str)
+            if not first_token_seen and event_data.get("type") in ("TEXT_MESSAGE_CONTENT", "TOOL_CALL_START"):
+                first_token_seen = True
+                stats.time_to_first_token = time.perf_counter() - run_start
+                run_ttft.observe(stats.time_to_first_token)
             if event_data.get("type") == "RUN_FINISHED":
                 logger.debug(f"[{token[:8]}] RUN_FINISHED event received")
+                run_finished = True
                 deferred_event = CustomEvent(
                     name="deferred_tool_requests",
                     value=deferred_tool_requests,
@@ -592,11 +3879,29 @@ async def stream_agent_response(
                 )
                 yield f"data: {json.dumps(deferred_event.model_dump())}\n\n"
 
+                stats.model_time = max(time.perf_counter() - run_start - stats.tool_time, 0.0)
+                value: dict[str, typing.Any] = {"run": stats.to_dict()}
+                if session is not None:
+                    session.usage.add(stats)
+                    value["session_totals"] = session.usage.to_dict()
+                stats_event = CustomEvent(name="run_stats", value=value, timestamp=int(time.time() * 1000))
+                yield f"data: {json.dumps(stats_event.model_dump())}\n\n"
+
         yield chunk
 
+    run_events.observe(events_sent)
+    # Only complete answers are cached; paused runs depend on approvals that can't be replayed
+    if cache_key and recording is not None and run_finished and not deferred_tool_requests:
+        response_cache.put(cache_key, recording)
+
 
 @app.post("/agent")
-async def agent_run(request: Request, run_input: RunAgentInput, token: str):
+async def agent_run(
+    request: Request,
+    run_input: typing.Annotated[RunAgentInput, Depends(read_run_input)],
+    token: str,
+):
+    received = time.perf_counter()
     # Validate token and get session
     session = sessions.get(token)
     if not session:
@@ -610,6 +3915,13 @@ async def agent_run(request: Request, run_input: RunAgentInput, token: str):
         except asyncio.CancelledError:
             pass
 
+    # Approvals for a paused run can resume it from the server-side snapshot,
+    # without the client resending (and us re-validating) the whole history
+    message_history = None
+    if run_input.state and run_input.state.get("resume_paused_run"):
+        message_history = take_paused_run(session, run_input)
+        logger.info(f"[{token[:8]}] Resuming paused run ({len(message_history)} messages)")
+
     deferred_tool_requests: dict[str, typing.Any] = {}
     deps = StateDeps(Dependencies())
 
@@ -624,6 +3936,13 @@ async def agent_run(request: Request, run_input: RunAgentInput, token: str):
                         "tool_name": part.tool_name,
                         "args": part.args
                     }
+            session.paused_run = PausedRun(
+                thread_id=run_input.thread_id,
+                messages=result.all_messages(),
+                pending={part.tool_call_id for part in [*result.output.calls, *result.output.approvals]},
+            )
+        else:
+            session.paused_run = None
 
     # Check for manual tool call — use FunctionModel to inject a predetermined tool call
     manual_call = run_input.state.get("manual_tool_call") if run_input.state else None
@@ -631,16 +3950,18 @@ async def agent_run(request: Request, run_input: RunAgentInput, token: str):
         stream_fn = make_injector_stream_fn(
             tool_name=manual_call["name"],
             tool_args=json.dumps(manual_call["args"]),
-            real_model=session.agent.model,
+            # The summary is a cheap turn: route it to the fast model when one is configured
+            real_model=session.router.as_model(cheap=True) if session.router else session.agent.model,  # type: ignore[arg-type]
         )
         injector_model = FunctionModel(stream_function=stream_fn, model_name="manual-tool-injector")
-        auto_approved_toolset = FunctionToolset()
+        auto_approved_toolset = ServerToolset()
         for name, tool in toolset.tools.items():
             auto_approved_toolset.add_function(
                 tool.function,
                 name=name,
                 description=tool.description,
                 requires_approval=False,
+                cache=toolset.caches.get(name),
             )
         agent = Agent[StateDeps[Dependencies], str](
             injector_model,
@@ -655,49 +3976,122 @@ async def agent_run(request: Request, run_input: RunAgentInput, token: str):
 
     state: dict[str, typing.Any] = {}
 
+    profile = None
+    headers = {}
+    profile_mode = requested_profile_mode(request, run_input)
+    if profile_mode:
+        profile = start_profile(profile_mode)
+        profile.add("agent_run;setup", time.perf_counter() - received)
+        headers["X-Agui-Profile-Url"] = f"/debug/profiles/{profile.id}"
+        logger.info(f"[{token[:8]}] Profiling run {run_input.run_id} as {profile.id} ({profile_mode})")
+
     async def event_stream():
+        # Lets tools started by this run (e.g. background jobs) report to the session
+        current_session_token.set(token)
+        current_run_id.set(run_input.run_id)
+        current_profile.set(profile)
+        drainer.run_started(token)
+        outcome = "error"
+        first_byte_sent = False
         try:
-            async for chunk in stream_agent_response(
+            # Started here rather than in agent_run, so a response that is never sent
+            # doesn't leave a sampler thread running
+            if profile is not None and profile.sampler is not None and not profile.sampler.start():
+                # Another run is being sampled; this one only times its stages
+                profile.sampler = None
+            chunks = stream_agent_response(
                 token, run_input, agent, deps,
-                on_complete_callback, deferred_tool_requests, state
-            ):
-                yield chunk
+                on_complete_callback, deferred_tool_requests, state,
+                message_history=message_history,
+            )
+            if profile is not None:
+                chunks = profile_chunks(chunks, STREAM_STAGE)
+            async for chunk in chunks:
+                if not first_byte_sent:
+                    first_byte_sent = True
+                    run_ttfb.observe(time.perf_counter() - received)
+                if profile is None:
+                    yield chunk
+                else:
+                    with profile_stage("agent_run;sse_write"):
+                        yield chunk
+            outcome = "paused" if deferred_tool_requests else "finished"
         except asyncio.CancelledError:
             logger.info(f"[{token[:8]}] /agent client disconnected")
+            outcome = "cancelled"
             raise
         finally:
+            run_duration.observe(time.perf_counter() - received, outcome=outcome)
+            if profile is not None and profile.sampler is not None:
+                profile.sampler.stop()
             # Close the underlying LLM stream to stop wasting API credits
             # NOTE: run_ag_ui has a bug where it doesn't handle GeneratorExit cleanly,
             # causing "RuntimeError: async generator ignored GeneratorExit" in a background task.
             # TODO: Report bug / patch pydantic_ai
             if state.get("ag_ui_events") is not None:
                 await state["ag_ui_events"].aclose()
+            enforce_session_memory(token, session)
+            drainer.run_finished(token)
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+
+# --- Tracing ---
+
+# Set AGUI_TRACING=1 to instrument at startup; AGUI_TRACE_FILE additionally appends
+# kept traces to that file as OTLP/JSON lines
+TRACE_SAMPLE_RATE = float(os.environ.get("AGUI_TRACE_SAMPLE_RATE", "0.1"))  # head sampling
+
+tracer = trace.get_tracer("agent_server")
 
 
-def instrument(service_name: str = "default") -> None:
+# Set by instrument()
+trace_buffer: tracing.TraceRingBuffer | None = None
+
+
+async def traced_run(chunks: typing.AsyncIterator[str], token: str, run_input: RunAgentInput) -> typing.AsyncIterator[str]:
+    """Wrap a run's chunks in an agui.run span tagged with its session prefix and run id.
+
+    Must be iterated by a single task (see with_tool_progress) so the span stays current
+    for the model and tool spans the run creates.
+    """
+    attributes = {"agui.session": token[:8], "agui.run_id": run_input.run_id, "agui.thread_id": run_input.thread_id}
+    with tracer.start_as_current_span("agui.run", attributes=attributes) as span:
+        async for chunk in chunks:
+            if '"RUN_ERROR"' in chunk:
+                span.set_status(Status(StatusCode.ERROR, "RUN_ERROR"))
+            yield chunk
+
+
+@app.get("/debug/traces")
+async def debug_traces(request: Request, token: str | None = None, run_id: str | None = None, limit: int = 20):
+    """Recent traces. A session may read its own by token; anything else needs debug access."""
+    if token is None or token not in sessions:
+        await require_debug_access(request)
+    if trace_buffer is None:
+        raise HTTPException(status_code=404, detail="Tracing is not enabled (set AGUI_TRACING=1)")
+    return {
+        "traces": [record.to_dict() for record in trace_buffer.find(token, run_id, limit)],
+        **trace_buffer.stats(),
+    }
 
-    class CustomConsoleSpanExporter(ConsoleSpanExporter):
-        def export(self, spans: typing.Sequence[ReadableSpan]) -> SpanExportResult:
-            for span in spans:
-                formatted_span = self.formatter(span)
-                span_dict = json.loads(formatted_span)
-                name = span_dict.get("name", "")
-                print(name, span_dict)
-            return SpanExportResult.SUCCESS
 
-    resource = Resource.create(attributes={SERVICE_NAME: service_name})
+def instrument(
+    service_name: str = "default",
+    sample_rate: float = TRACE_SAMPLE_RATE,
+    trace_file: str | None = None,
+) -> tracing.TraceRingBuffer:
+    """Trace agent runs into the in-memory ring buffer served at /debug/traces."""
+    global trace_buffer
 
-    provider = TracerProvider(resource=resource)
-    trace.set_tracer_provider(provider)
+    import tracing  # noqa: PLC0415 - the OpenTelemetry SDK is only loaded when tracing is turned on
 
-    print("Enabling local LLM prompt logging to console")
-    provider.add_span_processor(BatchSpanProcessor(CustomConsoleSpanExporter()))
-    provider._disabled = False  # type: ignore[attr-defined]
+    logger.info(f"Tracing enabled (sample rate {sample_rate}, OTLP file {trace_file or 'off'})")
+    trace_buffer = tracing.install(service_name, sample_rate, trace_file)
 
     Agent.instrument_all(InstrumentationSettings(version=3))
+    return trace_buffer
 
 
-if DEBUG:  # pragma: no cover
-    instrument()
+if DEBUG or os.environ.get("AGUI_TRACING"):  # pragma: no cover
+    instrument(trace_file=os.environ.get("AGUI_TRACE_FILE"))
@@ -0,0 +1 @@
+"""Benchmarks for the agent server (run from the python/ directory)."""
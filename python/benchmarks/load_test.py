@@ -0,0 +1,361 @@
+"""Load test: how many concurrent sessions can one agent server process handle?
+
+Opens N /events streams, then drives /agent turns on every session at once against
+stand-in models that stream tokens at a configurable rate and latency. Reports
+sessions per process, events/sec, time-to-first-byte percentiles and RSS per session
+as JSON, so results can be compared between commits. RSS per session is measured
+with the sessions connected but idle; the peak while turns run is reported apart,
+since it includes each run's transient allocations.
+
+    uv run python -m benchmarks.load_test --sessions 10,50,100 --output load.json
+    uv run python -m benchmarks.load_test --mode uvicorn --sessions 200
+
+--mode inprocess serves the app from this process (client load shares the CPU);
+--mode uvicorn starts a separate server process and measures only its memory.
+--replay serves a model recording (see AGUI_RECORD_FILE in agent_server) instead of
+the synthetic stand-in streams, with --replay-time-scale compressing its timing.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing
+from dataclasses import asdict, dataclass, field
+from uuid import uuid4
+
+import httpx
+import uvicorn
+from pydantic_ai.messages import ModelMessage, ModelResponse, TextPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+import agent_server
+
+
+@dataclass
+class LoadConfig:
+    sessions: list[int] = field(default_factory=lambda: [10, 50])
+    turns: int = 3
+    tokens: int = 50  # tokens per model response
+    token_rate: float = 200.0  # tokens/sec streamed by the stand-in model (0: all at once)
+    latency: float = 0.2  # seconds before the stand-in model's first token
+    mode: typing.Literal["inprocess", "uvicorn"] = "inprocess"
+    replay: str | None = None  # model recording to serve instead of the stand-in model
+    replay_time_scale: float = 1.0
+    connect_timeout: float = 30.0
+
+
+@dataclass
+class LoadResult:
+    sessions: int
+    connected: int = 0
+    errors: int = 0
+    turns: int = 0
+    duration_s: float = 0.0
+    events: int = 0
+    events_per_sec: float = 0.0
+    ttfb_ms: dict[str, float] = field(default_factory=dict)
+    rss_baseline_mb: float = 0.0
+    rss_idle_mb: float = 0.0  # sessions connected, before any turns
+    rss_peak_mb: float = 0.0  # while turns run
+    rss_settled_mb: float = 0.0  # sessions still connected, after their turns
+    rss_per_session_kb: float = 0.0  # from rss_idle_mb
+    rss_active_per_session_kb: float = 0.0  # from rss_peak_mb
+
+
+def stand_in_model(tokens: int, token_rate: float, latency: float) -> FunctionModel:
+    """A model that answers after latency seconds, streaming tokens at token_rate."""
+
+    async def stream(messages: list[ModelMessage], info: AgentInfo) -> typing.AsyncIterator[str]:
+        await asyncio.sleep(latency)
+        for i in range(tokens):
+            if token_rate:
+                await asyncio.sleep(1 / token_rate)
+            yield f"tok{i} "
+
+    async def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(latency + (tokens / token_rate if token_rate else 0))
+        return ModelResponse(parts=[TextPart("".join(f"tok{i} " for i in range(tokens)))])
+
+    return FunctionModel(respond, stream_function=stream, model_name="load-test")
+
+
+def install_stand_in_model(config: LoadConfig) -> None:
+    """Make every new session's agent use the stand-in (or replayed) model."""
+    if config.replay:
+        model = agent_server.ModelReplayer.load(config.replay, config.replay_time_scale).as_model()
+    else:
+        model = stand_in_model(config.tokens, config.token_rate, config.latency)
+    agent_server.MODEL_BACKENDS[:] = [model]
+    agent_server.FAST_MODEL = None
+    # Per-request info logs would dominate the profile at this volume
+    agent_server.logger.setLevel(logging.WARNING)
+
+
+def rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    # macOS and other systems without procfs
+    result = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        # The process has already exited
+        return 0.0
+    return int(result.stdout.strip() or 0) / 1024
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_input(thread_id: str, prompt: str) -> dict[str, typing.Any]:
+    return {
+        "threadId": thread_id,
+        "runId": str(uuid4()),
+        "state": {},
+        "messages": [{"id": str(uuid4()), "role": "user", "content": prompt}],
+        "tools": [],
+        "context": [],
+        "forwardedProps": {},
+    }
+
+
+class Session:
+    """One simulated client: an open /events stream plus sequential /agent turns."""
+
+    def __init__(self, client: httpx.AsyncClient, result: LoadResult, ttfbs: list[float]):
+        self.client = client
+        self.result = result
+        self.ttfbs = ttfbs
+        self.agent_url: str | None = None
+        self.connected = asyncio.Event()
+        self.done = asyncio.Event()
+
+    async def hold_events(self) -> None:
+        """Keep /events open until done, counting what the server pushes."""
+        try:
+            async with self.client.stream("POST", "/events") as response:
+                lines = response.aiter_lines()
+                async for line in lines:
+                    if line.startswith("data:"):
+                        self.agent_url = json.loads(line[5:])["agent"]
+                        break
+                self.result.connected += 1
+                self.connected.set()
+                drain = asyncio.ensure_future(self._count(lines))
+                await self.done.wait()
+                drain.cancel()
+        except httpx.HTTPError:
+            self.result.errors += 1
+            self.connected.set()
+
+    async def _count(self, lines: typing.AsyncIterator[str]) -> None:
+        async for line in lines:
+            if line.startswith("data:"):
+                self.result.events += 1
+
+    async def run_turns(self, turns: int) -> None:
+        if self.agent_url is None:
+            return
+        thread_id = str(uuid4())
+        for turn in range(turns):
+            start = time.perf_counter()
+            first_byte = True
+            try:
+                async with self.client.stream(
+                    "POST", self.agent_url, json=run_input(thread_id, f"turn {turn}: tell me something")
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if first_byte:
+                            self.ttfbs.append(time.perf_counter() - start)
+                            first_byte = False
+                        if line.startswith("data:"):
+                            self.result.events += 1
+                self.result.turns += 1
+            except httpx.HTTPError:
+                self.result.errors += 1
+
+
+async def drive(base_url: str, server_pid: int, count: int, config: LoadConfig) -> LoadResult:
+    result = LoadResult(sessions=count)
+    ttfbs: list[float] = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        result.rss_baseline_mb = rss_mb(server_pid)
+        sessions = [Session(client, result, ttfbs) for _ in range(count)]
+        holders = [asyncio.ensure_future(session.hold_events()) for session in sessions]
+        await asyncio.wait_for(
+            asyncio.gather(*(session.connected.wait() for session in sessions)), config.connect_timeout
+        )
+        result.rss_idle_mb = rss_mb(server_pid)
+
+        peak = result.rss_idle_mb
+        start = time.perf_counter()
+        turns = asyncio.gather(*(session.run_turns(config.turns) for session in sessions))
+        while not turns.done():
+            await asyncio.wait({turns}, timeout=0.25)
+            peak = max(peak, rss_mb(server_pid))
+        result.duration_s = time.perf_counter() - start
+        result.rss_peak_mb = peak
+        result.rss_settled_mb = rss_mb(server_pid)
+
+        for session in sessions:
+            session.done.set()
+        await asyncio.gather(*holders)
+
+    result.events_per_sec = result.events / result.duration_s if result.duration_s else 0.0
+    result.ttfb_ms = {
+        "p50": percentile(ttfbs, 0.50) * 1000,
+        "p99": percentile(ttfbs, 0.99) * 1000,
+        "max": max(ttfbs, default=0.0) * 1000,
+    }
+    if result.connected:
+        result.rss_per_session_kb = (result.rss_idle_mb - result.rss_baseline_mb) * 1024 / result.connected
+        result.rss_active_per_session_kb = (result.rss_peak_mb - result.rss_baseline_mb) * 1024 / result.connected
+    return result
+
+
+async def wait_until_up(base_url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                await client.get("/metrics")
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+def run_inprocess(config: LoadConfig) -> list[LoadResult]:
+    """Serve from this process's main thread; the clients run on their own thread and loop."""
+    install_stand_in_model(config)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = uvicorn.Server(uvicorn.Config(agent_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    results: list[LoadResult] = []
+
+    def clients() -> None:
+        async def main() -> None:
+            await wait_until_up(base_url)
+            for count in config.sessions:
+                results.append(await drive(base_url, os.getpid(), count, config))
+
+        try:
+            asyncio.run(main())
+        finally:
+            server.should_exit = True
+
+    thread = threading.Thread(target=clients, name="load-clients")
+    thread.start()
+    server.run()
+    thread.join()
+    return results
+
+
+def run_uvicorn(config: LoadConfig) -> list[LoadResult]:
+    """Start a separate server process so its memory is measured on its own."""
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.load_test", "serve",
+        "--port", str(port),
+        "--tokens", str(config.tokens),
+        "--token-rate", str(config.token_rate),
+        "--latency", str(config.latency),
+        *(["--replay", config.replay, "--replay-time-scale", str(config.replay_time_scale)] if config.replay else []),
+    ])
+    try:
+        async def main() -> list[LoadResult]:
+            await wait_until_up(base_url)
+            return [await drive(base_url, server.pid, count, config) for count in config.sessions]
+
+        return asyncio.run(main())
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def serve(port: int, config: LoadConfig) -> None:
+    install_stand_in_model(config)
+    uvicorn.run(agent_server.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", choices=["run", "serve"], default="run")
+    parser.add_argument("--sessions", default="10,50", help="comma-separated session counts to test")
+    parser.add_argument("--turns", type=int, default=LoadConfig.turns)
+    parser.add_argument("--tokens", type=int, default=LoadConfig.tokens)
+    parser.add_argument("--token-rate", type=float, default=LoadConfig.token_rate)
+    parser.add_argument("--latency", type=float, default=LoadConfig.latency)
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default=LoadConfig.mode)
+    parser.add_argument("--replay", help="model recording (JSONL) to replay instead of the stand-in model")
+    parser.add_argument("--replay-time-scale", type=float, default=LoadConfig.replay_time_scale)
+    parser.add_argument("--port", type=int, default=0, help="port for the serve command")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    config = LoadConfig(
+        sessions=[int(n) for n in args.sessions.split(",")],
+        turns=args.turns,
+        tokens=args.tokens,
+        token_rate=args.token_rate,
+        latency=args.latency,
+        mode=args.mode,
+        replay=args.replay,
+        replay_time_scale=args.replay_time_scale,
+    )
+    if args.command == "serve":
+        serve(args.port, config)
+        return
+
+    results = run_inprocess(config) if config.mode == "inprocess" else run_uvicorn(config)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": asdict(config),
+        "results": [asdict(result) for result in results],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
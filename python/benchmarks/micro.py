@@ -0,0 +1,362 @@
+"""Micro-benchmarks for the agent server's hot paths, with regression gates.
+
+    uv run python -m benchmarks.micro run              # print timings
+    uv run python -m benchmarks.micro save             # store them as the baseline
+    uv run python -m benchmarks.micro check            # exit 1 if anything regressed
+
+Each benchmark is timed as the best of several repeats (the least noisy estimate)
+and compared per call against benchmarks/baseline.json. Baselines are machine
+specific, so the file isn't committed: save one with the project's Python on the
+machine that runs check. check warns when the baseline came from a different
+interpreter or platform.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import platform
+import subprocess
+import sys
+import time
+import typing
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+
+import httpx
+from ag_ui.core.types import RunAgentInput, UserMessage
+from PIL import Image, ImageDraw, ImageFont
+from starlette.requests import Request
+
+import agent_server
+from benchmarks.load_test import free_port
+
+BASELINE_FILE = Path(__file__).parent / "baseline.json"
+SERVER_DIR = Path(__file__).parent.parent
+RECORDING = Path(__file__).parent.parent / "tests" / "recordings" / "arithmetic.jsonl"
+DEFAULT_THRESHOLD = 0.25  # fail when a benchmark is more than 25% slower than its baseline
+REPEATS = 5
+MIN_REPEAT_SECONDS = 0.2  # calls per repeat are scaled up until a repeat takes this long
+
+MB = 1024 * 1024
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Returns the function to time; setup work happens before timing starts
+    setup: Callable[[], Callable[[], typing.Any]]
+    # Work units per call, e.g. chunks streamed; results are reported per unit
+    units: int = 1
+    # Allowed slowdown for this benchmark, if noisier than DEFAULT_THRESHOLD allows
+    threshold: float | None = None
+
+
+BENCHMARKS: list[Benchmark] = []
+
+
+def benchmark(name: str, units: int = 1, threshold: float | None = None):
+    def register(setup: Callable[[], Callable[[], typing.Any]]) -> Callable[[], Callable[[], typing.Any]]:
+        BENCHMARKS.append(Benchmark(name, setup, units, threshold))
+        return setup
+
+    return register
+
+
+def _attachment_input(size: int, media_type: str) -> Callable[[], typing.Any]:
+    payload = base64.b64encode(b"x" * size).decode()
+    data_url = f"data:{media_type};base64,{payload}"
+
+    def run() -> None:
+        # process_attachments rewrites the message, so every call gets a fresh one
+        run_input = RunAgentInput(
+            thread_id="bench", run_id="bench", tools=[], context=[], forwarded_props=None,
+            state={"attachments": {"file": data_url}},
+            messages=[UserMessage(id="u", role="user", content="see attached")],
+        )
+        agent_server.process_attachments(run_input)
+
+    return run
+
+
+for _size in (1, 10, 50):
+    benchmark(f"process_attachments_text_{_size}mb")(lambda size=_size: _attachment_input(size * MB, "text/plain"))
+    benchmark(f"process_attachments_binary_{_size}mb")(lambda size=_size: _attachment_input(size * MB, "image/png"))
+
+
+@benchmark("read_run_input_binary_50mb")
+def _read_run_input() -> Callable[[], typing.Any]:
+    """Streaming POST /agent body parsing, with the attachment spooled, then processed."""
+    data_url = "data:image/png;base64," + base64.b64encode(b"x" * 50 * MB).decode()
+    body = json.dumps({
+        "threadId": "bench", "runId": "bench", "tools": [], "context": [], "forwardedProps": None,
+        "state": {"attachments": {"image.png": data_url}},
+        "messages": [{"id": "u", "role": "user", "content": "see attached"}],
+    }).encode()
+    chunk_size = 64 * 1024  # what uvicorn hands over per receive()
+
+    async def parse() -> None:
+        messages = [
+            {"type": "http.request", "body": body[i:i + chunk_size], "more_body": i + chunk_size < len(body)}
+            for i in range(0, len(body), chunk_size)
+        ]
+
+        async def receive() -> dict[str, typing.Any]:
+            return messages.pop(0)
+
+        request = Request({"type": "http", "method": "POST", "path": "/agent", "headers": []}, receive)
+        run_input = await agent_server.read_run_input(request)
+        for data_url in agent_server.process_attachments(run_input).values():
+            if isinstance(data_url, agent_server.SpooledString):
+                data_url.close()
+
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(parse())
+
+
+@benchmark("parse_data_url_small")
+def _parse_small() -> Callable[[], typing.Any]:
+    data_url = "data:text/plain;base64," + base64.b64encode(b"hello world").decode()
+    return lambda: agent_server.parse_data_url(data_url)
+
+
+@benchmark("parse_data_url_10mb")
+def _parse_large() -> Callable[[], typing.Any]:
+    data_url = "data:image/png;base64," + base64.b64encode(b"x" * 10 * MB).decode()
+    return lambda: agent_server.parse_data_url(data_url)
+
+
+@benchmark("tool_schema_to_a2ui_all_tools")
+def _a2ui() -> Callable[[], typing.Any]:
+    tools = list(agent_server.toolset.tools.items())
+    return lambda: [agent_server.tool_schema_to_a2ui(name, tool) for name, tool in tools]
+
+
+STREAM_CHUNKS = 1_000
+BROADCAST_SESSIONS = 1_000
+
+
+@benchmark("stream_agent_response_per_chunk", units=STREAM_CHUNKS)
+def _stream() -> Callable[[], typing.Any]:
+    """Overhead stream_agent_response adds per chunk, fed pre-rendered run_ag_ui output."""
+    delta = json.dumps({"type": "TEXT_MESSAGE_CONTENT", "messageId": "m", "delta": "token "})
+    chunks = [
+        'data: {"type":"RUN_STARTED","threadId":"bench","runId":"bench"}\n\n',
+        *[f"data: {delta}\n\n" for _ in range(STREAM_CHUNKS - 2)],
+        'data: {"type":"RUN_FINISHED","threadId":"bench","runId":"bench"}\n\n',
+    ]
+    agent = agent_server.create_agent(agent_server.ModelRouter(["test"]))
+    run_input = RunAgentInput(
+        thread_id="bench", run_id="bench", state={}, tools=[], context=[], forwarded_props=None,
+        messages=[UserMessage(id="u", role="user", content="hi"), UserMessage(id="u2", role="user", content="again")],
+    )
+    loop = asyncio.new_event_loop()
+
+    async def pre_rendered() -> typing.AsyncIterator[str]:
+        for chunk in chunks:
+            yield chunk
+
+    async def consume() -> None:
+        state = {"ag_ui_events": pre_rendered()}
+        async for _ in agent_server.stream_agent_response(
+            "bench", run_input, agent, agent_server.StateDeps(agent_server.Dependencies()), None, {}, state
+        ):
+            pass
+
+    return lambda: loop.run_until_complete(consume())
+
+
+@benchmark("broadcast_1000_sessions", units=BROADCAST_SESSIONS)
+def _broadcast() -> Callable[[], typing.Any]:
+    """Fanning a tools_changed-sized event out to every /events queue, per session."""
+    event = {"type": "CUSTOM", "name": "tools_changed", "value": {"available_tools": agent_server.available_tools()}}
+    broker = agent_server.EventBroker()
+    queues = [asyncio.Queue() for _ in range(BROADCAST_SESSIONS)]
+    agent_server.sessions.update({
+        f"bench-{i}": agent_server.Session(agent=None, queue=queue)  # type: ignore[arg-type]
+        for i, queue in enumerate(queues)
+    })
+
+    def broadcast() -> None:
+        broker.broadcast(event)
+        for queue in queues:
+            queue.get_nowait()
+
+    return broadcast
+
+
+@benchmark("agent_run_replayed")
+def _replayed_run() -> Callable[[], typing.Any]:
+    """A whole run through run_ag_ui with a recorded model stream, replayed without delays."""
+    replayer = agent_server.ModelReplayer.load(RECORDING, time_scale=0)
+    agent = agent_server.create_agent(agent_server.ModelRouter([replayer.as_model()]))
+    loop = asyncio.new_event_loop()
+
+    async def consume() -> None:
+        run_input = RunAgentInput(
+            thread_id="bench", run_id="bench", state={}, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id="u", role="user", content="Hello!")],
+        )
+        async for _ in agent_server.stream_agent_response(
+            "bench", run_input, agent, agent_server.StateDeps(agent_server.Dependencies()), None, {}, {}
+        ):
+            pass
+
+    return lambda: loop.run_until_complete(consume())
+
+
+@benchmark("draw_meme_text")
+def _draw() -> Callable[[], typing.Any]:
+    img = Image.open(agent_server.DOGE_TEMPLATE).copy()
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.truetype(agent_server.IMPACT_FONT, img.size[0] // 12)
+    return lambda: agent_server._draw_meme_text(draw, "such benchmark", 20, img.size[0], font)
+
+
+@benchmark("render_meme")
+def _render() -> Callable[[], typing.Any]:
+    def run() -> None:
+        agent_server.render_meme("benchmark", "much fast", "wow").unlink()
+
+    return run
+
+
+@benchmark("evaluate_expression")
+def _evaluate() -> Callable[[], typing.Any]:
+    agent_server.expression_pool.start()
+    return lambda: agent_server.evaluate_expression("2 + 3 * (7 - 4) / 5")
+
+
+@benchmark("evaluate_expression_batch_1000_rows", units=1_000)
+def _evaluate_batch() -> Callable[[], typing.Any]:
+    agent_server.expression_pool.start()
+    rows = [{"price": i * 0.5, "qty": float(i % 7), "tax": 0.2} for i in range(1_000)]
+    return lambda: agent_server.evaluate_expression_batch("price * qty * (1 + tax)", rows)
+
+
+@benchmark("startup_import", threshold=0.5)
+def _startup_import() -> Callable[[], typing.Any]:
+    """Importing agent_server in a fresh interpreter (interpreter startup included)."""
+    command = [sys.executable, "-c", "import agent_server"]
+    return lambda: subprocess.run(command, cwd=SERVER_DIR, check=True, capture_output=True)
+
+
+@benchmark("startup_time_to_ready", threshold=0.5)
+def _startup_ready() -> Callable[[], typing.Any]:
+    """From launching uvicorn until the app answers requests."""
+
+    def run() -> None:
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "agent_server:app", "--port", str(port), "--log-level", "warning"],
+            cwd=SERVER_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                try:
+                    httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+                    return
+                except httpx.TransportError:
+                    if server.poll() is not None:
+                        raise RuntimeError("agent server exited during startup") from None
+                    time.sleep(0.005)
+        finally:
+            server.terminate()
+            server.wait()
+
+    return run
+
+
+def time_benchmark(bench: Benchmark) -> dict[str, float]:
+    """Seconds per unit: best and median over REPEATS repeats."""
+    func = bench.setup()
+    func()  # warm up caches, pools and lazy imports
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_REPEAT_SECONDS or calls >= 1_000_000:
+            break
+        calls *= 10 if elapsed < MIN_REPEAT_SECONDS / 10 else 2
+    samples = [elapsed]
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        samples.append(time.perf_counter() - start)
+    per_unit = sorted(sample / calls / bench.units for sample in samples)
+    return {"best": per_unit[0], "median": per_unit[len(per_unit) // 2], "calls": calls}
+
+
+def run(selected: str | None = None) -> dict[str, dict[str, float]]:
+    results = {}
+    for bench in BENCHMARKS:
+        if selected and selected not in bench.name:
+            continue
+        results[bench.name] = time_benchmark(bench)
+        if bench.threshold is not None:
+            results[bench.name]["threshold"] = bench.threshold
+        print(f"{bench.name:45} {results[bench.name]['best'] * 1e6:12.2f} us", file=sys.stderr)
+    agent_server.expression_pool.close()
+    return results
+
+
+def check(results: dict[str, dict[str, float]], baseline: dict[str, typing.Any], threshold: float) -> list[str]:
+    """Names of benchmarks slower than their baseline by more than the threshold."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        limit = base["best"] * (1 + base.get("threshold", threshold))
+        ratio = result["best"] / base["best"]
+        status = "REGRESSED" if result["best"] > limit else "ok"
+        print(f"{name:45} {ratio:6.2f}x baseline  {status}", file=sys.stderr)
+        if result["best"] > limit:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["run", "save", "check"], nargs="?", default="run")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--output", type=Path, help="also write the results here as JSON")
+    args = parser.parse_args(argv)
+    if args.command == "check" and not args.baseline.exists():
+        parser.error(f"no baseline at {args.baseline}; record one on this machine with `make bench-baseline`")
+
+    results = run(args.filter)
+    report = {"python": platform.python_version(), "platform": platform.platform(), "benchmarks": results}
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+
+    if args.command == "save":
+        previous = json.loads(args.baseline.read_text())["benchmarks"] if args.baseline.exists() else {}
+        # Benchmarks skipped by --filter keep their old baseline
+        report["benchmarks"] = {**previous, **results}
+        args.baseline.write_text(json.dumps(report, indent=2) + "\n")
+    elif args.command == "check":
+        baseline = json.loads(args.baseline.read_text())
+        for key in ("python", "platform"):
+            if baseline.get(key) != report[key]:
+                print(f"Warning: baseline was saved on {key} {baseline.get(key)}, this is {report[key]}",
+                      file=sys.stderr)
+        regressions = check(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
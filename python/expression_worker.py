@@ -0,0 +1,188 @@
+"""Worker process for sandboxed expression evaluation.
+
+Kept separate from agent_server so spawned workers only import simpleeval
+and NumPy (for batch evaluation).
+"""
+
+import ast
+import functools
+import operator
+import resource
+import typing
+from multiprocessing.connection import Connection
+
+import numpy as np
+from simpleeval import DEFAULT_NAMES, MAX_POWER, InvalidExpression, SimpleEval
+
+PARSE_CACHE_SIZE = 256
+
+# Integers up to this magnitude are represented exactly by float64
+_EXACT_INT_LIMIT = 2**53
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(expression: str) -> typing.Any:
+    """Parse an expression once; repeated expressions reuse the cached tree."""
+    return SimpleEval.parse(expression)
+
+
+def evaluate(expression: str, names: dict[str, typing.Any] | None = None) -> str:
+    """Evaluate an expression with simpleeval and format the result for the model."""
+    try:
+        evaluator = SimpleEval(names={**DEFAULT_NAMES, **(names or {})})
+        result = evaluator.eval(expression, previously_parsed=parse(expression))
+        return str(result)
+    except ZeroDivisionError:
+        return str(float("inf"))
+    except Exception as e:
+        return f"Error evaluating expression: {str(e)}"
+
+
+# Operators the vectorized path supports, and whether they keep integers exact
+_BINARY_OPS: dict[type[ast.operator], tuple[typing.Callable[[typing.Any, typing.Any], typing.Any], bool]] = {
+    ast.Add: (operator.add, True),
+    ast.Sub: (operator.sub, True),
+    ast.Mult: (operator.mul, True),
+    ast.Mod: (operator.mod, True),
+    ast.Div: (operator.truediv, False),
+    ast.Pow: (operator.pow, False),
+}
+_UNARY_OPS: dict[type[ast.unaryop], typing.Callable[[typing.Any], typing.Any]] = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+def _is_number(value: typing.Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _vectorizable(node: ast.AST, names: set[str], integer_mode: bool) -> bool:
+    """True if node is plain arithmetic over the given names that NumPy reproduces exactly."""
+    if isinstance(node, ast.Expr):
+        return _vectorizable(node.value, names, integer_mode)
+    if isinstance(node, ast.Constant):
+        return _is_number(node.value) and (not integer_mode or isinstance(node.value, int))
+    if isinstance(node, ast.Name):
+        return node.id in names
+    if isinstance(node, ast.UnaryOp):
+        return type(node.op) in _UNARY_OPS and _vectorizable(node.operand, names, integer_mode)
+    if isinstance(node, ast.BinOp):
+        op = _BINARY_OPS.get(type(node.op))
+        if op is None or (integer_mode and not op[1]):
+            return False
+        return _vectorizable(node.left, names, integer_mode) and _vectorizable(node.right, names, integer_mode)
+    return False
+
+
+def _eval_array(node: ast.AST, columns: dict[str, typing.Any], unsafe: typing.Any, integer_mode: bool) -> typing.Any:
+    """Evaluate an arithmetic tree over NumPy columns; rows simpleeval would reject are flagged in unsafe.
+
+    Every intermediate value is checked, not just the result: an overflow or a rounded
+    integer part way through can still produce a plausible looking final value.
+    """
+    if isinstance(node, ast.Expr):
+        return _eval_array(node.value, columns, unsafe, integer_mode)
+    if isinstance(node, ast.Constant):
+        return np.float64(node.value)
+    if isinstance(node, ast.Name):
+        return columns[node.id]
+    if isinstance(node, ast.UnaryOp):
+        return _UNARY_OPS[type(node.op)](_eval_array(node.operand, columns, unsafe, integer_mode))
+    assert isinstance(node, ast.BinOp)
+    left = _eval_array(node.left, columns, unsafe, integer_mode)
+    right = _eval_array(node.right, columns, unsafe, integer_mode)
+    if isinstance(node.op, ast.Pow):
+        # Mirror simpleeval's safe_power limits
+        unsafe |= (np.abs(left) > MAX_POWER) | (np.abs(right) > MAX_POWER)
+    value = _BINARY_OPS[type(node.op)][0](left, right)
+    unsafe |= ~np.isfinite(value)
+    if integer_mode:
+        unsafe |= np.abs(value) >= _EXACT_INT_LIMIT
+    return value
+
+
+def _evaluate_vectorized(expression: str, rows: list[dict[str, typing.Any]]) -> list[str | None] | None:
+    """Evaluate all rows at once with NumPy, or return None if the expression isn't eligible.
+
+    Rows whose result NumPy can't reproduce exactly (errors, overflow, inexact integers)
+    are returned as None so the caller evaluates them one by one.
+    """
+    if not rows:
+        return None
+    keys = set(rows[0])
+    if any(set(row) != keys or not all(_is_number(v) for v in row.values()) for row in rows):
+        return None
+    values = [v for row in rows for v in row.values()]
+    if all(isinstance(v, int) for v in values):
+        integer_mode = True
+    elif all(isinstance(v, float) for v in values):
+        integer_mode = False
+    else:
+        return None
+    if integer_mode and any(abs(v) >= _EXACT_INT_LIMIT for v in values):
+        return None
+    try:
+        tree = parse(expression)
+    except (SyntaxError, ValueError, RecursionError, InvalidExpression):
+        # Let the per-row path report the error in simpleeval's words
+        return None
+    if not _vectorizable(tree, keys, integer_mode):
+        return None
+    if not any(isinstance(node, ast.Name) for node in ast.walk(tree)):
+        # Constant expressions keep Python's int/float result type, which NumPy would lose
+        return None
+
+    columns = {key: np.array([row[key] for row in rows], dtype=np.float64) for key in keys}
+    unsafe = np.zeros(len(rows), dtype=bool)
+    with np.errstate(all="ignore"):
+        result = np.broadcast_to(_eval_array(tree, columns, unsafe, integer_mode), (len(rows),))
+    return [
+        None if bad else str(int(value)) if integer_mode else str(float(value))
+        for value, bad in zip(result.tolist(), unsafe.tolist())
+    ]
+
+
+def evaluate_batch(expression: str, rows: list[dict[str, typing.Any]]) -> list[str]:
+    """Evaluate one expression for each row of variable bindings."""
+    results = _evaluate_vectorized(expression, rows) or [None] * len(rows)
+    return [
+        result if result is not None else evaluate(expression, row)
+        for result, row in zip(results, rows)
+    ]
+
+
+def _cpu_seconds_used() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _set_limit(limit: int, soft: int) -> None:
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    try:
+        resource.setrlimit(limit, (soft, hard))
+    except (ValueError, OSError):
+        # Not every platform supports every limit (e.g. RLIMIT_AS on macOS)
+        pass
+
+
+def serve(conn: Connection, cpu_seconds: int, memory_bytes: int | None) -> None:
+    """Handle ("eval", expression) and ("batch", expression, rows) requests until conn is closed.
+
+    Each call may use at most cpu_seconds of CPU time; exceeding it raises SIGXCPU,
+    which kills the worker so the pool replaces it.
+    """
+    if memory_bytes:
+        _set_limit(resource.RLIMIT_AS, memory_bytes)
+    while True:
+        try:
+            request: typing.Any = conn.recv()
+        except EOFError:
+            return
+        _set_limit(resource.RLIMIT_CPU, int(_cpu_seconds_used()) + 1 + cpu_seconds)
+        if request[0] == "batch":
+            conn.send(evaluate_batch(request[1], request[2]))
+        else:
+            conn.send(evaluate(request[1]))
@@ -2,23 +2,47 @@ import pytest
 import base64
 import json
 import asyncio
+import math
 import signal
+import threading
+import concurrent.futures
 from unittest.mock import MagicMock, Mock, patch, AsyncMock
 from pathlib import Path
-from fastapi import FastAPI, HTTPException
+from uuid import uuid4
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.testclient import TestClient
-from pydantic_ai.messages import ModelMessage, ModelRequest, UserPromptPart, ToolCallPart
-from pydantic_ai import DeferredToolRequests
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, TextPart, UserPromptPart, ToolCallPart, BinaryContent, ThinkingPart, ToolReturnPart
+from pydantic_ai import Agent, DeferredToolRequests
+from pydantic_ai.models import ModelRequestParameters
+from pydantic_ai.models.function import DeltaToolCall, FunctionModel, DeltaThinkingPart
 from pydantic_ai.models.test import TestModel
-from ag_ui.core.types import RunAgentInput, TextInputContent, BinaryInputContent
+from pydantic_ai.usage import RequestUsage
+from ag_ui.core.types import (
+    RunAgentInput, TextInputContent, BinaryInputContent,
+    AssistantMessage, SystemMessage, UserMessage, ToolMessage, ToolCall, FunctionCall, Tool, Context,
+)
 from agent_server import (
     parse_data_url, evaluate_expression, dangerous_tool, 
     process_text_attachment, process_binary_attachment, 
     tool_schema_to_a2ui, make_meme, create_agent, make_injector_stream_fn,
     Session, sessions, ping_all_sessions, lifespan, app, generated_memes,
     process_attachments, stream_agent_response, Dependencies, StateDeps,
-    agent_run, instrument
+    agent_run, instrument, ModelRouter, LatencyTracker, model_latency,
+    compact_history, pending_summaries, context_token_budget, estimate_message_tokens,
+    DEFAULT_CONTEXT_TOKEN_BUDGET, ToolSelector, select_tools, toolset,
+    ResponseCache, is_cacheable_run, response_cache_key, ExpressionWorkerPool,
+    evaluate_expression_batch, BATCH_MAX_ROWS, ToolResultCache, ServerToolset,
+    with_tool_progress, RUN_OUTPUT_QUEUE_SIZE,
+    profiles, EventLoopSampler, ToolExecutor, ToolExecution, ToolRunner, ToolOverloaded, inline_tool_executor, tool_executors,
+    ModelRecorder, ModelRecording, ModelReplayer,
+    SpooledString, read_run_input, attachments_event_chunks,
+    estimate_size, enforce_session_memory, session_memory, PausedRun, RunStats,
+    Drainer, drainer, DRAIN_RETRY_AFTER,
+    EventBroker, toolset_changed, available_tools, traced_run, is_deterministic_expression,
 )
+import agent_server
+import expression_worker
 
 client = TestClient(app)
 
@@ -26,20 +50,135 @@ import sys
 
 def test_instrument():
     from agent_server import instrument
-    # We call instrument to set up the provider
-    instrument("test_service")
+    # We call instrument to set up the provider, keeping every trace
+    buffer = instrument("test_service", sample_rate=1.0)
     
     from opentelemetry import trace
     tracer = trace.get_tracer("test_tracer")
     
-    # Create a span to ensure CustomConsoleSpanExporter.export is called
     with tracer.start_as_current_span("test_span"):
+        with tracer.start_as_current_span("child_span"):
+            pass
+
+    record = buffer.find(limit=1)[0]
+    assert [span.name for span in record.spans] == ["child_span", "test_span"]
+    assert record.reason == "sampled"
+
+def test_trace_ring_buffer_tail_sampling_and_otlp_export(tmp_path):
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.trace import Status, StatusCode
+
+    trace_file = tmp_path / "traces.jsonl"
+    buffer = TraceRingBuffer(sample_rate=0.0, slow_seconds=60, exporter=OTLPJsonFileExporter(trace_file))
+    provider = TracerProvider()
+    provider.add_span_processor(buffer)
+    tracer = provider.get_tracer("test")
+
+    with tracer.start_as_current_span("agui.run", attributes={"agui.session": "tok-0123456789", "agui.run_id": "run-ok"}):
         pass
-        
-    # Force flush to process the batch and call export()
-    provider = trace.get_tracer_provider()
-    if hasattr(provider, "force_flush"):
-        provider.force_flush()  # type: ignore[attr-defined]
+    with tracer.start_as_current_span("agui.run", attributes={"agui.session": "tok-0123456789", "agui.run_id": "run-bad"}):
+        with tracer.start_as_current_span("tool") as span:
+            span.set_status(Status(StatusCode.ERROR))
+    provider.shutdown()
+
+    # Not head-sampled and fast, so only the failed run is kept
+    assert buffer.dropped == 1
+    [record] = buffer.find(session="tok-0123456789")
+    assert buffer.find(session="tok-0123") == [record]
+    assert record.session == "tok-0123"
+    assert record.reason == "error"
+    assert record.run_id == "run-bad"
+    assert buffer.find(run_id="run-ok") == []
+    assert not buffer.open
+
+    [line] = trace_file.read_text().splitlines()
+    spans = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert [s["name"] for s in spans] == ["tool", "agui.run"]
+    assert spans[0]["parentSpanId"] == spans[1]["spanId"]
+    assert spans[0]["status"]["code"] == 2
+
+def test_debug_traces_endpoint():
+    buffer = TraceRingBuffer()
+    with patch("agent_server.trace_buffer", buffer):
+        # Other sessions' traces need DEBUG or the admin token
+        assert client.get("/debug/traces?token=abc").status_code == 403
+        with patch("agent_server.ADMIN_TOKEN", "admin-secret"):
+            assert client.get("/debug/traces", headers={"Authorization": "Bearer wrong"}).status_code == 403
+            response = client.get("/debug/traces?token=abc", headers={"Authorization": "Bearer admin-secret"})
+            assert response.json() == {"traces": [], "open": 0, "dropped": 0}
+    with patch("agent_server.trace_buffer", None), patch("agent_server.DEBUG", True):
+        assert client.get("/debug/traces").status_code == 404
+
+@pytest.mark.asyncio
+async def test_traced_run_tags_spans_with_the_token_prefix_only():
+    from opentelemetry.sdk.trace import TracerProvider
+
+    buffer = TraceRingBuffer(sample_rate=1.0)
+    provider = TracerProvider()
+    provider.add_span_processor(buffer)
+    run_input = RunAgentInput(
+        thread_id="thread", run_id="run-1", state={}, tools=[], context=[], forwarded_props=None, messages=[],
+    )
+
+    async def chunks():
+        yield "data: {}\n\n"
+
+    token = "secret-token-0123456789"
+    with patch("agent_server.tracer", provider.get_tracer("test")):
+        assert [chunk async for chunk in traced_run(chunks(), token, run_input)] == ["data: {}\n\n"]
+    # A session reads its own traces with its token
+    sessions[token] = Session(agent=MagicMock(), queue=asyncio.Queue())
+    try:
+        with patch("agent_server.trace_buffer", buffer):
+            [found] = client.get(f"/debug/traces?token={token}").json()["traces"]
+    finally:
+        del sessions[token]
+    assert found["session"] == token[:8]
+    assert found["spans"][0]["attributes"]["agui.session"] == token[:8]
+    assert token not in json.dumps(found)
+
+def test_log_records_carry_session_and_run_and_drop_when_queue_is_full():
+    import logging
+    import queue
+
+    log_queue: queue.Queue = queue.Queue(maxsize=2)
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    test_logger = logging.getLogger("agent_server.test_logging")
+    test_logger.propagate = False
+    test_logger.addHandler(handler)
+    try:
+        async def in_run():
+            current_session_token.set("tok-0123456789")
+            current_run_id.set("run-1")
+            try:
+                raise ValueError("bad")
+            except ValueError:
+                test_logger.exception("failed %s", "tool")
+
+        asyncio.run(in_run())
+        test_logger.warning("outside a run")
+        test_logger.warning("no room left")
+    finally:
+        test_logger.removeHandler(handler)
+
+    assert handler.dropped == 1
+    in_run_entry = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert in_run_entry["message"] == "failed tool"
+    assert (in_run_entry["session"], in_run_entry["run_id"]) == ("tok-0123", "run-1")
+    assert "ValueError: bad" in in_run_entry["exception"]
+    outside_entry = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert outside_entry["level"] == "WARNING"
+    assert "session" not in outside_entry
+
+def test_parse_log_levels():
+    import logging
+    assert parse_log_levels("agent_server=info, pydantic_ai=DEBUG,") == {
+        "agent_server": logging.INFO, "pydantic_ai": logging.DEBUG,
+    }
+    assert parse_log_levels("") == {}
+    with pytest.raises(ValueError, match="AGUI_LOG_LEVELS"):
+        parse_log_levels("agent_server=LOUD")
 
 @pytest.mark.asyncio
 async def test_agent_run_on_complete_callback():
@@ -50,7 +189,9 @@ async def test_agent_run_on_complete_callback():
 
     request = MagicMock(spec=Request)
     run_input = MagicMock(spec=RunAgentInput)
+    run_input.run_id = "run"
     run_input.state = None
+    run_input.thread_id = "thread"
     
     callback_executed = False
 
@@ -121,6 +262,7 @@ async def test_agent_run_cancel_task():
     
     request = MagicMock(spec=Request)
     run_input = MagicMock(spec=RunAgentInput)
+    run_input.run_id = "run"
     run_input.state = None
     
     with patch("agent_server.stream_agent_response") as mock_stream:
@@ -150,6 +292,7 @@ async def test_agent_run_manual_call():
     
     request = MagicMock(spec=Request)
     run_input = MagicMock(spec=RunAgentInput)
+    run_input.run_id = "run"
     run_input.state = {
         "manual_tool_call": {
             "name": "evaluate_expression",
@@ -182,6 +325,7 @@ async def test_agent_run_generator_exit():
     
     request = MagicMock(spec=Request)
     run_input = MagicMock(spec=RunAgentInput)
+    run_input.run_id = "run"
     run_input.state = None
     
     state_dict = {}
@@ -226,6 +370,8 @@ async def test_stream_agent_response():
     
     text_data = base64.b64encode(b"Attachment data").decode("utf-8")
     run_input = MagicMock(spec=RunAgentInput)
+    run_input.thread_id = "thread"
+    run_input.run_id = "run"
     run_input.messages = [mock_msg]
     run_input.state = {
         "deferred_tool_approvals": {"tool1": True},
@@ -277,11 +423,15 @@ async def test_stream_agent_response():
         assert '"name": "deferred_tool_requests"' in deferred_chunk
         assert "tool2" in deferred_chunk
         
-        # 5. RUN_FINISHED
+        # 5. CustomEvent: run_stats
+        stats_chunk = await anext(gen)
+        assert '"name": "run_stats"' in stats_chunk
+        
+        # 6. RUN_FINISHED
         finished_chunk = await anext(gen)
         assert "RUN_FINISHED" in finished_chunk
         
-        # 6. OTHER
+        # 7. OTHER
         other_chunk = await anext(gen)
         assert "OTHER" in other_chunk
         
@@ -372,16 +522,124 @@ def test_process_attachments_no_messages():
     result = process_attachments(run_input)
     assert result == {}
 
+def _body_request(body: bytes, chunk_size: int, headers: dict[str, str] | None = None) -> Request:
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1} for i, c in enumerate(chunks)]
+
+    async def receive():
+        return messages.pop(0)
+
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({"type": "http", "method": "POST", "path": "/agent", "headers": raw_headers}, receive)
+
+def _attachment_body(attachments: dict[str, str], content: str = "see attached") -> bytes:
+    return json.dumps({
+        "threadId": "t", "runId": "r", "tools": [], "context": [], "forwardedProps": None,
+        "state": {"attachments": attachments},
+        "messages": [{"id": "u", "role": "user", "content": content}],
+    }).encode()
+
+@pytest.mark.asyncio
+async def test_read_run_input_spools_large_attachments():
+    text = "line with \"quotes\" and \\ slashes é\n" * 2_000
+    text_url = "data:text/plain;base64," + base64.b64encode(text.encode()).decode()
+    image_url = "data:image/png;base64," + base64.b64encode(b"\x89PNG" * 100_000).decode()
+    long_prompt = "é\"" * 40_000
+    body = _attachment_body({"notes.txt": text_url, "image.png": image_url, "small.txt": "data:text/plain;base64,WA=="}, long_prompt)
+
+    with patch("agent_server.SPOOL_THRESHOLD", 1_000):
+        run_input = await read_run_input(_body_request(body, chunk_size=777))
+
+    attachments = run_input.state["attachments"]
+    assert isinstance(attachments["notes.txt"], SpooledString)
+    assert isinstance(attachments["image.png"], SpooledString)
+    assert attachments["small.txt"] == "data:text/plain;base64,WA=="
+    # Large strings outside state are restored as plain strings
+    assert run_input.messages[0].content == long_prompt
+
+    info = process_attachments(run_input)
+    content = run_input.messages[0].content
+    assert text in content[1].text
+    assert content[2].data == image_url.split(",", 1)[1]
+
+    event = "".join(attachments_event_chunks(info))
+    assert event.startswith("data: ") and event.endswith("\n\n")
+    assert json.loads(event[6:])["value"] == {"notes.txt": text_url, "image.png": image_url, "small.txt": "data:text/plain;base64,WA=="}
+    attachments["notes.txt"].close()
+    attachments["image.png"].close()
+
+@pytest.mark.asyncio
+async def test_read_run_input_rejects_oversized_bodies():
+    body = _attachment_body({"big.txt": "data:text/plain;base64," + "A" * 5_000})
+
+    with patch("agent_server.MAX_REQUEST_BYTES", 1_000):
+        # Rejected from Content-Length before the body is read
+        with pytest.raises(HTTPException) as excinfo:
+            await read_run_input(_body_request(body, 100, {"content-length": str(len(body))}))
+        assert excinfo.value.status_code == 413
+        # and while streaming when the length isn't declared
+        with pytest.raises(HTTPException) as excinfo:
+            await read_run_input(_body_request(body, 100))
+        assert excinfo.value.status_code == 413
+
+    with patch("agent_server.MAX_ATTACHMENT_BYTES", 2_000):
+        with pytest.raises(HTTPException) as excinfo:
+            await read_run_input(_body_request(body, 100))
+        assert excinfo.value.status_code == 413
+
+    response = client.post("/agent?token=missing", content=b'{"threadId": ', headers={"content-type": "application/json"})
+    assert response.status_code == 422
+
+    for declared in ("12abc", "-5"):
+        with pytest.raises(HTTPException) as excinfo:
+            await read_run_input(_body_request(body, 100, {"content-length": declared}))
+        assert excinfo.value.status_code == 400
+
+@pytest.mark.asyncio
+async def test_read_run_input_only_spools_attachments():
+    large = "x" * 5_000
+    body = json.dumps({
+        "threadId": "t", "runId": "r", "tools": [], "context": [], "forwardedProps": None,
+        "state": {
+            "attachments": {"a.txt": "data:text/plain;base64," + "QQ==" * 2_000, "forged.txt": "\x00spool:0"},
+            "manual_tool_call": {"name": "echo", "args": {"state": large}},
+        },
+        "messages": [{"id": "u", "role": "user", "content": "\x00spool:99"}],
+    }).encode()
+
+    with patch("agent_server.SPOOL_THRESHOLD", 1_000):
+        run_input = await read_run_input(_body_request(body, 700))
+
+    attachments = run_input.state["attachments"]
+    assert isinstance(attachments["a.txt"], SpooledString)
+    # Strings that look like placeholders are the client's own text
+    assert attachments["forged.txt"] == "\x00spool:0"
+    assert run_input.messages[0].content == "\x00spool:99"
+    # Large strings elsewhere in state stay serializable
+    assert run_input.state["manual_tool_call"]["args"]["state"] == large
+    json.dumps(run_input.state["manual_tool_call"])
+    attachments["a.txt"].close()
+
+@pytest.mark.asyncio
+async def test_read_run_input_turns_away_while_draining():
+    async def receive():
+        raise AssertionError("the body should not be read")
+
+    request = Request({"type": "http", "method": "POST", "path": "/agent", "headers": []}, receive)
+    with patch("agent_server.drainer.draining", True):
+        with pytest.raises(HTTPException) as excinfo:
+            await read_run_input(request)
+    assert excinfo.value.status_code == 503
+
 def test_serve_meme():
     # Test 404
     response = client.get("/memes/invalid_id")
     assert response.status_code == 404
     
     # Generate a real meme to test 200 OK
-    result_json = make_meme("test", "serve")
-    result = json.loads(result_json)
-    meme_id = result["meme_id"]
-    
+    meme_id = "servetst"
+    render_meme(meme_id, "test", "serve")
+
     try:
         # Test 200
         response = client.get(f"/memes/{meme_id}")
@@ -396,7 +654,13 @@ def test_serve_meme():
             del generated_memes[meme_id]
 
 from fastapi import Request
-from agent_server import events
+from agent_server import events, current_session_token, job_status, jobs, render_meme, serve_meme
+from agent_server import ToolProgress, ToolProgressStream, report_progress
+from agent_server import Counter, Gauge, Histogram, MetricsRegistry, run_duration, tool_calls
+from tracing import OTLPJsonFileExporter, TraceRingBuffer
+from agent_server import RunProfile
+from agent_server import ContextFilter, JsonFormatter, LogQueueHandler, current_run_id, parse_log_levels
+import time
 
 from typing import AsyncGenerator, cast
 
@@ -497,7 +761,17 @@ async def test_lifespan():
          patch("signal.getsignal", return_value=Mock()), \
          patch("asyncio.create_task", return_value=mock_task) as mock_create_task:
         
+        import logging
+        assert agent_server.log_handler is None
+        level = agent_server.logger.level
+        agent_server.logger.setLevel(logging.WARNING)
         async with lifespan(app_mock):
+            # Logging is configured here, not when agent_server is imported,
+            # and a level set by the embedding code is kept
+            assert agent_server.log_handler in logging.getLogger().handlers
+            assert agent_server.logger.level == logging.WARNING
+            agent_server.logger.setLevel(level)
+
             # Verify signal handlers were added for SIGTERM and SIGINT
             assert mock_loop.add_signal_handler.call_count == 2
             
@@ -510,22 +784,234 @@ async def test_lifespan():
             sessions["test_token"] = Session(agent=MagicMock(), queue=queue)
             
             try:
+                # The first signal starts draining
                 handler()
+                mock_loop.create_task.assert_called_once()
+                assert drainer.task is mock_loop.create_task.return_value
+                assert queue.empty()
+                # A failed drain is logged and still shuts down
+                with patch.object(drainer, "drain", AsyncMock(side_effect=RuntimeError("boom"))), \
+                     patch.object(agent_server.logger, "exception") as log_exception:
+                    await mock_loop.create_task.call_args[0][0]
+                log_exception.assert_called_once()
+                assert queue.get_nowait() == {"die": True}
+
+                # A second one (here: draining already) shuts down at once
+                with patch.object(drainer, "draining", True):
+                    handler()
                 assert queue.qsize() == 1
                 event = queue.get_nowait()
                 assert event == {"die": True}
             finally:
+                drainer.task = None
                 if "test_token" in sessions:
                     del sessions["test_token"]
             
         # Verify ping task was cancelled after yield
         assert mock_task.cancelled
+        assert agent_server.log_handler is None
+        assert not any(isinstance(h, LogQueueHandler) for h in logging.getLogger().handlers)
         
         # Capture the real ping_all_sessions coroutine that was passed to create_task
         # and close it to prevent the "unawaited coroutine" warning.
         coro = mock_create_task.call_args[0][0]
         coro.close()
 
+@pytest.mark.asyncio
+async def test_drain_releases_idle_sessions_now_and_busy_ones_after_their_run():
+    drainer = Drainer(timeout=5, retry_after=3)
+    sessions["idle_token"] = idle = Session(agent=MagicMock(), queue=asyncio.Queue())
+    sessions["busy_token"] = busy = Session(agent=MagicMock(), queue=asyncio.Queue())
+    run_done = asyncio.Event()
+
+    async def run():
+        drainer.run_started("busy_token")
+        await run_done.wait()
+        drainer.run_finished("busy_token")
+
+    run_task = asyncio.create_task(run())
+    try:
+        await asyncio.sleep(0)
+        drain_task = asyncio.create_task(drainer.drain())
+        await asyncio.sleep(0.01)
+        # Everyone hears about the restart; idle sessions are sent on their way at once
+        for session in (idle, busy):
+            assert json.loads(session.queue.get_nowait()[6:])["name"] == "server_notice"
+        assert idle.queue.get_nowait() == {"reconnect": {"retry_after": 3, "resume": "idle_token"}}
+        assert busy.queue.empty()
+        with pytest.raises(HTTPException) as exc_info:
+            drainer.check_accepting()
+        assert exc_info.value.status_code == 503
+        assert exc_info.value.headers == {"Retry-After": "3"}
+
+        run_done.set()
+        await asyncio.wait_for(drain_task, 1)
+        assert busy.queue.get_nowait() == {"reconnect": {"retry_after": 3, "resume": "busy_token"}}
+        # Sessions are only told once
+        assert idle.queue.empty()
+    finally:
+        await run_task
+        del sessions["idle_token"], sessions["busy_token"]
+
+@pytest.mark.asyncio
+async def test_drain_cancels_runs_past_its_timeout():
+    drainer = Drainer(timeout=0.05)
+    sessions["slow_token"] = session = Session(agent=MagicMock(), queue=asyncio.Queue())
+
+    async def run():
+        drainer.run_started("slow_token")
+        try:
+            await asyncio.sleep(60)
+        finally:
+            drainer.run_finished("slow_token")
+
+    run_task = asyncio.create_task(run())
+    try:
+        await asyncio.sleep(0)
+        await asyncio.wait_for(drainer.drain(), 2)
+        assert run_task.cancelled()
+        session.queue.get_nowait()  # the restart notice
+        assert "reconnect" in session.queue.get_nowait()
+        assert not drainer.runs
+    finally:
+        del sessions["slow_token"]
+
+@pytest.mark.asyncio
+async def test_events_reconnect_hands_session_off_to_resume(tmp_path):
+    request = MagicMock(spec=Request)
+    with patch("agent_server.HANDOFF_DIR", str(tmp_path)), patch("agent_server.drainer", Drainer(retry_after=2)) as drainer:
+        gen = cast(AsyncGenerator[str, None], (await events(request)).body_iterator)
+        token = json.loads((await anext(gen))[6:])["agent"].split("token=")[1]
+        session = sessions[token]
+        session.history_summaries = {"m1": "They said hi"}
+        messages = [ModelRequest(parts=[UserPromptPart(content="do it")])]
+        session.paused_run = PausedRun(thread_id="t", messages=messages, pending={"call-1"})
+
+        drainer.release(token, session)
+        assert await anext(gen) == (
+            f'event: reconnect\nretry: 2000\ndata: {{"retry_after": 2, "resume": "{token}"}}\n\n'
+        )
+        with pytest.raises(StopAsyncIteration):
+            await anext(gen)
+        assert token not in sessions
+
+        # The replacement process picks the session up, once
+        resumed_gen = cast(AsyncGenerator[str, None], (await events(request, resume=token)).body_iterator)
+        resumed_token = json.loads((await anext(resumed_gen))[6:])["agent"].split("token=")[1]
+        resumed = sessions[resumed_token]
+        assert resumed.history_summaries == {"m1": "They said hi"}
+        assert resumed.paused_run is not None and resumed.paused_run.pending == {"call-1"}
+        assert resumed.paused_run.messages[0].parts[0].content == "do it"
+        assert not list(tmp_path.iterdir())
+        await resumed_gen.aclose()
+
+        again_gen = cast(AsyncGenerator[str, None], (await events(request, resume=token)).body_iterator)
+        again_token = json.loads((await anext(again_gen))[6:])["agent"].split("token=")[1]
+        assert sessions[again_token].paused_run is None
+        await again_gen.aclose()
+
+@pytest.mark.asyncio
+async def test_corrupt_handoff_is_treated_as_none(tmp_path):
+    token = str(uuid4())
+    (tmp_path / f"{token}.json").write_text('{"saved": 1')
+    with patch("agent_server.HANDOFF_DIR", str(tmp_path)):
+        gen = cast(AsyncGenerator[str, None], (await events(MagicMock(spec=Request), resume=token)).body_iterator)
+        new_token = json.loads((await anext(gen))[6:])["agent"].split("token=")[1]
+        assert sessions[new_token].paused_run is None
+        await gen.aclose()
+    assert not list(tmp_path.iterdir())
+
+def test_draining_server_turns_new_clients_away():
+    assert client.get("/ready").json() == {"ready": True}
+    with patch("agent_server.drainer.draining", True):
+        for response in (client.get("/ready"), client.post("/events")):
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == str(DRAIN_RETRY_AFTER)
+        assert "agui_draining 1" in client.get("/metrics").text
+
+def test_broker_encodes_each_event_once_for_all_recipients():
+    queues = {token: asyncio.Queue() for token in ("a_token", "b_token", "c_token")}
+    for token, queue in queues.items():
+        sessions[token] = Session(agent=MagicMock(), queue=queue)
+    sessions["full_token"] = Session(agent=MagicMock(), queue=asyncio.Queue(maxsize=1))
+    sessions["full_token"].queue.put_nowait("backlog")
+    broker = EventBroker()
+    broker.join("a_token", "room")
+    broker.join("b_token", "room")
+    dropped = agent_server.events_dropped.get()
+    try:
+        with patch("agent_server.encode_sse", wraps=agent_server.encode_sse) as encode:
+            assert broker.broadcast({"notice": "hi"}) == 3
+            assert encode.call_count == 1
+            frames = [queue.get_nowait() for queue in queues.values()]
+            assert frames[0] == b'data: {"notice": "hi"}\n\n'
+            assert all(frame is frames[0] for frame in frames)
+            assert agent_server.events_dropped.get() == dropped + 1
+
+            assert broker.publish("room", {"n": 1}) == 2
+            assert queues["c_token"].empty()
+            assert broker.send("c_token", {"n": 2}) == 1
+            # Nobody to tell: nothing is encoded
+            assert broker.send("gone_token", {"n": 3}) == 0
+            assert broker.publish("empty", {"n": 4}) == 0
+            assert encode.call_count == 3
+
+        broker.join("b_token", "lobby")
+        broker.leave("a_token", "room")
+        assert broker.groups == {"room": {"b_token"}, "lobby": {"b_token"}}
+        assert "a_token" not in broker.memberships
+        broker.leave("b_token")
+        assert broker.groups == {} and broker.memberships == {}
+    finally:
+        for token in (*queues, "full_token"):
+            del sessions[token]
+
+@pytest.mark.asyncio
+async def test_events_streams_broker_frames_and_leaves_groups_on_close():
+    request = MagicMock(spec=Request)
+    gen = cast(AsyncGenerator[str, None], (await events(request, group=["room"])).body_iterator)
+    token = json.loads((await anext(gen))[6:])["agent"].split("token=")[1]
+    assert token in agent_server.broker.groups["room"]
+
+    assert agent_server.broker.publish("room", {"hello": "room"}) == 1
+    assert await anext(gen) == b'data: {"hello": "room"}\n\n'
+    assert agent_server.notify_sessions("Maintenance at noon", token=token) == 1
+    notice = json.loads((await anext(gen))[6:])
+    assert (notice["name"], notice["value"]) == ("server_notice", {"message": "Maintenance at noon", "level": "info"})
+
+    await gen.aclose()
+    assert "room" not in agent_server.broker.groups
+    assert token not in agent_server.broker.memberships
+
+def test_events_rejects_invalid_or_unlisted_groups():
+    for query in ("group=" + "x" * 65, "group=a%20b", "&".join(f"group=g{i}" for i in range(17))):
+        assert client.post(f"/events?{query}").status_code == 400
+    with patch("agent_server.EVENT_GROUPS", frozenset({"ops"})):
+        response = client.post("/events?group=admins")
+        assert response.status_code == 400
+        assert "admins" in response.json()["detail"]
+
+def test_toolset_changed_refreshes_tool_list_and_tells_clients():
+    sessions["tools_token"] = session = Session(agent=MagicMock(), queue=asyncio.Queue())
+
+    def convert_units(value: float, unit: str) -> str:
+        """Convert a value between units."""
+        return f"{value} {unit}"
+
+    toolset.add_function(convert_units)
+    try:
+        toolset_changed()
+        event = json.loads(session.queue.get_nowait()[6:])
+        assert event["name"] == "tools_changed"
+        assert "convert_units" in [tool["name"] for tool in event["value"]["available_tools"]]
+        assert "convert_units" in [tool["name"] for tool in available_tools()]
+        assert "convert_units" in agent_server.tool_selector.docs
+    finally:
+        del toolset.tools["convert_units"]
+        toolset_changed()
+        del sessions["tools_token"]
+    assert "convert_units" not in [tool["name"] for tool in available_tools()]
+
 @pytest.mark.asyncio
 async def test_ping_all_sessions():
     # Setup mock session
@@ -542,7 +1028,7 @@ async def test_ping_all_sessions():
         # Verify ping was put in queue
         assert queue.qsize() == 1
         event = queue.get_nowait()
-        assert event == {"ping": True}
+        assert event == b'data: {"ping": true}\n\n'
         
         # Test QueueFull branch
         queue.put_nowait({"already": "full"})
@@ -564,22 +1050,18 @@ def test_create_agent():
 
 @pytest.mark.asyncio
 async def test_make_injector_stream_fn():
-    class MockModel:
-        async def request(self, messages, settings, params):
-            class MockResponse:
-                class MockPart:
-                    content = "Mock summary"
-                parts = [MockPart()]
-            return MockResponse()
-
-    mock_model = MockModel()
+    async def summary_stream(messages, info):
+        yield "Mock "
+        yield "summary"
+
+    mock_model = FunctionModel(stream_function=summary_stream)
     injector_fn = make_injector_stream_fn("test_tool", '{"arg": "value"}', mock_model)
     
     # First call - should yield tool call delta
     messages = []
     info = MagicMock()
     info.model_settings = None
-    info.model_request_parameters = None
+    info.model_request_parameters = ModelRequestParameters()
     
     async_iter_1 = injector_fn(messages, info)
     result_1 = []
@@ -604,23 +1086,1096 @@ async def test_make_injector_stream_fn():
     async for item in async_iter_2:
         result_2.append(item)
         
-    assert len(result_2) == 1
-    assert result_2[0] == "Mock summary"
+    # Summary text is forwarded delta by delta rather than as one finished part
+    assert result_2 == ["Mock ", "summary"]
     # Note: messages should now have another injected user prompt, making it 2 items
     assert len(messages) == 2
 
-def test_make_meme():
-    result_json = make_meme("hello", "world")
-    result = json.loads(result_json)
-    assert "url" in result
-    assert "meme_id" in result
-    
-    meme_id = result["meme_id"]
-    meme_path = Path(__file__).parent.parent / "generated_memes" / f"meme_{meme_id}.png"
-    assert meme_path.exists()
-    
-    # Cleanup
-    meme_path.unlink()
+def _latency_model(name: str, delay: float, text: str, calls: list[str]) -> FunctionModel:
+    """A FunctionModel stand-in that waits `delay` seconds before its first token."""
+    async def fn(messages, info):
+        calls.append(name)
+        await asyncio.sleep(delay)
+        return ModelResponse(parts=[TextPart(text)])
+
+    async def stream_fn(messages, info):
+        calls.append(name)
+        await asyncio.sleep(delay)
+        yield text
+
+    return FunctionModel(fn, stream_function=stream_fn, model_name=name)
+
+@pytest.mark.asyncio
+async def test_model_router_hedges_slow_primary_stream():
+    model_latency.clear()
+    calls = []
+    router = ModelRouter(
+        [_latency_model("slow", 5, "slow answer", calls), _latency_model("fast", 0, "fast answer", calls)],
+        default_hedge_delay=0.05,
+    )
+    agent = Agent(router.as_model())
+
+    async with agent.run_stream("hi") as result:
+        output = await asyncio.wait_for(result.get_output(), 2)
+
+    assert output == "fast answer"
+    assert calls == ["slow", "fast"]
+
+@pytest.mark.asyncio
+async def test_model_router_hedges_slow_primary():
+    model_latency.clear()
+    calls = []
+    router = ModelRouter(
+        [_latency_model("slow", 5, "slow answer", calls), _latency_model("fast", 0, "fast answer", calls)],
+        default_hedge_delay=0.05,
+    )
+    agent = Agent(router.as_model())
+
+    result = await asyncio.wait_for(agent.run("hi"), 2)
+
+    assert result.output == "fast answer"
+    assert calls == ["slow", "fast"]
+    assert len(model_latency["fast"].samples) == 1
+    # The cancelled loser is counted too, with how long it had taken so far
+    [slow_sample] = model_latency["slow"].samples
+    assert 0.05 <= slow_sample < 1
+
+@pytest.mark.asyncio
+async def test_model_router_no_hedge_when_primary_is_fast():
+    model_latency.clear()
+    calls = []
+    router = ModelRouter(
+        [_latency_model("primary", 0, "primary answer", calls), _latency_model("backup", 0, "backup answer", calls)],
+        default_hedge_delay=1,
+    )
+    result = await Agent(router.as_model()).run("hi")
+    assert result.output == "primary answer"
+    assert calls == ["primary"]
+
+@pytest.mark.asyncio
+async def test_model_router_fails_over_on_error():
+    model_latency.clear()
+    calls = []
+
+    async def broken_fn(messages, info):
+        calls.append("broken")
+        raise RuntimeError("backend down")
+
+    async def broken_stream_fn(messages, info):
+        calls.append("broken")
+        raise RuntimeError("backend down")
+        yield ""  # pragma: no cover
+
+    router = ModelRouter(
+        [FunctionModel(broken_fn, stream_function=broken_stream_fn, model_name="broken"),
+         _latency_model("backup", 0, "backup answer", calls)],
+        default_hedge_delay=10,
+    )
+    agent = Agent(router.as_model())
+    result = await asyncio.wait_for(agent.run("hi"), 2)
+    assert result.output == "backup answer"
+    assert calls == ["broken", "backup"]
+
+    calls.clear()
+    async with agent.run_stream("hi") as streamed:
+        output = await asyncio.wait_for(streamed.get_output(), 2)
+    assert output == "backup answer"
+    assert calls == ["broken", "backup"]
+
+@pytest.mark.asyncio
+async def test_model_router_cheap_turn_uses_fast_model():
+    model_latency.clear()
+    calls = []
+    router = ModelRouter(
+        [_latency_model("main", 0, "main answer", calls)],
+        fast_model=_latency_model("cheap", 0, "cheap answer", calls),
+    )
+    result = await Agent(router.as_model(cheap=True)).run("hi")
+    assert result.output == "cheap answer"
+    assert router.candidates(cheap=True)[1].model_name == "main"
+
+@pytest.mark.asyncio
+async def test_model_router_forwards_tool_calls():
+    model_latency.clear()
+
+    async def tool_stream_fn(messages, info):
+        if len(messages) == 1:
+            yield {0: DeltaToolCall(name="dangerous_tool", tool_call_id="call-1")}
+            yield {0: DeltaToolCall(json_args='{"text": "abc"}')}
+        else:
+            yield "done"
+
+    router = ModelRouter([FunctionModel(stream_function=tool_stream_fn, model_name="tools")])
+    agent = Agent(router.as_model(), tools=[dangerous_tool])
+
+    async with agent.run_stream("hi") as result:
+        assert await result.get_output() == "done"
+    tool_calls = [p for m in result.all_messages() for p in m.parts if isinstance(p, ToolCallPart)]
+    assert tool_calls[0].tool_name == "dangerous_tool"
+    assert tool_calls[0].args_as_dict() == {"text": "abc"}
+
+class _ProviderFunctionModel(FunctionModel):
+    """A FunctionModel whose streams carry provider details and usage, like a real backend's."""
+
+    @asynccontextmanager
+    async def request_stream(self, *args, **kwargs):
+        async with super().request_stream(*args, **kwargs) as response:
+            response.provider_details = {"thought_signature": "sig-1"}
+            response._usage = RequestUsage(input_tokens=5000, output_tokens=3)
+            yield response
+
+@pytest.mark.asyncio
+async def test_model_router_streams_the_backend_response_unchanged():
+    model_latency.clear()
+
+    async def thinking_stream_fn(messages, info):
+        yield {0: DeltaThinkingPart(content="Let me think", signature="sig-0")}
+        yield "answer"
+
+    router = ModelRouter([_ProviderFunctionModel(stream_function=thinking_stream_fn, model_name="backend")])
+    async with Agent(router.as_model()).run_stream("hi") as result:
+        assert await result.get_output() == "answer"
+    response = result.all_messages()[-1]
+    assert isinstance(response, ModelResponse)
+    assert response.model_name == "backend"
+    assert response.provider_details == {"thought_signature": "sig-1"}
+    [thinking] = [part for part in response.parts if isinstance(part, ThinkingPart)]
+    assert (thinking.content, thinking.signature) == ("Let me think", "sig-0")
+    assert response.usage.input_tokens >= 5000
+
+def test_model_router_hedge_delay_uses_percentile():
+    model_latency.clear()
+    model = _latency_model("tracked", 0, "", [])
+    router = ModelRouter([model], default_hedge_delay=7)
+    assert router.hedge_delay(model) == 7
+
+    for seconds in [0.5] * 19 + [2.0]:
+        model_latency.setdefault("tracked", LatencyTracker()).record(seconds)
+    # p95 of 20 samples is the 19th, not the maximum
+    assert router.hedge_delay(model) == 0.5
+    model_latency["tracked"].record(3.0)
+    assert router.hedge_delay(model) == 2.0
+
+    with pytest.raises(ValueError):
+        ModelRouter([])
+
+@pytest.mark.asyncio
+async def test_model_recorder_and_replayer_round_trip(tmp_path):
+    path = tmp_path / "recording.jsonl"
+
+    async def live_stream_fn(messages, info):
+        if len(messages) == 1:
+            await asyncio.sleep(0.05)
+            yield {0: DeltaToolCall(name="dangerous_tool", json_args='{"text": "abc"}', tool_call_id="call-1")}
+        else:
+            yield "all "
+            await asyncio.sleep(0.05)
+            yield "done"
+
+    recorder = ModelRecorder(FunctionModel(stream_function=live_stream_fn, model_name="live"), path)
+    async with Agent(recorder.as_model(), tools=[dangerous_tool]).run_stream("hi") as result:
+        assert await result.get_output() == "all done"
+
+    recordings = [ModelRecording.from_json(line) for line in path.read_text().splitlines()]
+    assert [(r.model, r.prompt, r.step) for r in recordings] == [("live", "hi", 0), ("live", "hi", 1)]
+    assert recordings[0].chunks[0][0] >= 0.05
+    assert recordings[1].chunks[1][0] - recordings[1].chunks[0][0] >= 0.05
+
+    replayer = ModelReplayer.load(path, time_scale=0)
+    agent = Agent(replayer.as_model(), tools=[dangerous_tool])
+    start = asyncio.get_running_loop().time()
+    async with agent.run_stream("hi") as result:
+        assert await result.get_output() == "all done"
+    assert asyncio.get_running_loop().time() - start < 0.05
+    tool_calls = [p for m in result.all_messages() for p in m.parts if isinstance(p, ToolCallPart)]
+    assert tool_calls[0].tool_call_id == "call-1"
+    assert tool_calls[0].args_as_dict() == {"text": "abc"}
+
+    # Non-streamed requests get the assembled response
+    assert (await agent.run("hi")).output == "all done"
+
+
+@pytest.mark.asyncio
+async def test_model_replayer_scales_timing_and_falls_back_in_order():
+    recordings = [
+        ModelRecording("m", "first", 0, [(0.1, "one")]),
+        ModelRecording("m", "second", 0, [(0.0, "two "), (0.1, "too")]),
+    ]
+    agent = Agent(ModelReplayer(recordings, time_scale=0.5).as_model())
+    loop = asyncio.get_running_loop()
+
+    start = loop.time()
+    async with agent.run_stream("second") as result:
+        assert await result.get_output() == "two too"
+    assert 0.05 <= loop.time() - start < 0.1
+
+    # Unrecorded prompts are answered by the recordings in turn
+    assert [(await agent.run("unknown")).output for _ in range(3)] == ["one", "two too", "one"]
+
+    with pytest.raises(ValueError):
+        ModelReplayer([])
+
+def _conversation(turns: int) -> list:
+    messages = [SystemMessage(id="sys", role="system", content="client system prompt")]
+    for i in range(turns):
+        messages.append(UserMessage(id=f"u{i}", role="user", content=f"question {i} " + "x" * 400))
+        messages.append(AssistantMessage(id=f"a{i}", role="assistant", content=f"answer {i} " + "y" * 400))
+    return messages
+
+@pytest.mark.asyncio
+async def test_compact_history_drops_old_turns():
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", messages=_conversation(10), state={},
+        tools=[], context=[], forwarded_props=None,
+    )
+    dropped = await compact_history(run_input, budget=1000, keep_recent=4)
+
+    assert dropped > 0
+    messages = run_input.messages
+    assert messages[0].id == "sys"
+    assert "omitted" in messages[1].content
+    # Recent turns are kept verbatim and the kept history starts at a user turn
+    assert [m.id for m in messages[-4:]] == ["u8", "a8", "u9", "a9"]
+    assert messages[2].role == "user"
+    assert sum(estimate_message_tokens(m) for m in messages) <= 1000
+
+@pytest.mark.asyncio
+async def test_compact_history_under_budget_is_untouched():
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", messages=_conversation(3), state={},
+        tools=[], context=[], forwarded_props=None,
+    )
+    assert await compact_history(run_input, budget=100_000, keep_recent=2) == 0
+    assert len(run_input.messages) == 7
+    assert context_token_budget("router:gemini-3.1-pro-preview") == 200_000
+    assert context_token_budget("unknown-model") == DEFAULT_CONTEXT_TOKEN_BUDGET
+
+@pytest.mark.asyncio
+async def test_compact_history_strips_stale_attachments():
+    image = BinaryInputContent(mime_type="image/png", data="iVBORw0KGgo=", filename="cat.png")
+    messages = _conversation(4)
+    messages[1] = UserMessage(id="u0", role="user", content=[TextInputContent(text="look"), image])
+    messages[-2] = UserMessage(id="u3", role="user", content=[TextInputContent(text="again"), image])
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", messages=messages, state={},
+        tools=[], context=[], forwarded_props=None,
+    )
+    await compact_history(run_input, budget=100_000, keep_recent=2)
+
+    assert run_input.messages[1].content[1].text == "[attachment cat.png omitted from history]"
+    # Attachments in the recent window are kept
+    assert run_input.messages[-2].content[1] is image
+
+@pytest.mark.asyncio
+async def test_compact_history_summaries_are_cached():
+    prompts = []
+
+    def summarize(messages, info):
+        prompts.append(messages[-1].parts[-1].content)
+        return ModelResponse(parts=[TextPart(f"summary {len(prompts)}")])
+
+    summary_model = FunctionModel(summarize)
+    cache: dict[str, str] = {}
+
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", messages=_conversation(10), state={},
+        tools=[], context=[], forwarded_props=None,
+    )
+    await compact_history(run_input, budget=1000, keep_recent=4, summary_model=summary_model, summary_cache=cache)
+    # The run doesn't wait for the summary; it is made in the background for the next turn
+    assert "omitted" in run_input.messages[1].content
+    await asyncio.gather(*pending_summaries.values())
+    assert len(cache) == 1
+
+    # Same history again: the cached summary is used without another model call
+    run_input.messages = _conversation(10)
+    await compact_history(run_input, budget=1000, keep_recent=4, summary_model=summary_model, summary_cache=cache)
+    assert "summary 1" in run_input.messages[1].content
+    assert len(prompts) == 1
+
+    # A longer history only summarizes the newly dropped turns on top of the cached summary
+    run_input.messages = _conversation(12)
+    await compact_history(run_input, budget=1000, keep_recent=4, summary_model=summary_model, summary_cache=cache)
+    await compact_history(run_input, budget=1000, keep_recent=4, summary_model=summary_model, summary_cache=cache)
+    await asyncio.gather(*pending_summaries.values())
+    # Only one summary is made for the same dropped turns
+    assert len(prompts) == 2
+    assert "summary 1" in prompts[1]
+    assert "question 0" not in prompts[1]
+    # Only the latest summary is kept
+    assert list(cache.values()) == ["summary 2"]
+
+@pytest.mark.asyncio
+async def test_compact_history_falls_back_to_omitting_when_summarizing_fails():
+    async def hang(messages, info):
+        await asyncio.sleep(10)
+        return ModelResponse(parts=[TextPart("too late")])
+
+    def fail(messages, info):
+        raise RuntimeError("backend down")
+
+    for summarize in (hang, fail):
+        cache = {"u0": "older summary"}
+        run_input = RunAgentInput(
+            thread_id="t", run_id="r", messages=_conversation(10), state={},
+            tools=[], context=[], forwarded_props=None,
+        )
+        with patch("agent_server.SUMMARY_TIMEOUT_SECONDS", 0.05):
+            dropped = await compact_history(
+                run_input, budget=1000, keep_recent=4, summary_model=FunctionModel(summarize), summary_cache=cache,
+            )
+            await asyncio.gather(*pending_summaries.values())
+        assert run_input.messages[1].content == f"[{dropped} earlier messages were omitted to fit the context window]"
+        assert cache == {"u0": "older summary"}
+
+@pytest.mark.asyncio
+async def test_compact_history_never_starts_with_a_tool_result():
+    call = ToolCall(id="call-1", type="function", function=FunctionCall(name="evaluate_expression", arguments="{}"))
+    messages = [
+        UserMessage(id="u0", role="user", content="question " + "x" * 4000),
+        AssistantMessage(id="a0", role="assistant", content="answer " + "y" * 4000),
+        UserMessage(id="u1", role="user", content="compute it"),
+        AssistantMessage(id="a1", role="assistant", content="", tool_calls=[call]),
+        ToolMessage(id="t1", role="tool", content="42", tool_call_id="call-1"),
+        AssistantMessage(id="a2", role="assistant", content="It is 42"),
+        UserMessage(id="u2", role="user", content="thanks"),
+        AssistantMessage(id="a3", role="assistant", content="You're welcome"),
+    ]
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", messages=messages, state={}, tools=[], context=[], forwarded_props=None,
+    )
+    # The window of 4 would start at the tool result; it moves back to the user turn that
+    # made the call, and everything older is dropped
+    dropped = await compact_history(run_input, budget=1, keep_recent=4)
+
+    assert dropped == 2
+    assert "omitted" in run_input.messages[0].content
+    assert [m.id for m in run_input.messages[1:]] == ["u1", "a1", "t1", "a2", "u2", "a3"]
+
+    # With no earlier user turn to move back to, the history is left alone
+    run_input.messages = messages[2:6]
+    assert await compact_history(run_input, budget=1, keep_recent=2) == 0
+
+def test_tool_selector_ranks_relevant_tools():
+    selector = ToolSelector(toolset.tools)
+    assert selector.select("make a doge meme about cats", top_k=1) == {"make_meme"}
+    assert selector.select("evaluate the expression 3 * 7", top_k=1) == {"evaluate_expression"}
+    assert selector.select("rot13 encrypt this text", top_k=1) == {"dangerous_tool"}
+    # Nothing relevant: the caller falls back to sending every tool
+    assert selector.select("hello there", top_k=1) is None
+
+def test_select_tools_keeps_tools_used_in_thread():
+    messages = [
+        UserMessage(id="u0", role="user", content="rot13 this"),
+        AssistantMessage(id="a0", role="assistant", tool_calls=[
+            ToolCall(id="c0", type="function", function=FunctionCall(name="dangerous_tool", arguments="{}"))
+        ]),
+        UserMessage(id="u1", role="user", content="now make a meme"),
+    ]
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", messages=messages, state={},
+        tools=[], context=[], forwarded_props=None,
+    )
+    assert select_tools(run_input, top_k=1) == {"make_meme", "dangerous_tool"}
+
+def test_select_tools_ignores_attached_file_text():
+    notes = base64.b64encode(b"evaluate the mathematical expression operators").decode()
+    run_input = RunAgentInput(
+        thread_id="t", run_id="r", state={"attachments": {"notes.txt": f"data:text/plain;base64,{notes}"}},
+        messages=[UserMessage(id="u0", role="user", content="meme")],
+        tools=[], context=[], forwarded_props=None,
+    )
+    process_attachments(run_input)
+    assert "mathematical expression" in run_input.messages[0].content[1].text
+    assert select_tools(run_input, top_k=1) == {"make_meme"}
+
+def test_response_cache_ttl_and_size_eviction():
+    cache = ResponseCache(ttl=60, max_bytes=10)
+    cache.put("a", [(0.0, "12345")])
+    cache.put("b", [(0.0, "12345")])
+    assert cache.get("a") is not None  # "a" is now most recently used
+    cache.put("c", [(0.0, "12345")])
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.size == 10
+
+    # Entries larger than the whole cache are not stored
+    cache.put("huge", [(0.0, "x" * 11)])
+    assert cache.get("huge") is None
+
+    with patch("agent_server.time.monotonic", return_value=10**9):
+        assert cache.get("a") is None
+    assert "a" not in cache.entries
+
+@pytest.mark.asyncio
+async def test_stream_agent_response_replays_cached_response():
+    calls = []
+
+    async def stream_fn(messages, info):
+        calls.append(1)
+        yield "Cached "
+        yield "answer"
+
+    agent = Agent(
+        FunctionModel(stream_function=stream_fn, model_name="cache-test"),
+        toolsets=[toolset],
+        output_type=[DeferredToolRequests, str],
+        deps_type=StateDeps[Dependencies],
+    )
+
+    async def run(run_id: str) -> list[str]:
+        run_input = RunAgentInput(
+            thread_id="thread", run_id=run_id, state={}, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id=f"msg-{run_id}", role="user", content="same prompt")],
+        )
+        return [chunk async for chunk in stream_agent_response(
+            "cache_token", run_input, agent, StateDeps(Dependencies()), None, {}, {}
+        )]
+
+    with patch("agent_server.RESPONSE_CACHE_ENABLED", True), \
+         patch("agent_server.response_cache", ResponseCache()) as cache:
+        first = await run("run-1")
+        second = await run("run-2")
+
+    assert len(calls) == 1
+    assert cache.hits == 1
+    assert "".join(second).count("Cached ") == 1
+    assert '"runId": "run-2"' in second[0]
+    assert len(first) == len(second)
+
+    # The replayed message gets its own id, so it doesn't overwrite the original turn's
+    def message_ids(chunks: list[str]) -> set[str]:
+        return {json.loads(c[6:])["messageId"] for c in chunks if '"messageId"' in c}
+    assert len(message_ids(first)) == len(message_ids(second)) == 1
+    assert message_ids(first) != message_ids(second)
+
+@pytest.mark.asyncio
+async def test_runs_that_call_impure_tools_are_not_cached():
+    rolls = []
+
+    def roll() -> str:
+        """Roll a die."""
+        rolls.append(1)
+        return str(len(rolls))
+
+    def double(x: int) -> int:
+        """Double x."""
+        return 2 * x
+
+    tools = ServerToolset()
+    tools.add_function(roll)
+    tools.add_function(double, pure=True)
+    model_calls = []
+
+    def agent_for(tool_name: str, args: str) -> Agent:
+        async def stream_fn(messages, info):
+            model_calls.append(tool_name)
+            if any(isinstance(p, ToolReturnPart) for p in messages[-1].parts):
+                yield "done"
+            else:
+                yield {0: DeltaToolCall(name=tool_name, json_args=args, tool_call_id="call-1")}
+
+        return Agent(
+            FunctionModel(stream_function=stream_fn, model_name="cache-test"),
+            toolsets=[tools],
+            output_type=[DeferredToolRequests, str],
+            deps_type=StateDeps[Dependencies],
+        )
+
+    async def run(agent: Agent, prompt: str) -> None:
+        run_input = RunAgentInput(
+            thread_id="thread", run_id="run", state={}, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id="msg", role="user", content=prompt)],
+        )
+        [chunk async for chunk in stream_agent_response(
+            "cache_token", run_input, agent, StateDeps(Dependencies()), None, {}, {}
+        )]
+
+    with patch("agent_server.RESPONSE_CACHE_ENABLED", True), \
+         patch("agent_server.response_cache", ResponseCache()), \
+         patch("agent_server.toolset", tools):
+        for _ in range(2):
+            await run(agent_for("double", '{"x": 2}'), "double two")
+            await run(agent_for("roll", "{}"), "roll a die")
+
+    # The pure tool's run is replayed; the die is rolled again
+    assert model_calls.count("double") == 2
+    assert model_calls.count("roll") == 4
+    assert len(rolls) == 2
+    assert tools.is_replayable("double", {"x": 2}) and not tools.is_replayable("roll", {})
+    assert toolset.is_replayable("evaluate_expression", {"expression": "2 + 2"})
+    assert not toolset.is_replayable("evaluate_expression", {"expression": "rand()"})
+    assert not toolset.is_replayable("make_meme", {"top_text": "a", "bottom_text": "b"})
+
+@pytest.mark.asyncio
+async def test_tool_progress_stream_coalesces_updates():
+    sent = []
+    progress = ToolProgressStream(sent.append, min_interval=0.05)
+    for i in range(4):
+        progress.report("tool", "call-1", i / 4, f"step {i}")
+    progress.report("tool", "call-2", None, "other call")
+    # The first update of each call goes out at once; the rest wait for the interval
+    assert len(sent) == 2
+    await asyncio.sleep(0.1)
+    assert len(sent) == 3
+    assert json.loads(sent[-1][6:])["value"]["message"] == "step 3"
+    assert progress.coalesced == 2
+
+@pytest.mark.asyncio
+async def test_with_tool_progress_holds_the_run_back_for_a_slow_client():
+    produced = 0
+
+    async def chunks():
+        nonlocal produced
+        for i in range(1000):
+            produced += 1
+            yield f"data: {i}\n\n"
+
+    stream = with_tool_progress(chunks())
+    assert await anext(stream) == "data: 0\n\n"
+    await asyncio.sleep(0.01)
+    # The run stops once the queue is full instead of buffering everything
+    assert produced <= RUN_OUTPUT_QUEUE_SIZE + 2
+    assert len([chunk async for chunk in stream]) == 999
+
+@pytest.mark.asyncio
+async def test_stream_agent_response_streams_tool_progress():
+    async def count_up():
+        """Count to five, reporting progress."""
+        for i in range(5):
+            yield ToolProgress(fraction=(i + 1) / 5, message=f"at {i + 1}")
+        yield "counted to 5"
+
+    def crunch() -> str:
+        """Crunch numbers on a worker thread."""
+        report_progress(0.5, "crunching")
+        return "crunched"
+
+    tools = ServerToolset()
+    tools.add_function(count_up)
+    executor = ToolExecutor("threads", max_workers=1, name="progress-test")
+    tools.add_function(crunch, execution=ToolExecution(executor))
+    agent = Agent(
+        TestModel(call_tools=["count_up", "crunch"]),
+        toolsets=[tools],
+        output_type=[DeferredToolRequests, str],
+        deps_type=StateDeps[Dependencies],
+    )
+    run_input = RunAgentInput(
+        thread_id="thread", run_id="run", state={}, tools=[], context=[], forwarded_props=None,
+        messages=[UserMessage(id="msg", role="user", content="count")],
+    )
+    chunks = [chunk async for chunk in stream_agent_response(
+        "progress_token", run_input, agent, StateDeps(Dependencies()), None, {}, {}
+    )]
+    executor.shutdown()
+
+    progress = [json.loads(c[6:])["value"] for c in chunks if '"name": "tool_progress"' in c]
+    by_tool = {}
+    for update in progress:
+        by_tool.setdefault(update["tool_name"], []).append(update)
+    # Five quick updates are rate-limited to the first and the latest
+    assert [u["message"] for u in by_tool["count_up"]] == ["at 1", "at 5"]
+    assert by_tool["count_up"][0]["tool_call_id"]
+    assert [u["message"] for u in by_tool["crunch"]] == ["crunching"]
+    assert "counted to 5" in "".join(chunks)
+
+@pytest.mark.asyncio
+async def test_agent_run_resumes_paused_run_from_snapshot():
+    seen_histories = []
+
+    async def stream_fn(messages, info):
+        seen_histories.append(messages)
+        if len(messages) == 1:
+            yield {0: DeltaToolCall(name="dangerous_tool", json_args='{"text": "hello"}', tool_call_id="call-1")}
+        else:
+            yield "Encrypted."
+
+    token = "resume_token"
+    agent = Agent(
+        FunctionModel(stream_function=stream_fn, model_name="resume-test"),
+        toolsets=[toolset],
+        output_type=[DeferredToolRequests, str],
+        deps_type=StateDeps[Dependencies],
+    )
+    sessions[token] = Session(agent=agent, queue=asyncio.Queue())
+    request = MagicMock(spec=Request)
+
+    async def post(run_input: RunAgentInput) -> str:
+        response = await agent_run(request, run_input, token)
+        return "".join([chunk async for chunk in response.body_iterator])
+
+    try:
+        paused = await post(RunAgentInput(
+            thread_id="thread", run_id="run-1", state={}, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id="u1", role="user", content="encrypt hello")],
+        ))
+        assert '"call-1"' in paused
+        assert sessions[token].paused_run.pending == {"call-1"}
+
+        # Resending the history along with the resume flag would duplicate it
+        with pytest.raises(HTTPException) as exc:
+            await agent_run(request, RunAgentInput(
+                thread_id="thread", run_id="run-2", tools=[], context=[], forwarded_props=None,
+                messages=[UserMessage(id="u1", role="user", content="encrypt hello")],
+                state={"resume_paused_run": True, "deferred_tool_approvals": {"call-1": True}},
+            ), token)
+        assert exc.value.status_code == 400
+        assert sessions[token].paused_run is not None
+
+        # Only the decision is sent back; the history comes from the snapshot
+        resume = RunAgentInput(
+            thread_id="thread", run_id="run-2", tools=[], context=[], forwarded_props=None, messages=[],
+            state={"resume_paused_run": True, "deferred_tool_approvals": {"call-1": True}},
+        )
+        resumed = await post(resume)
+        assert "Encrypted." in resumed
+        assert sessions[token].paused_run is None
+        tool_return = seen_histories[-1][-1].parts[0]
+        assert tool_return.tool_name == "dangerous_tool"
+        assert tool_return.content == "uryyb"
+
+        # The snapshot is consumed, so the same approval can't be replayed
+        with pytest.raises(HTTPException) as exc:
+            await agent_run(request, resume, token)
+        assert exc.value.status_code == 409
+    finally:
+        del sessions[token]
+
+def test_metrics_render_prometheus_text_format():
+    registry = MetricsRegistry()
+    calls = registry.register(Counter("test_calls_total", "Calls", ("tool",)))
+    latency = registry.register(Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0)))
+    registry.register(Gauge("test_depth", "Depth", lambda: 3))
+    calls.inc(tool='say "hi"')
+    calls.inc(2, tool='say "hi"')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    text = registry.render()
+    assert "# TYPE test_calls_total counter" in text
+    assert 'test_calls_total{tool="say \\"hi\\""} 3' in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{le="1"} 2' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "test_latency_seconds_sum 5.55" in text
+    assert "test_latency_seconds_count 3" in text
+    assert "test_depth 3" in text
+
+@pytest.mark.asyncio
+async def test_agent_run_records_metrics():
+    def shout(text: str) -> str:
+        """Uppercase the text."""
+        return text.upper()
+
+    tools = ServerToolset()
+    tools.add_function(shout)
+    agent = Agent(
+        TestModel(call_tools=["shout"]),
+        toolsets=[tools],
+        output_type=[DeferredToolRequests, str],
+        deps_type=StateDeps[Dependencies],
+    )
+    token = "metrics_token"
+    sessions[token] = Session(agent=agent, queue=asyncio.Queue())
+    runs_before = run_duration.count(outcome="finished")
+    calls_before = tool_calls.get(tool="shout", outcome="ok")
+    try:
+        response = await agent_run(MagicMock(spec=Request), RunAgentInput(
+            thread_id="thread", run_id="run", state={}, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id="u1", role="user", content="shout")],
+        ), token)
+        [chunk async for chunk in response.body_iterator]
+    finally:
+        del sessions[token]
+
+    assert run_duration.count(outcome="finished") == runs_before + 1
+    assert tool_calls.get(tool="shout", outcome="ok") == calls_before + 1
+    body = client.get("/metrics").text
+    for name in (
+        "agui_active_sessions", "agui_run_time_to_first_token_seconds_count",
+        "agui_run_time_to_first_byte_seconds_count", "agui_run_events_bucket",
+        'agui_tool_call_duration_seconds_count{tool="shout"}',
+        'agui_tool_cache_lookups_total{tool="evaluate_expression",result="hits"}', "agui_tool_cache_entries",
+        'agui_tool_calls_rejected_total{tool="evaluate_expression"}',
+        'agui_expression_evaluations_total{outcome="ok"}',
+    ):
+        assert name in body
+
+@pytest.mark.asyncio
+async def test_agent_run_profile_on_request():
+    def busy() -> str:
+        """Keep the event loop busy for a moment."""
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return "done"
+
+    tools = ServerToolset()
+    tools.add_function(busy, execution=ToolExecution(inline_tool_executor))
+    agent = Agent(
+        TestModel(call_tools=["busy"]),
+        toolsets=[tools],
+        output_type=[DeferredToolRequests, str],
+        deps_type=StateDeps[Dependencies],
+    )
+    token = "profile_token"
+    sessions[token] = Session(agent=agent, queue=asyncio.Queue())
+    run_input = RunAgentInput(
+        thread_id="thread", run_id="profiled-run", state={"profile": "Sample"}, tools=[], context=[],
+        forwarded_props=None, messages=[UserMessage(id="u1", role="user", content="work")],
+    )
+    try:
+        # Clients can only ask for a profile when the server has profiling on
+        response = await agent_run(MagicMock(spec=Request), run_input, token)
+        assert "x-agui-profile-url" not in response.headers
+        [chunk async for chunk in response.body_iterator]
+
+        with patch("agent_server.PROFILING", True):
+            response = await agent_run(MagicMock(spec=Request), run_input, token)
+        # The id is the server's, not the client's run id
+        profile_url = response.headers["x-agui-profile-url"]
+        profile_id = profile_url.removeprefix("/debug/profiles/")
+        assert profile_id != "profiled-run"
+        # The sampler only starts once the response body is iterated
+        assert not profiles[profile_id].sampler._thread.is_alive()
+        [chunk async for chunk in response.body_iterator]
+    finally:
+        del sessions[token]
+    assert not profiles[profile_id].sampler._thread.is_alive()
+
+    # Profiles are only downloadable with debug access
+    assert client.get(profile_url).status_code == 403
+    with patch("agent_server.DEBUG", True):
+        download = client.get(profile_url)
+        assert client.get("/debug/profiles/unknown").status_code == 404
+    assert download.status_code == 200
+    assert f"profile-{profile_id}.folded" in download.headers["content-disposition"]
+    weights = {}
+    for line in download.text.splitlines():
+        path, _, weight = line.rpartition(" ")
+        weights[path] = int(weight)
+    assert weights["agent_run;stream_agent_response;run_ag_ui;tool:busy"] >= 50_000
+    assert "agent_run;sse_write" in weights
+    # The busy tool ran on the event loop, so the sampler saw it
+    assert any(path.startswith("event_loop;") and "busy" in path for path in weights)
+
+def test_only_one_event_loop_sampler_runs_at_a_time():
+    first, second = EventLoopSampler(), EventLoopSampler()
+    assert first.start()
+    try:
+        assert not second.start()
+    finally:
+        first.stop()
+    first.stop()
+    assert second.start()
+    second.stop()
+
+@pytest.mark.asyncio
+async def test_unsent_profiled_response_leaves_no_sampler_running():
+    token = "unsent_profile_token"
+    sessions[token] = Session(agent=MagicMock(), queue=asyncio.Queue())
+    try:
+        request = MagicMock(spec=Request)
+        request.headers = {"x-agui-profile": " SAMPLE "}
+        with patch("agent_server.PROFILING", True):
+            response = await agent_run(request, RunAgentInput(
+                thread_id="thread", run_id="never-sent", state={}, tools=[], context=[],
+                forwarded_props=None, messages=[UserMessage(id="u1", role="user", content="work")],
+            ), token)
+    finally:
+        del sessions[token]
+    profile = profiles[response.headers["x-agui-profile-url"].removeprefix("/debug/profiles/")]
+    assert profile.sampler is not None
+    assert profile.sampler._thread.ident is None
+    profile.sampler.stop()
+
+def test_run_profile_self_times():
+    profile = RunProfile("p")
+    profile.add("a", 1.0)
+    profile.add("a;b", 0.25)
+    profile.add("a;b;c", 0.5)
+    assert profile.self_times() == {"a": 0.75, "a;b": 0.0, "a;b;c": 0.5}
+    assert profile.collapsed().splitlines() == ["a 750000", "a;b 0", "a;b;c 500000"]
+
+@pytest.mark.asyncio
+async def test_run_stats_event_and_session_totals():
+    def slow_tool() -> str:
+        """Take a little while."""
+        threading.Event().wait(0.02)
+        return "ok"
+
+    tools = ServerToolset()
+    tools.add_function(slow_tool)
+    agent = Agent(
+        TestModel(call_tools=["slow_tool"]),
+        toolsets=[tools],
+        output_type=[DeferredToolRequests, str],
+        deps_type=StateDeps[Dependencies],
+    )
+    token = "stats_token"
+    sessions[token] = Session(agent=agent, queue=asyncio.Queue())
+
+    async def run(run_id: str) -> dict:
+        run_input = RunAgentInput(
+            thread_id="thread", run_id=run_id, state={}, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id=f"u-{run_id}", role="user", content="go")],
+        )
+        chunks = [chunk async for chunk in stream_agent_response(
+            token, run_input, agent, StateDeps(Dependencies()), None, {}, {}
+        )]
+        [stats] = [json.loads(c[6:])["value"] for c in chunks if '"name": "run_stats"' in c]
+        # Sent right before RUN_FINISHED, next to deferred_tool_requests
+        names = [json.loads(c[6:]).get("name") or json.loads(c[6:])["type"] for c in chunks if c.startswith("data: ")]
+        assert names[names.index("run_stats") - 1] == "deferred_tool_requests"
+        assert names[names.index("run_stats") + 1] == "RUN_FINISHED"
+        return stats
+
+    try:
+        first = await run("run-1")
+        second = await run("run-2")
+    finally:
+        session = sessions.pop(token)
+
+    run_stats = first["run"]
+    assert run_stats["requests"] == 2
+    assert run_stats["input_tokens"] > 0 and run_stats["output_tokens"] > 0
+    assert run_stats["tool_calls"] == 1
+    assert run_stats["tool_time_ms"] >= 20
+    assert run_stats["time_to_first_token_ms"] is not None
+    assert run_stats["bytes_streamed"] > 0
+    assert second["session_totals"]["runs"] == 2
+    assert second["session_totals"]["input_tokens"] == first["run"]["input_tokens"] + second["run"]["input_tokens"]
+    assert session.usage.tool_calls == 2
+
+def test_debug_sessions_needs_debug_access():
+    sessions["usage_token"] = session = Session(agent=MagicMock(), queue=asyncio.Queue())
+    session.usage.add(RunStats(runs=1, input_tokens=10))
+    try:
+        assert client.get("/debug/sessions").status_code == 403
+        with patch("agent_server.DEBUG", True):
+            listed = client.get("/debug/sessions").json()["sessions"]
+    finally:
+        del sessions["usage_token"]
+    [entry] = [s for s in listed if s["token"] == "usage_to"]
+    assert entry["usage"]["input_tokens"] == 10
+
+@pytest.mark.asyncio
+async def test_run_stats_report_the_backend_usage_through_the_router():
+    model_latency.clear()
+
+    async def stream_fn(messages, info):
+        yield "answer"
+
+    router = ModelRouter([_ProviderFunctionModel(stream_function=stream_fn, model_name="backend")])
+    agent = Agent(router.as_model(), output_type=[DeferredToolRequests, str], deps_type=StateDeps[Dependencies])
+    token = "router_stats_token"
+    sessions[token] = Session(agent=agent, queue=asyncio.Queue(), router=router)
+    run_input = RunAgentInput(
+        thread_id="thread", run_id="run-1", state={}, tools=[], context=[], forwarded_props=None,
+        messages=[UserMessage(id="u-1", role="user", content="go")],
+    )
+    try:
+        chunks = [chunk async for chunk in stream_agent_response(
+            token, run_input, agent, StateDeps(Dependencies()), None, {}, {}
+        )]
+    finally:
+        session = sessions.pop(token)
+    [stats] = [json.loads(c[6:])["value"] for c in chunks if '"name": "run_stats"' in c]
+    # The backend's own count, not FunctionModel's estimate of a two-word prompt
+    assert stats["run"]["input_tokens"] == 5000
+    assert session.usage.input_tokens == 5000
+
+def test_estimate_size_counts_shared_objects_once_and_only_data():
+    payload = "x" * 10_000
+    assert estimate_size([payload, payload]) < estimate_size([payload, "y" * 10_000])
+    message = ModelRequest(parts=[UserPromptPart(content=[payload])])
+    assert estimate_size(message) > 10_000
+    # Arbitrary objects aren't followed
+    assert estimate_size(MagicMock()) < 1_000
+
+def _paused_session_with_attachments() -> Session:
+    messages = [ModelRequest(parts=[UserPromptPart(content=[
+        "look at these",
+        BinaryContent(data=b"\x89PNG" * 250_000, media_type="image/png"),
+        '<file-attachment name="notes.txt">\n' + "n" * 500_000 + "\n</file-attachment>",
+    ])])]
+    session = Session(agent=MagicMock(), queue=asyncio.Queue())
+    session.paused_run = PausedRun(thread_id="t", messages=messages, pending={"call-1"}, created=0.0)
+    session.history_summaries = {f"m{i}": "s" * 100_000 for i in range(3)}
+    return session
+
+def test_enforce_session_memory_sheds_attachments_then_history_then_paused_run():
+    session = _paused_session_with_attachments()
+    assert enforce_session_memory("tok", session, limit=10_000_000) > 1_000_000
+    assert session.paused_run is not None and len(session.history_summaries) == 3
+
+    retained = enforce_session_memory("tok", session, limit=250_000)
+    assert retained <= 250_000
+    content = session.paused_run.messages[0].parts[0].content
+    assert content[0] == "look at these"
+    assert content[1] == "[image/png attachment removed to save server memory]"
+    assert content[2] == '<file-attachment name="notes.txt">[removed to save server memory]</file-attachment>'
+    assert list(session.history_summaries) == ["m2"]
+
+    # The latest summary is kept even when that leaves the session over its limit
+    assert enforce_session_memory("tok", session, limit=50_000) > 50_000
+    assert session.paused_run is None and list(session.history_summaries) == ["m2"]
+
+def test_debug_memory_lists_heaviest_sessions_first():
+    sessions["light_token"] = Session(agent=MagicMock(), queue=asyncio.Queue())
+    sessions["heavy_token"] = _paused_session_with_attachments()
+    try:
+        assert client.get("/debug/memory").status_code == 403
+        with patch("agent_server.DEBUG", True):
+            data = client.get("/debug/memory?limit=1").json()
+    finally:
+        del sessions["light_token"], sessions["heavy_token"]
+    [heaviest] = data["sessions"]
+    assert heaviest["token"] == "heavy_to"
+    assert heaviest["breakdown"]["paused_run"] > 1_000_000
+    assert data["total_bytes"] >= heaviest["bytes"]
+
+def test_tracemalloc_snapshots_on_demand():
+    # Tracing slows the whole process down, so only debug access may turn it on
+    assert client.post("/debug/memory/tracemalloc").status_code == 403
+    assert client.delete("/debug/memory/tracemalloc").status_code == 403
+
+    admin = {"Authorization": "Bearer admin-secret"}
+    with patch("agent_server.ADMIN_TOKEN", "admin-secret"):
+        assert client.post("/debug/memory/tracemalloc", headers=admin).json()["started"] is True
+        try:
+            retained = [bytearray(1024) for _ in range(1_000)]
+            first = client.post("/debug/memory/tracemalloc?limit=5", headers=admin).json()
+            assert first["started"] is False and len(first["top"]) == 5
+            assert first["traced_bytes"] >= 1024 * 1_000
+            # Later snapshots report growth since the previous one
+            assert "bytes_diff" in client.post("/debug/memory/tracemalloc", headers=admin).json()["top"][0]
+            del retained
+        finally:
+            assert client.delete("/debug/memory/tracemalloc", headers=admin).json() == {"tracing": False}
+
+def test_session_memory_estimates_the_queue_from_the_broker():
+    sessions["queued_token"] = session = Session(agent=MagicMock(), queue=asyncio.Queue())
+    broker = EventBroker()
+    try:
+        assert session_memory("queued_token", session)["queue"] == 0
+        for _ in range(3):
+            broker.send("queued_token", {"text": "x" * 1_000})
+        with patch("agent_server.broker", broker):
+            assert 3_000 < session_memory("queued_token", session)["queue"] < 4_000
+    finally:
+        del sessions["queued_token"]
+
+def test_is_cacheable_run_bypasses_approvals_and_attachments():
+    def make(state, content="hi"):
+        return RunAgentInput(
+            thread_id="t", run_id="r", state=state, tools=[], context=[], forwarded_props=None,
+            messages=[UserMessage(id="u", role="user", content=content)],
+        )
+
+    assert is_cacheable_run(make({}))
+    assert not is_cacheable_run(make({"deferred_tool_approvals": {"call": True}}))
+    assert not is_cacheable_run(make({"attachments": {"f.txt": "data:text/plain;base64,WA=="}}))
+    image = BinaryInputContent(mime_type="image/png", data="iVBORw0KGgo=", filename="cat.png")
+    assert not is_cacheable_run(make({}, [TextInputContent(text="look"), image]))
+
+def test_response_cache_key_covers_client_tools_and_context():
+    def key(tools=(), context=()):
+        run_input = RunAgentInput(
+            thread_id="t", run_id="r", state={}, tools=list(tools), context=list(context), forwarded_props=None,
+            messages=[UserMessage(id="u", role="user", content="hi")],
+        )
+        return response_cache_key("model", "prompt", ["dangerous_tool"], run_input)
+
+    weather = Tool(name="weather", description="Look up the weather", parameters={"type": "object"})
+    clock = Tool(name="clock", description="Read the time", parameters={"type": "object"})
+    assert key() != key([weather])
+    assert key([weather, clock]) == key([clock, weather])
+    assert key([weather]) != key([weather.model_copy(update={"description": "Look up the forecast"})])
+    assert key() != key(context=[Context(description="user location", value="Paris")])
+    assert key(context=[Context(description="user location", value="Paris")]) != key(
+        context=[Context(description="user location", value="Oslo")]
+    )
+
+@pytest.mark.asyncio
+async def test_make_meme():
+    queue: asyncio.Queue = asyncio.Queue()
+    sessions["meme-token"] = Session(agent=MagicMock(), queue=queue)
+    current_session_token.set("meme-token")
+    try:
+        result_json = await make_meme("hello", "world")
+        result = json.loads(result_json)
+        assert "url" in result
+        assert "meme_id" in result
+
+        # The handle comes back before the image is rendered
+        job = jobs.get(result["job_id"])
+        assert job is not None and not job.done
+        await job.wait(10)
+        assert job.status == "done"
+
+        meme_id = result["meme_id"]
+        meme_path = Path(__file__).parent.parent / "generated_memes" / f"meme_{meme_id}.png"
+        assert meme_path.exists()
+
+        events = []
+        while not queue.empty():
+            events.append(json.loads(queue.get_nowait()[6:]))
+        assert events[0]["name"] == "job_progress" and events[0]["value"]["status"] == "pending"
+        assert any(e["value"]["message"] == "Saving image" for e in events)
+        assert events[-1]["name"] == "job_finished"
+        assert events[-1]["value"]["status"] == "done"
+        # A cached result repeats the job id, so it expires before the job is pruned
+        assert agent_server.meme_cache.ttl <= jobs.retention
+
+        # Cleanup
+        meme_path.unlink()
+    finally:
+        sessions.pop("meme-token", None)
+        current_session_token.set(None)
+
+@pytest.mark.asyncio
+async def test_serve_meme_returns_202_while_rendering():
+    release = threading.Event()
+
+    def slow_render(meme_id: str, progress) -> None:
+        release.wait(5)
+
+    runner = ToolRunner("slow", ToolExecution(inline_tool_executor))
+    runner.execution.executor = ToolExecutor("threads", max_workers=1, name="slow-render")
+    job = jobs.submit("make_meme", slow_render, "pending1", runner=runner, job_id="meme-pending1")
+    with patch("agent_server.MEME_WAIT_SECONDS", 0.05):
+        response = await serve_meme("pending1")
+    assert response.status_code == 202
+    assert response.headers["retry-after"] == "1"
+    assert json.loads(response.body)["status"] == "running"
+
+    release.set()
+    await job.wait(5)
+    # Finished, but this job didn't produce a file
+    with pytest.raises(HTTPException) as exc:
+        await serve_meme("pending1")
+    assert exc.value.status_code == 404
+    assert (await job_status("meme-pending1"))["status"] == "done"
+    runner.execution.executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_failed_job_reports_error_and_respects_backlog():
+    def broken(progress) -> None:
+        progress(0.5, "halfway")
+        raise ValueError("boom")
+
+    runner = ToolRunner("broken", ToolExecution(inline_tool_executor, max_backlog=1))
+    job = jobs.submit("broken", broken, runner=runner)
+    # The first job still counts against the backlog, so a second is rejected immediately
+    with pytest.raises(ToolOverloaded):
+        jobs.submit("broken", broken, runner=runner)
+    await job.wait(5)
+    assert job.status == "failed"
+    assert job.error == "boom"
+    assert runner.backlog == 0
 
 def test_parse_data_url_valid():
     result = parse_data_url("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB")
@@ -645,6 +2200,286 @@ def test_evaluate_expression_invalid_syntax():
     result = evaluate_expression("2 + ")
     assert "Error evaluating expression" in result
 
+def test_expression_pool_timeout_replaces_worker():
+    pool = ExpressionWorkerPool(size=1, timeout=0.3)
+    try:
+        result = pool.evaluate("999999 ** 999999")
+        assert "timed out" in result
+        assert pool.stats.timeouts == 1
+        # The replacement worker keeps serving
+        assert pool.evaluate("6 * 7") == "42"
+        assert pool.stats.calls == 2
+        assert pool.stats.latency_max >= 0.3
+    finally:
+        pool.close()
+
+def test_expression_pool_replaces_dead_worker():
+    pool = ExpressionWorkerPool(size=1)
+    try:
+        pool.start()
+        worker = pool._idle.queue[0]
+        worker.process.kill()
+        worker.process.join()
+        assert "resource limit" in pool.evaluate("1 + 1")
+        assert pool.stats.crashes == 1
+        assert pool.evaluate("1 + 1") == "2"
+        assert pool.stats.by_outcome() == {("ok",): 1, ("timeout",): 0, ("crash",): 1}
+    finally:
+        pool.close()
+
+def test_expression_pool_waits_for_a_worker_with_a_bound():
+    pool = ExpressionWorkerPool(size=1, wait_timeout=0.2)
+    try:
+        pool.start()
+        busy = pool._idle.get()
+        with pytest.raises(ToolOverloaded):
+            pool.evaluate("1 + 1")
+        # A worker lost to a failed respawn is made up on the next call
+        busy.kill()
+        pool._workers.discard(busy)
+        assert pool.evaluate("1 + 1") == "2"
+        assert len(pool._workers) == 1
+    finally:
+        pool.close()
+
+def test_expression_pool_stats_are_exported_and_consistent_across_threads():
+    pool = ExpressionWorkerPool(size=2)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(8) as threads:
+            assert list(threads.map(pool.evaluate, ["1 + 1"] * 40)) == ["2"] * 40
+        assert pool.stats.calls == 40
+        with patch("agent_server.expression_pool", pool):
+            body = client.get("/metrics").text
+        assert 'agui_expression_evaluations_total{outcome="ok"} 40' in body
+        assert 'agui_expression_evaluations_total{outcome="timeout"} 0' in body
+        assert "# TYPE agui_expression_evaluations_total counter" in body
+        assert "agui_expression_evaluation_seconds_total " in body
+        assert "agui_expression_evaluation_seconds_max " in body
+    finally:
+        pool.close()
+
+def test_evaluate_expression_batch():
+    rows = [{"x": 1, "y": 2}, {"x": 10, "y": -4}, {"x": 3, "y": 0}]
+    assert json.loads(evaluate_expression_batch("x * y + 1", rows)) == ["3", "-39", "1"]
+    # Division by zero falls back to per-row evaluation for that row
+    assert json.loads(evaluate_expression_batch("x / y", rows)) == ["0.5", "-2.5", "inf"]
+    # Non-arithmetic expressions are evaluated row by row
+    assert json.loads(evaluate_expression_batch("str(x) + '!'", rows[:1])) == ["1!"]
+    assert "at most" in evaluate_expression_batch("x", [{"x": 1}] * (BATCH_MAX_ROWS + 1))
+
+def test_evaluate_batch_vectorized_matches_per_row():
+    cases = [
+        ("a * b - a % 3", [{"a": a, "b": b} for a in range(-5, 6) for b in range(-3, 4)]),
+        ("a / b + b ** 2", [{"a": a / 4, "b": b / 3} for a in range(-5, 6) for b in range(-3, 4)]),
+        ("-a ** 0.5", [{"a": -4.0}, {"a": 9.0}]),
+        ("a ** b", [{"a": 2.0, "b": 5000000.0}, {"a": 2.0, "b": 3.0}]),
+    ]
+    for expression, rows in cases:
+        assert expression_worker._evaluate_vectorized(expression, rows) is not None
+        assert expression_worker.evaluate_batch(expression, rows) == [
+            expression_worker.evaluate(expression, row) for row in rows
+        ]
+    # Mixed int/float bindings and integer division are not vectorized
+    assert expression_worker._evaluate_vectorized("a / b", [{"a": 1, "b": 2}]) is None
+    assert expression_worker._evaluate_vectorized("a", [{"a": 1}, {"a": 2.5}]) is None
+    # Constant expressions keep simpleeval's result type
+    assert expression_worker._evaluate_vectorized("2 + 3", [{"a": 1.5}]) is None
+    assert expression_worker.evaluate_batch("2 + 3", [{"a": 1.5}]) == ["5"]
+
+def test_evaluate_batch_vectorized_catches_intermediate_overflow():
+    # Exact final results whose intermediate products don't fit float64 exactly
+    cases = [
+        ("a*b+1-a*b", {"a": 2**30 + 1, "b": 2**30 + 1}, "1"),
+        ("a*b % 7", {"a": 3037000500, "b": 3037000500}, "4"),
+    ]
+    for expression, row, expected in cases:
+        rows = [row, {"a": 3, "b": 4}]
+        assert expression_worker._evaluate_vectorized(expression, rows)[0] is None
+        assert expression_worker.evaluate_batch(expression, rows) == [
+            expected, expression_worker.evaluate(expression, rows[1])
+        ]
+
+def test_expression_parse_cache():
+    expression_worker.parse.cache_clear()
+    for _ in range(3):
+        assert expression_worker.evaluate("2 + x", {"x": 3}) == "5"
+    info = expression_worker.parse.cache_info()
+    assert info.misses == 1 and info.hits == 2
+
+@pytest.mark.asyncio
+async def test_tool_result_cache_single_flight_and_ttl():
+    cache = ToolResultCache(maxsize=2, ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    # Concurrent identical calls share one execution, argument order doesn't matter
+    results = await asyncio.gather(
+        cache.call({"a": 1, "b": 2}, compute),
+        cache.call({"b": 2, "a": 1}, compute),
+    )
+    assert results == ["result", "result"]
+    assert len(calls) == 1
+    assert await cache.call({"a": 1, "b": 2}, compute) == "result"
+    assert len(calls) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "shared": 1, "bypassed": 0, "hit_rate": 2 / 3, "size": 1}
+
+    # LRU eviction
+    await cache.call({"x": 1}, compute)
+    await cache.call({"x": 2}, compute)
+    assert ToolResultCache.key({"a": 1, "b": 2}) not in cache.entries
+
+    # Expired entries are recomputed
+    cache.ttl = -1
+    await cache.call({"x": 2}, compute)
+    assert len(calls) == 4
+
+@pytest.mark.asyncio
+async def test_tool_result_cache_does_not_cache_errors():
+    cache = ToolResultCache()
+
+    async def failing():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await cache.call({}, failing)
+    assert cache.entries == {} and cache.inflight == {}
+
+@pytest.mark.asyncio
+async def test_expression_cache_skips_random_expressions_and_error_results():
+    cache = toolset.caches["evaluate_expression"]
+    calls = []
+
+    async def compute(result):
+        calls.append(result)
+        return result
+
+    for expression in ("rand() * 10", "randint(6) + 1", "1 + randint (3)"):
+        assert not is_deterministic_expression({"expression": expression})
+    assert is_deterministic_expression({"expression": "operand + 2"})
+
+    bypassed = cache.bypassed
+    await cache.call({"expression": "rand()"}, lambda: compute("0.5"))
+    await cache.call({"expression": "rand()"}, lambda: compute("0.7"))
+    assert calls == ["0.5", "0.7"]
+    assert cache.bypassed == bypassed + 2
+    assert ToolResultCache.key({"expression": "rand()"}) not in cache.entries
+
+    error = "Error evaluating expression: timed out after 5 seconds"
+    args = {"expression": "9 ** 9 ** 9 + 0"}
+    await cache.call(args, lambda: compute(error))
+    assert ToolResultCache.key(args) not in cache.entries
+    await cache.call(args, lambda: compute("42"))
+    assert cache.entries[ToolResultCache.key(args)][1] == "42"
+    cache.invalidate(args)
+
+@pytest.mark.asyncio
+async def test_caching_toolset_reuses_results():
+    calls = []
+
+    def double(x: int) -> int:
+        """Double a number."""
+        calls.append(x)
+        return x * 2
+
+    cached_toolset = ServerToolset()
+    cached_toolset.add_function(double, cache=ToolResultCache())
+    agent = Agent(TestModel(call_tools=["double"]), toolsets=[cached_toolset])
+
+    await agent.run("go")
+    await agent.run("go")
+
+    assert len(calls) == 1
+    assert cached_toolset.cache_stats()["double"]["hits"] == 1
+    assert "evaluate_expression" in toolset.cache_stats()
+
+@pytest.mark.asyncio
+async def test_server_toolset_runs_sync_tools_on_configured_executor():
+    threads = {}
+
+    def on_dedicated(label: str) -> str:
+        """Report the thread the tool ran on."""
+        threads["on_dedicated"] = threading.current_thread().name
+        return label
+
+    def on_inline(label: str) -> str:
+        """Report the thread the tool ran on."""
+        threads["on_inline"] = threading.current_thread().name
+        return label
+
+    dedicated = ToolExecutor("threads", max_workers=1, name="dedicated-test")
+    tools = ServerToolset()
+    tools.add_function(on_dedicated, execution=ToolExecution(dedicated))
+    tools.add_function(on_inline, execution=ToolExecution(inline_tool_executor))
+    # The wrapper keeps the original schema
+    assert tools.tools["on_dedicated"].function_schema.json_schema["properties"] == {"label": {"type": "string"}}
+
+    agent = Agent(TestModel(call_tools=["on_dedicated", "on_inline"]), toolsets=[tools])
+    await agent.run("go")
+
+    assert threads["on_dedicated"].startswith("dedicated-test")
+    assert threads["on_inline"] == threading.current_thread().name
+    dedicated.shutdown()
+
+@pytest.mark.asyncio
+async def test_tool_runner_circuit_breaker_fails_fast():
+    release = threading.Event()
+    executor = ToolExecutor("threads", max_workers=1, name="breaker-test")
+    runner = ToolRunner("slow_tool", ToolExecution(executor, max_concurrency=1, max_backlog=2, breaker_reset=60))
+
+    running = [asyncio.ensure_future(runner.run(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    assert runner.backlog == 2
+
+    with pytest.raises(ToolOverloaded, match="overloaded"):
+        await runner.run(release.wait)
+    release.set()
+    await asyncio.gather(*running)
+
+    # The breaker stays open for breaker_reset seconds even though the backlog drained
+    with pytest.raises(ToolOverloaded):
+        await runner.run(release.wait)
+    assert runner.rejected == 2
+    runner.open_until = 0
+    assert await runner.run(release.wait) is True
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_overloaded_tool_returns_a_result_without_using_retries():
+    def busy_tool() -> str:
+        """Always busy."""
+        return "ran"
+
+    tools = ServerToolset()
+    tools.add_function(busy_tool, execution=ToolExecution(inline_tool_executor, max_backlog=0), retries=0)
+    calls_before = tool_calls.get(tool="busy_tool", outcome="overloaded")
+    # With no retries left, a ModelRetry would fail the run instead
+    result = await Agent(TestModel(call_tools=["busy_tool"]), toolsets=[tools]).run("go")
+
+    [returned] = [p for m in result.all_messages() for p in m.parts if isinstance(p, ToolReturnPart)]
+    assert "overloaded" in returned.content
+    assert tools.runners["busy_tool"].rejected == 1
+    assert tool_calls.get(tool="busy_tool", outcome="overloaded") == calls_before + 1
+
+def test_tool_executors_are_forgotten_once_dropped():
+    import gc
+    executor = ToolExecutor("threads", max_workers=1, name="dropped-test")
+    assert executor in tool_executors
+    del executor
+    gc.collect()
+    assert not any(e.name == "dropped-test" for e in tool_executors)
+
+@pytest.mark.asyncio
+async def test_tool_executor_process_pool():
+    executor = ToolExecutor("processes", max_workers=1, name="process-test")
+    try:
+        assert await executor.run(math.factorial, 10) == 3628800
+    finally:
+        executor.shutdown()
+
 def test_dangerous_tool():
     result = dangerous_tool("testing")
     assert result == "grfgvat"
@@ -0,0 +1,39 @@
+import logging
+from unittest.mock import patch
+
+import agent_server
+from benchmarks.load_test import LoadConfig, percentile, run_inprocess
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 0.5) == 51.0
+    assert percentile(values, 0.99) == 100.0
+    assert percentile([], 0.5) == 0.0
+
+
+def test_load_test_inprocess_smoke():
+    config = LoadConfig(sessions=[3], turns=2, tokens=5, token_rate=0, latency=0)
+    records: list[logging.LogRecord] = []
+    handler = logging.Handler()
+    handler.emit = records.append  # type: ignore[method-assign]
+    agent_server.logger.addHandler(handler)
+    with patch.object(agent_server, "MODEL_BACKENDS", list(agent_server.MODEL_BACKENDS)), \
+         patch.object(agent_server, "FAST_MODEL", agent_server.FAST_MODEL):
+        try:
+            [result] = run_inprocess(config)
+        finally:
+            agent_server.logger.removeHandler(handler)
+            agent_server.logger.setLevel(logging.DEBUG)
+
+    # Per-request logs stay out of the profile, even though the server's lifespan ran
+    assert all(record.levelno >= logging.WARNING for record in records)
+
+    assert result.connected == 3
+    assert result.errors == 0
+    assert result.turns == 6
+    assert result.events > 0
+    assert result.ttfb_ms["p50"] > 0
+    assert result.rss_idle_mb > 0
+    assert result.rss_settled_mb > 0
+    assert result.rss_per_session_kb == (result.rss_idle_mb - result.rss_baseline_mb) * 1024 / 3
@@ -0,0 +1,43 @@
+import pytest
+
+from benchmarks.micro import BENCHMARKS, Benchmark, check, main, time_benchmark
+
+
+def test_check_flags_regressions_past_threshold():
+    baseline = {"benchmarks": {
+        "fast": {"best": 1.0},
+        "tuned": {"best": 1.0, "threshold": 1.0},
+        "steady": {"best": 1.0},
+    }}
+    results = {
+        "fast": {"best": 1.3},
+        "tuned": {"best": 1.9},  # within its own, looser threshold
+        "steady": {"best": 1.1},
+        "new": {"best": 5.0},  # no baseline yet
+    }
+    assert check(results, baseline, threshold=0.25) == ["fast"]
+
+
+def test_time_benchmark_reports_per_unit():
+    calls = []
+    result = time_benchmark(Benchmark("noop", lambda: lambda: calls.append(1), units=10))
+    assert result["calls"] >= 1
+    assert 0 < result["best"] <= result["median"]
+    assert len(calls) > result["calls"]
+
+
+def test_benchmarks_cover_hot_paths():
+    names = {bench.name for bench in BENCHMARKS}
+    assert {"process_attachments_binary_50mb", "parse_data_url_10mb", "tool_schema_to_a2ui_all_tools",
+            "stream_agent_response_per_chunk", "render_meme", "evaluate_expression"} <= names
+
+
+def test_check_needs_a_local_baseline(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main(["check", "--baseline", str(tmp_path / "baseline.json")])
+    assert "make bench-baseline" in capsys.readouterr().err
+
+
+def test_startup_benchmarks_carry_their_own_threshold():
+    thresholds = {bench.name: bench.threshold for bench in BENCHMARKS}
+    assert thresholds["startup_import"] == thresholds["startup_time_to_ready"] == 0.5
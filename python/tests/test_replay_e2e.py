@@ -0,0 +1,80 @@
+"""End-to-end test of the agent server against recorded model streams (no browser or API key)."""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections.abc import Generator
+from pathlib import Path
+from typing import Any
+
+import httpx
+import pytest
+
+RECORDING = Path(__file__).parent / "recordings" / "arithmetic.jsonl"
+BACKEND_LOG = "/tmp/aguitest-backend-e2e.log"
+
+
+@pytest.fixture(scope="session")
+def backend_url() -> Generator[str, None, None]:
+    """Start the agent server on a free port, replaying recorded model streams instantly."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    url = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "AGUI_REPLAY_FILE": str(RECORDING), "AGUI_REPLAY_TIME_SCALE": "0"}
+    env.setdefault("GOOGLE_API_KEY", "unused-during-replay")
+    with open(BACKEND_LOG, "w") as backend_log:
+        backend = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "agent_server:app", "--port", str(port)],
+            cwd=Path(__file__).parent.parent,
+            env=env,
+            stdout=backend_log,
+            stderr=backend_log,
+        )
+        try:
+            for _ in range(60):
+                try:
+                    httpx.get(f"{url}/metrics", timeout=1)
+                    break
+                except httpx.RequestError:
+                    time.sleep(0.5)
+            else:
+                raise RuntimeError(f"Backend failed to start, see {BACKEND_LOG}")
+
+            yield url
+        finally:
+            backend.terminate()
+            backend.wait()
+
+
+def test_agent_run_with_replayed_model(backend_url: str) -> None:
+    """A full /events + /agent round trip, including a server tool call, without a live model."""
+    with httpx.Client(base_url=backend_url, timeout=30) as client:
+        with client.stream("POST", "/events") as events:
+            lines = events.iter_lines()
+            agent_url = next(json.loads(line[5:]) for line in lines if line.startswith("data:"))["agent"]
+
+            run_input = {
+                "threadId": "e2e-thread",
+                "runId": "e2e-run",
+                "state": {},
+                "messages": [{"id": "u1", "role": "user", "content": "What is 6 * 7?"}],
+                "tools": [],
+                "context": [],
+                "forwardedProps": {},
+            }
+            response = client.post(agent_url, json=run_input)
+
+    events_by_type: dict[str, list[dict[str, Any]]] = {}
+    for line in response.text.splitlines():
+        if line.startswith("data:"):
+            event = json.loads(line[5:])
+            events_by_type.setdefault(event["type"], []).append(event)
+    assert events_by_type["TOOL_CALL_START"][0]["toolCallName"] == "evaluate_expression"
+    assert any(e["content"] == "42" for e in events_by_type["TOOL_CALL_RESULT"])
+    text = "".join(e["delta"] for e in events_by_type["TEXT_MESSAGE_CONTENT"])
+    assert text == "6 * 7 is **42**."
+    assert "RUN_FINISHED" in events_by_type
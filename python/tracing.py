@@ -0,0 +1,234 @@
+"""In-memory trace sampling and OTLP/JSON file export for the agent server.
+
+Kept separate from agent_server so the OpenTelemetry SDK is only imported when
+tracing is enabled (see agent_server.instrument).
+"""
+
+import concurrent.futures
+import json
+import random
+import threading
+import typing
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from pathlib import Path
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+from opentelemetry.trace import StatusCode
+
+TRACE_BUFFER_SIZE = 200  # traces kept in memory
+DEFAULT_SAMPLE_RATE = 0.1  # head sampling; the server passes AGUI_TRACE_SAMPLE_RATE
+TRACE_SLOW_SECONDS = 5.0  # tail sampling: slower traces are always kept, as are errors
+TRACE_MAX_OPEN = 1_000  # traces still being assembled before the oldest are dropped
+
+
+@dataclass
+class TraceRecord:
+    trace_id: int
+    spans: list[ReadableSpan]
+    reason: typing.Literal["sampled", "slow", "error"]
+    duration: float
+    session: str | None = None
+    run_id: str | None = None
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return {
+            "trace_id": format(self.trace_id, "032x"),
+            "reason": self.reason,
+            "duration_ms": round(self.duration * 1000, 3),
+            "session": self.session,
+            "run_id": self.run_id,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": format(span.context.span_id, "016x"),
+                    "parent_id": format(span.parent.span_id, "016x") if span.parent else None,
+                    "start_time_unix_nano": span.start_time,
+                    "duration_ms": round(((span.end_time or 0) - (span.start_time or 0)) / 1e6, 3),
+                    "status": span.status.status_code.name,
+                    "attributes": dict(span.attributes or {}),
+                }
+                for span in self.spans
+            ],
+        }
+
+
+class TraceRingBuffer(SpanProcessor):
+    """Keeps recent traces in memory, with head and tail sampling.
+
+    Spans are held until their trace's root span ends. The trace is then kept if it was
+    head-sampled when it started, took at least slow_seconds, or contains an error.
+    Kept traces are also handed to exporter (on a background thread) when one is given.
+    """
+
+    def __init__(
+        self,
+        size: int = TRACE_BUFFER_SIZE,
+        sample_rate: float = DEFAULT_SAMPLE_RATE,
+        slow_seconds: float = TRACE_SLOW_SECONDS,
+        exporter: SpanExporter | None = None,
+        max_open: int = TRACE_MAX_OPEN,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.exporter = exporter
+        self.max_open = max_open
+        self.traces: deque[TraceRecord] = deque(maxlen=size)
+        self.open: OrderedDict[int, list[ReadableSpan]] = OrderedDict()
+        self.head_sampled: set[int] = set()
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._export_pool = (
+            concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="trace-export") if exporter else None
+        )
+
+    def on_start(self, span: typing.Any, parent_context: typing.Any = None) -> None:
+        if span.parent is None and random.random() < self.sample_rate:
+            with self._lock:
+                self.head_sampled.add(span.context.trace_id)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        trace_id = span.context.trace_id
+        with self._lock:
+            spans = self.open.setdefault(trace_id, [])
+            spans.append(span)
+            if span.parent is not None and not span.parent.is_remote:
+                while len(self.open) > self.max_open:
+                    evicted, _ = self.open.popitem(last=False)
+                    self.head_sampled.discard(evicted)
+                    self.dropped += 1
+                return
+            del self.open[trace_id]
+            head_sampled = trace_id in self.head_sampled
+            self.head_sampled.discard(trace_id)
+
+        duration = ((span.end_time or 0) - (span.start_time or 0)) / 1e9
+        if any(s.status.status_code == StatusCode.ERROR for s in spans):
+            reason = "error"
+        elif duration >= self.slow_seconds:
+            reason = "slow"
+        elif head_sampled:
+            reason = "sampled"
+        else:
+            with self._lock:
+                self.dropped += 1
+            return
+
+        record = TraceRecord(trace_id=trace_id, spans=spans, reason=reason, duration=duration)
+        for s in spans:
+            attributes = s.attributes or {}
+            session = typing.cast(str | None, attributes.get("agui.session"))
+            # Session tokens are bearer credentials, so only their prefix is kept
+            record.session = record.session or (session[:8] if session else None)
+            record.run_id = record.run_id or typing.cast(str | None, attributes.get("agui.run_id"))
+        with self._lock:
+            self.traces.append(record)
+        if self.exporter is not None and self._export_pool is not None:
+            self._export_pool.submit(self.exporter.export, spans)
+
+    def find(self, session: str | None = None, run_id: str | None = None, limit: int = 20) -> list[TraceRecord]:
+        """Most recent kept traces first, optionally only those of a session (token or prefix) or run."""
+        # on_end appends from other threads, so iterate over a copy
+        with self._lock:
+            traces = list(self.traces)
+        found = []
+        for record in reversed(traces):
+            if session and record.session != session[:8]:
+                continue
+            if run_id and record.run_id != run_id:
+                continue
+            found.append(record)
+            if len(found) >= limit:
+                break
+        return found
+
+    def stats(self) -> dict[str, int]:
+        """Traces still being assembled, and traces dropped so far."""
+        with self._lock:
+            return {"open": len(self.open), "dropped": self.dropped}
+
+    def shutdown(self) -> None:
+        if self._export_pool is not None:
+            self._export_pool.shutdown(wait=True)
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30_000) -> bool:
+        return True
+
+
+def _otlp_value(value: typing.Any) -> dict[str, typing.Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: typing.Any) -> list[dict[str, typing.Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in (attributes or {}).items()]
+
+
+class OTLPJsonFileExporter(SpanExporter):
+    """Appends spans to a file as OTLP/JSON ExportTraceServiceRequest lines (the OTel file exporter format)."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+
+    def export(self, spans: typing.Sequence[ReadableSpan]) -> SpanExportResult:
+        scopes: dict[tuple[str, str], list[dict[str, typing.Any]]] = {}
+        for span in spans:
+            scope = span.instrumentation_scope
+            key = (scope.name, scope.version or "") if scope else ("", "")
+            scopes.setdefault(key, []).append({
+                "traceId": format(span.context.trace_id, "032x"),
+                "spanId": format(span.context.span_id, "016x"),
+                "parentSpanId": format(span.parent.span_id, "016x") if span.parent else "",
+                "name": span.name,
+                # OTLP's SpanKind enum reserves 0 for UNSPECIFIED
+                "kind": span.kind.value + 1,
+                "startTimeUnixNano": str(span.start_time),
+                "endTimeUnixNano": str(span.end_time),
+                "attributes": _otlp_attributes(span.attributes),
+                "events": [
+                    {"timeUnixNano": str(event.timestamp), "name": event.name, "attributes": _otlp_attributes(event.attributes)}
+                    for event in span.events
+                ],
+                "status": {"code": span.status.status_code.value, "message": span.status.description or ""},
+            })
+        resource = spans[0].resource.attributes if spans else {}
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes(resource)},
+                "scopeSpans": [
+                    {"scope": {"name": name, "version": version}, "spans": scope_spans}
+                    for (name, version), scope_spans in scopes.items()
+                ],
+            }]
+        }
+        with self.path.open("a") as f:
+            f.write(json.dumps(request) + "\n")
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        pass
+
+
+def install(service_name: str, sample_rate: float, trace_file: str | None = None) -> TraceRingBuffer:
+    """Set a tracer provider that feeds a new TraceRingBuffer, and return the buffer."""
+    provider = TracerProvider(resource=Resource.create(attributes={SERVICE_NAME: service_name}))
+    trace.set_tracer_provider(provider)
+    buffer = TraceRingBuffer(
+        sample_rate=sample_rate,
+        exporter=OTLPJsonFileExporter(trace_file) if trace_file else None,
+    )
+    provider.add_span_processor(buffer)
+    provider._disabled = False  # type: ignore[attr-defined]
+    return buffer
@@ -88,8 +88,9 @@ let shouldStreamScroll = false;
 let agent: HttpAgent;
 
 
-async function connectToEvents(): Promise<{ agentUrl: string; availableTools: { name: string; description: string }[] }> {
-  const response = await fetch("/events", { method: "POST" });
+async function connectToEvents(resume?: string): Promise<{ agentUrl: string; availableTools: { name: string; description: string }[] }> {
+  const url = resume ? `/events?resume=${encodeURIComponent(resume)}` : "/events";
+  const response = await fetch(url, { method: "POST" });
   if (!response.ok) {
     throw new Error(`Failed to connect to events: ${response.status}`);
   }
@@ -144,10 +145,26 @@ function listenForPings(
           const message = buffer.slice(0, newlineIndex);
           buffer = buffer.slice(newlineIndex + 2);
 
+          if (message.startsWith("event: reconnect")) {
+            // The server is restarting: pick the session up again once it's back
+            const dataLine = message.split("\n").find((line) => line.startsWith("data: "))!;
+            const { retry_after, resume } = JSON.parse(dataLine.slice(6));
+            setTimeout(() => reconnectToEvents(resume), retry_after * 1000);
+            return;
+          }
           if (message.startsWith("data: ")) {
             const data = JSON.parse(message.slice(6));
             if (data.ping) {
               addPingIndicator();
+            } else if (data.type === "CUSTOM" && data.name === "tools_changed") {
+              const toolToggles = document.getElementById("toolToggles") as ToolToggles;
+              toolToggles.setTools(data.value.available_tools);
+            } else if (data.type === "CUSTOM" && (data.name === "job_progress" || data.name === "job_finished")) {
+              // Tool results waiting on a background job (e.g. a meme still rendering) listen for these
+              window.dispatchEvent(new CustomEvent("job-update", { detail: data.value }));
+            } else if (data.type === "CUSTOM" && data.name === "server_notice") {
+              const log = data.value.level === "warning" ? console.warn : console.info;
+              log("[Server]", data.value.message);
             }
           }
         }
@@ -161,6 +178,22 @@ function listenForPings(
 }
 
 
+async function reconnectToEvents(resume: string, attempt = 1): Promise<void> {
+  try {
+    const { agentUrl } = await connectToEvents(resume);
+    agent.url = new URL(agentUrl, window.location.origin).href;
+    console.log("[Client] Reconnected to events, agent URL:", agentUrl);
+  } catch (error) {
+    if (attempt >= 10) {
+      showError("Lost connection to the server, please reload");
+      return;
+    }
+    console.warn("[Client] Reconnect failed, retrying:", error);
+    setTimeout(() => reconnectToEvents(resume, attempt + 1), Math.min(attempt, 5) * 1000);
+  }
+}
+
+
 function addPingIndicator(): void {
   const pingEl = document.getElementById("pingIndicator") as any;
   if (pingEl?.ping) pingEl.ping();
@@ -406,13 +439,29 @@ async function continueWithApprovals(approvals: Record<string, boolean>): Promis
 
   addTypingIndicator();
 
+  const runWithApprovals = () => agent.runAgent({}, createSubscriber({
+    logPrefix: " (with approvals)",
+    onFinished: () => {
+      delete agent.state!.deferred_tool_approvals;
+    },
+  }));
+
   try {
-    await agent.runAgent({}, createSubscriber({
-      logPrefix: " (with approvals)",
-      onFinished: () => {
-        delete agent.state!.deferred_tool_approvals;
-      },
-    }));
+    // The server resumes the paused run from its own snapshot, so only the decisions are sent
+    agent.state.resume_paused_run = true;
+    agent.messages = [];
+    try {
+      await runWithApprovals();
+    } catch (error: any) {
+      // 409: the snapshot expired or was evicted, so resend the conversation instead
+      if (!String(error?.message).includes("409")) throw error;
+      console.log("[Client] Paused run is gone, resending the conversation");
+      delete agent.state.resume_paused_run;
+      agent.messages = messages;
+      await runWithApprovals();
+    } finally {
+      delete agent.state.resume_paused_run;
+    }
   } catch (error: any) {
     console.error("[Client] Error continuing with approvals:", error);
     showError(error.message || "Failed to continue with approvals");